@@ -0,0 +1,9 @@
+## benchmarks
+#
+# synthetic tracks (generate.py) and per-stage timings of tracksim.py on
+# them (run.py), so performance can be measured without real data
+#
+# run from the repository root, e.g.
+#
+#   python3 -m benchmarks.generate --output-dir /tmp/tracks
+#   python3 -m benchmarks.run --output bench.json
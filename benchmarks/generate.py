@@ -0,0 +1,285 @@
+## generate.py
+#
+# seeded synthetic GPS tracks in the CSV layout tracksim.py reads
+#
+# tracks are spread over a few areas far enough apart to form separate
+# groups. each area has a shared corridor and a base route; every track
+# is one of
+#   * loop         - a wobbly closed loop
+#   * out_and_back - a random path and the same path back
+#   * corridor     - a random lead-in, the area's corridor (in either
+#                    direction) and a random lead-out
+#   * repeat       - the area's base route, shifted a little, at its own
+#                    speed
+# and gets independent GPS noise. each track is generated from its own
+# seed, so changing the count of one kind does not change the others.
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+ROUTE_KINDS = ['loop', 'out_and_back', 'corridor', 'repeat']
+
+METERS_PER_DEGREE_LAT = 111000
+
+# center of the first area; the others are further north
+ORIGIN_LAT = 41.88
+ORIGIN_LONG = -87.63
+AREA_SPACING_DEGREES = 1.0
+
+# spacing of the points paths are built from before resampling
+PATH_STEP_M = 10.0
+
+# 2020-01-01 UTC; tracks start at random times within the following year
+START_TIMESTAMP = 1577836800
+TIMEZONE = 'America/Chicago'
+
+DEFAULTS = {
+    'loops': 20,
+    'out_and_backs': 20,
+    'corridors': 20,
+    'repeats': 20,
+    'areas': 2,
+    'length_m': 5000.0,
+    'length_spread': 0.3,
+    'speed': 3.0,
+    'sample_seconds': 1,
+    'noise_m': 3.0,
+    'jitter_m': 10.0,
+    'seed': 0,
+}
+
+
+def random_path(rng, length_m, turn_sd=0.15):
+    """
+    (n, 2) array of x/y meters of a smoothly turning path from (0, 0)
+    """
+    n_steps = max(1, int(np.ceil(length_m / PATH_STEP_M)))
+    headings = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, turn_sd, n_steps))
+    steps = PATH_STEP_M * np.column_stack([np.cos(headings), np.sin(headings)])
+    return np.vstack([[0, 0], np.cumsum(steps, axis=0)])
+
+
+def loop_path(rng, length_m):
+    n_steps = max(3, int(np.ceil(length_m / PATH_STEP_M)))
+    theta = np.linspace(0, 2 * np.pi, n_steps + 1)
+    # a few low harmonics keep the loop closed but not circular
+    wobble = sum(
+        rng.uniform(0, 0.1) * np.sin(k * theta + rng.uniform(0, 2 * np.pi))
+        for k in range(2, 5)
+    )
+    radius = length_m / (2 * np.pi) * (1 + wobble)
+    theta = rng.uniform(0, 2 * np.pi) + rng.choice([-1, 1]) * theta
+    return np.column_stack([radius * np.cos(theta), radius * np.sin(theta)])
+
+
+def out_and_back_path(rng, length_m):
+    path = random_path(rng, length_m / 2)
+    return np.vstack([path, path[-2::-1]])
+
+
+def corridor_path(rng, length_m, corridor):
+    if rng.random() < 0.5:
+        corridor = corridor[::-1]
+    lead_length = max(0.0, length_m - path_length(corridor))
+    lead_in_length = rng.uniform(0, lead_length)
+    lead_in = random_path(rng, lead_in_length)[::-1]
+    lead_out = random_path(rng, lead_length - lead_in_length)
+    return np.vstack([
+        lead_in - lead_in[-1] + corridor[0],
+        corridor[1:],
+        lead_out[1:] + corridor[-1],
+    ])
+
+
+def path_length(path):
+    return np.sum(np.linalg.norm(np.diff(path, axis=0), axis=1))
+
+
+def resample(path, spacing_m):
+    """
+    points every spacing_m meters along a path
+    """
+    arc = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(path, axis=0), axis=1))])
+    s = np.arange(0, arc[-1] + spacing_m / 2, spacing_m)
+    return np.column_stack([np.interp(s, arc, path[:, 0]), np.interp(s, arc, path[:, 1])])
+
+
+def area_center(area):
+    return ORIGIN_LAT + area * AREA_SPACING_DEGREES, ORIGIN_LONG
+
+
+def area_routes(area, params):
+    """
+    the shared corridor and base route of an area
+    """
+    rng = np.random.default_rng([params['seed'], len(ROUTE_KINDS), area])
+    corridor = random_path(rng, params['length_m'] / 2, turn_sd=0.05)
+    base_route = loop_path(rng, params['length_m'])
+    return corridor, base_route
+
+
+def track_record(rng, path, area, params, speed):
+    """
+    dataframe of a track following path at speed, with GPS noise
+    """
+    points = resample(path, speed * params['sample_seconds'])
+    # distance is along the route, like a device's odometer
+    distance = np.concatenate([
+        [0],
+        np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1)),
+    ])
+    points = points + rng.normal(0, params['noise_m'], points.shape)
+    center_lat, center_long = area_center(area)
+    lat = center_lat + points[:, 1] / METERS_PER_DEGREE_LAT
+    long = center_long + points[:, 0] / (
+        METERS_PER_DEGREE_LAT * np.cos(np.pi / 180 * center_lat)
+    )
+    start = START_TIMESTAMP + int(rng.integers(0, 365 * 86400))
+    return pd.DataFrame({
+        'timestamp': start + params['sample_seconds'] * np.arange(points.shape[0]),
+        'position_lat': lat,
+        'position_long': long,
+        'distance': distance,
+        'timezone': TIMEZONE,
+    })
+
+
+def generate_track(kind, i, params, routes):
+    """
+    filename and dataframe of the i-th track of a kind
+    """
+    rng = np.random.default_rng([params['seed'], ROUTE_KINDS.index(kind), i])
+    area = i % params['areas']
+    corridor, base_route = routes[area]
+    length_m = params['length_m'] * (
+        1 + rng.uniform(-params['length_spread'], params['length_spread'])
+    )
+    speed = params['speed']
+    if kind == 'loop':
+        path = loop_path(rng, length_m)
+    elif kind == 'out_and_back':
+        path = out_and_back_path(rng, length_m)
+    elif kind == 'corridor':
+        path = corridor_path(rng, length_m, corridor)
+    elif kind == 'repeat':
+        path = base_route + rng.normal(0, params['jitter_m'], 2)
+        speed = speed * rng.uniform(0.8, 1.2)
+    else:
+        raise ValueError('unknown route kind %s' % kind)
+
+    return '%s_%04d.csv' % (kind, i), track_record(rng, path, area, params, speed)
+
+
+def counts_by_kind(params):
+    return {
+        'loop': params['loops'],
+        'out_and_back': params['out_and_backs'],
+        'corridor': params['corridors'],
+        'repeat': params['repeats'],
+    }
+
+
+def generate_tracks(params={}):
+    """
+    generator of (filename, dataframe) of every track; params are merged
+    with DEFAULTS
+    """
+    params = dict(DEFAULTS, **params)
+    routes = [area_routes(area, params) for area in range(params['areas'])]
+    for kind, count in counts_by_kind(params).items():
+        for i in range(count):
+            yield generate_track(kind, i, params, routes)
+
+
+def write_tracks(output_dir, params={}):
+    """
+    writes every track to a CSV in output_dir; returns their paths
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    for fn, record in generate_tracks(params):
+        path = os.path.join(output_dir, fn)
+        record.to_csv(path, index=False)
+        files.append(path)
+    return files
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--loops', type=int, default=DEFAULTS['loops'], help='Number of loops')
+    parser.add_argument(
+        '--out-and-backs',
+        type=int,
+        default=DEFAULTS['out_and_backs'],
+        help='Number of out-and-back tracks',
+    )
+    parser.add_argument(
+        '--corridors',
+        type=int,
+        default=DEFAULTS['corridors'],
+        help='Number of tracks along their area\'s shared corridor',
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=DEFAULTS['repeats'],
+        help='Number of jittered repeats of their area\'s base route',
+    )
+    parser.add_argument(
+        '--areas',
+        type=int,
+        default=DEFAULTS['areas'],
+        help='Number of separate areas (and groups) tracks are spread over',
+    )
+    parser.add_argument(
+        '--length-m',
+        type=float,
+        default=DEFAULTS['length_m'],
+        help='Average track length in meters',
+    )
+    parser.add_argument(
+        '--length-spread',
+        type=float,
+        default=DEFAULTS['length_spread'],
+        help='Track lengths vary uniformly by this fraction of --length-m',
+    )
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=DEFAULTS['speed'],
+        help='Speed in meters per second',
+    )
+    parser.add_argument(
+        '--sample-seconds',
+        type=int,
+        default=DEFAULTS['sample_seconds'],
+        help='Seconds between points; with --speed, sets the density of points',
+    )
+    parser.add_argument(
+        '--noise-m',
+        type=float,
+        default=DEFAULTS['noise_m'],
+        help='Standard deviation of GPS noise in meters',
+    )
+    parser.add_argument(
+        '--jitter-m',
+        type=float,
+        default=DEFAULTS['jitter_m'],
+        help='Standard deviation of the shift of repeated routes in meters',
+    )
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'], help='Random seed')
+
+
+def generator_params(args):
+    return {name: getattr(args, name) for name in DEFAULTS}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic GPS tracks')
+    parser.add_argument('--output-dir', required=True, help='Directory to write CSV files to')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    files = write_tracks(args.output_dir, generator_params(args))
+    print('Wrote %d tracks to %s' % (len(files), args.output_dir))
@@ -0,0 +1,184 @@
+## run.py
+#
+# runs tracksim.main() on synthetic (or given) tracks with metrics enabled
+# and saves the metrics of every run (see metrics.py) as JSON, so runs on
+# different code or machines can be compared
+#
+# arguments the runner does not know are passed on to tracksim.py, e.g.
+#
+#   python3 -m benchmarks.run --output bench.json --loops 50 --runs 5 \
+#       --add-directional-similarity --workers 4
+#
+# the raster cache is never used, so every run does all of the work
+
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# the repository root, so that the runner also works as a script
+# (python3 benchmarks/run.py) and not only as python3 -m benchmarks.run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.generate import add_generator_arguments
+from benchmarks.generate import generator_params
+from benchmarks.generate import write_tracks
+import metrics
+import tracksim
+
+# tracksim options that are not run by tracksim.main()
+UNSUPPORTED_OPTIONS = [
+    'previous_state',
+    'convert_to_store',
+    'raster_store',
+]
+
+
+def run_main(options):
+    """
+    runs tracksim.main() with metrics enabled; returns the metrics of the
+    run (see metrics.to_dict())
+    """
+    metrics.enable(trace_memory=options['metrics_trace_memory'])
+    tracksim.main(options)
+    return metrics.to_dict()
+
+
+def stage_timings(run_metrics):
+    """
+    dict of stage -> wall seconds of a run, plus the "total"
+    """
+    timings = {
+        record['stage']: record['wall_s']
+        for record in run_metrics['stages']
+    }
+    timings['total'] = run_metrics['run']['wall_s']
+    return timings
+
+
+def data_sizes(run_metrics):
+    counters = run_metrics['counters']
+    group_sizes = run_metrics['distributions'].get('group_size', {})
+    return {
+        'tracks': group_sizes.get('sum', 0),
+        'points': counters.get('points_rasterized', 0),
+        'groups': group_sizes.get('count', 0),
+        'pairs': counters.get('pairs', 0),
+        'raster_cells': counters.get('cells_created', 0),
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def summarize(runs):
+    """
+    minimum and median wall seconds of each stage over all runs
+    """
+    timings = [stage_timings(run) for run in runs]
+    stages = list(timings[0])
+    return {
+        stat: {
+            stage: float(func([t[stage] for t in timings if stage in t]))
+            for stage in stages
+        }
+        for stat, func in [('min', np.min), ('median', np.median)]
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Time the stages of tracksim.py on synthetic tracks. '
+        'Unknown arguments are passed on to tracksim.py.',
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        '--output',
+        default='benchmark.json',
+        help='JSON file to save the results to',
+    )
+    parser.add_argument(
+        '--data-dir',
+        default=None,
+        help='Use the CSV files in this directory instead of generating tracks',
+    )
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=3,
+        help='Number of times every stage is run',
+    )
+    add_generator_arguments(parser)
+    args, tracksim_args = parser.parse_known_args()
+    if args.runs < 1:
+        parser.error('--runs must be at least 1')
+    return args, tracksim_args
+
+
+def main(args, tracksim_args):
+    work_dir = tempfile.mkdtemp(prefix='tracksim_benchmark_')
+    try:
+        if args.data_dir:
+            files = sorted(glob.glob(os.path.join(args.data_dir, '*.csv')))
+            params = None
+        else:
+            params = generator_params(args)
+            files = write_tracks(os.path.join(work_dir, 'tracks'), params)
+
+        runs = []
+        for i in range(args.runs):
+            options = tracksim.get_options(
+                files + tracksim_args + [
+                    '--no-cache',
+                    '--output-filename',
+                    os.path.join(work_dir, 'similarities.csv'),
+                ]
+            )
+            unsupported = [
+                name for name in UNSUPPORTED_OPTIONS
+                if options[name] is not None and options[name] is not False
+            ]
+            if unsupported:
+                raise ValueError(
+                    'benchmarks do not support %s' % ', '.join(unsupported)
+                )
+            runs.append(run_main(options))
+            print('Run %d: %.3fs' % (i + 1, runs[-1]['run']['wall_s']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'generator': params,
+        'data_dir': args.data_dir,
+        'tracksim_args': tracksim_args,
+        'sizes': data_sizes(runs[0]),
+        'summary': summarize(runs),
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to %s' % args.output)
+    return results
+
+
+if __name__ == '__main__':
+    main(*get_args())
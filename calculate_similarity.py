@@ -3,17 +3,41 @@ import constants as c
 import numpy as np
 import pandas as pd
 from utility import Clogger
-from utility import diamond_generator
+import metrics
+import raster_engine
+from raster_config import get_config
+import parallel_similarity
 
 from group_clusters import GroupProcessor
 
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
 PI = np.pi
 
-WEIGHTS_FUNC=lambda x, y: x * y
+WEIGHTS_FUNC=c.WEIGHTS_FUNCTIONS['product']
+# name of the weights function; 'product' and 'smooth' can be computed with
+# sparse matrix products, anything else uses the pairwise calculation
+WEIGHTS_METHOD='product'
+
+# number of tracks whose similarities are computed per sparse matrix product
+SPARSE_BLOCK_SIZE=1024
+
+# number of raster cells whose directional similarities to the rest of
+# their group are computed at once; small blocks keep the matched history
+# entries in the CPU cache
+DIRECTIONAL_BLOCK_SIZE=2048
 
-def set_weights_func(func):
+def set_weights_func(func, method='custom'):
     global WEIGHTS_FUNC
+    global WEIGHTS_METHOD
     WEIGHTS_FUNC = func
+    WEIGHTS_METHOD = method
+
+def get_weights_method():
+    return WEIGHTS_METHOD
 
 
 logger = Clogger('calculate_similarity.log')
@@ -38,9 +62,62 @@ def has_intersection(
     )
 
 
-def calculate_similarities(data, grouper, options={}):
+def use_sparse_similarities(options={}):
+    if options.get('similarity_engine', 'sparse') != 'sparse':
+        return False
+    if sparse is None:
+        logger.warn('scipy is not installed; using pairwise similarities')
+        return False
+    if options.get('weight_center_only', False):
+        logger.debug('weight_center_only is not supported by sparse similarities')
+        return False
+    if WEIGHTS_METHOD not in ['product', 'smooth']:
+        logger.debug(
+            'Weights method %s is not supported by sparse similarities' % WEIGHTS_METHOD
+        )
+        return False
+    return True
+
+
+def use_parallel_similarities(options={}):
+    """
+    whether the pairwise calculation (used when sparse similarities
+    cannot be) is spread over --workers processes
+    """
+    if options.get('workers', 1) <= 1:
+        return False
+    if WEIGHTS_METHOD not in c.WEIGHTS_FUNCTIONS:
+        logger.warn(
+            'Weights method %s cannot be sent to workers; '
+            'calculating similarities in one process' % WEIGHTS_METHOD
+        )
+        return False
+    return True
+
+
+def calculate_similarities(data, grouper, options={}, similarities=None):
+    """
+    similarities of all pairs of members within each group, keyed by
+    (filename1, filename2)
+
+    "similarities" can be any object supporting item assignment (e.g. a
+    writer that streams rows to disk); a new dict is used by default
+    """
+    if similarities is None:
+        similarities = {}
+
+    if use_sparse_similarities(options):
+        return calculate_similarities_sparse(data, grouper, options, similarities)
+
+    if use_parallel_similarities(options):
+        return parallel_similarity.calculate_similarities_parallel(
+            grouper,
+            WEIGHTS_METHOD,
+            options,
+            similarities=similarities,
+        )
+
     logger.info('Calculating similarities...')
-    similarities = {}
     counter = 0
     zero_counter = 0
     for member1, member2 in grouper.pairwise_group_iter():
@@ -66,6 +143,231 @@ def calculate_similarities(data, grouper, options={}):
                 )
             )            
 
+    metrics.count('pairs', counter)
+    metrics.count('pairs_skipped_by_bbox', zero_counter)
+    return similarities
+
+
+def raster_dict_to_raster(raster_dict):
+    """
+    compact raster (see raster_engine.compact_raster()) of a raster dict
+    built by the python rasterizer
+    """
+    n_cells = len(raster_dict)
+    cells = np.fromiter(raster_dict, dtype=np.int64, count=n_cells)
+    order = np.argsort(cells)
+    stats = {
+        stat: np.fromiter(
+            (d[stat] for d in raster_dict.values()),
+            dtype=np.float64,
+            count=n_cells,
+        )[order]
+        for stat in ['sum_weight', 'sum_unit_weight']
+    }
+    return raster_engine.compact_raster(
+        cells[order],
+        stats['sum_weight'],
+        stats['sum_unit_weight'],
+    )
+
+
+def member_bboxes(members):
+    """
+    array of the (lat min, lat max, long min, long max) of each member
+    """
+    return np.array([
+        [m['bbox']['lat'][0], m['bbox']['lat'][1], m['bbox']['long'][0], m['bbox']['long'][1]]
+        for m in members
+    ]).reshape(-1, 4)
+
+
+def bbox_intersection_matrix(members, rows=slice(None), bboxes=None):
+    """
+    boolean matrix of has_intersection() of the members in rows (all by
+    default) and all members of a group; bboxes from member_bboxes() can
+    be given when this is called for many blocks of rows
+    """
+    if bboxes is None:
+        bboxes = member_bboxes(members)
+    lat_min, lat_max, long_min, long_max = bboxes.T
+    return ~(
+        (lat_max[rows, None] < lat_min[None, :]) |
+        (lat_min[rows, None] > lat_max[None, :]) |
+        (long_max[rows, None] < long_min[None, :]) |
+        (long_min[rows, None] > long_max[None, :])
+    )
+
+
+def group_weight_matrix(members):
+    """
+    sparse cells x members matrix of sum_weight
+    """
+    cell_list = []
+    weight_list = []
+    for member in members:
+        raster = member['raster']
+        cell_list.append(raster['cells'])
+        weight_list.append(raster['sum_weight'])
+
+    counts = [len(cells) for cells in cell_list]
+    _, rows = np.unique(np.concatenate(cell_list), return_inverse=True)
+    cols = np.repeat(np.arange(len(members)), counts)
+    weights = np.concatenate(weight_list).astype(np.float64)
+    n_cells = rows.max() + 1 if len(rows) else 0
+
+    return sparse.csc_matrix(
+        (weights, (rows.ravel(), cols)),
+        shape=(n_cells, len(members)),
+    )
+
+
+def group_sparse_matrices(members, smooth=False):
+    """
+    the cells x members weight matrix W of a group and, for the smooth
+    weights function, W^2 and the indicator B of W
+    """
+    W = group_weight_matrix(members)
+    if not smooth:
+        return W, None, None
+    W_squared = W.multiply(W).tocsc()
+    # explicit ones so that zero weights still count as shared cells
+    B = sparse.csc_matrix(
+        (np.ones_like(W.data), W.indices, W.indptr),
+        shape=W.shape,
+    )
+    return W, W_squared, B
+
+
+def block_products(matrices, rows, cols=None):
+    """
+    dense len(rows) x len(cols) array of sum(WEIGHTS_FUNC(x, y)) over the
+    shared cells of members in rows and cols (all members if cols is None)
+    of the matrices of group_sparse_matrices()
+    """
+    W, W_squared, B = matrices
+    select = lambda M: M if cols is None else M[:, cols]
+    products = (W[:, rows].T @ select(W)).toarray()
+    if W_squared is not None:
+        products = (
+            2 * products +
+            (W_squared[:, rows].T @ select(B)).toarray() +
+            (B[:, rows].T @ select(W_squared)).toarray()
+        ) / 4
+    return products
+
+
+def blocked_pair_values(i_idx, j_idx, block_func, block_size=SPARSE_BLOCK_SIZE):
+    """
+    values of the pairs (i_idx[k], j_idx[k]) taken from dense blocks
+    block_func(rows, cols), one block per block_size rows, restricted to
+    the columns that rows are paired with
+    """
+    i_idx = np.asarray(i_idx, dtype=np.int64)
+    j_idx = np.asarray(j_idx, dtype=np.int64)
+    values = np.zeros(len(i_idx))
+    order = np.argsort(i_idx, kind='stable')
+    sorted_rows = i_idx[order]
+    unique_rows = np.unique(sorted_rows)
+    for start in range(0, len(unique_rows), block_size):
+        rows = unique_rows[start:start+block_size]
+        pairs = order[
+            np.searchsorted(sorted_rows, rows[0], side='left'):
+            np.searchsorted(sorted_rows, rows[-1], side='right')
+        ]
+        cols, col_pos = np.unique(j_idx[pairs], return_inverse=True)
+        block = block_func(rows, cols)
+        values[pairs] = block[np.searchsorted(rows, i_idx[pairs]), col_pos.ravel()]
+    return values
+
+
+def group_similarity_matrices(members, options={}):
+    """
+    matrices used by pair_similarities() for the members of a group, or
+    None if sparse similarities cannot be used
+    """
+    if not use_sparse_similarities(options):
+        return None
+    return group_sparse_matrices(members, smooth=WEIGHTS_METHOD == 'smooth')
+
+
+def pair_similarities(members, i_idx, j_idx, matrices=None, options={}):
+    """
+    array of the similarities of the pairs (i_idx[k], j_idx[k]) of the
+    members of a group; with matrices from group_similarity_matrices(),
+    pairs are calculated with blocks of sparse matrix products (see
+    calculate_similarities_sparse()), otherwise one at a time
+    """
+    i_idx = np.asarray(i_idx, dtype=np.int64)
+    j_idx = np.asarray(j_idx, dtype=np.int64)
+    if matrices is None:
+        similarities = np.zeros(len(i_idx))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for k, (i, j) in enumerate(zip(i_idx.tolist(), j_idx.tolist())):
+                similarities[k] = calculate_similarity(members[i], members[j], options)
+        return similarities
+
+    norms = np.array([m['raster_norm'] for m in members], dtype=np.float64)
+    products = blocked_pair_values(
+        i_idx,
+        j_idx,
+        lambda rows, cols: block_products(matrices, rows, cols),
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return products / np.sqrt(norms[i_idx] * norms[j_idx])
+
+
+def calculate_similarities_sparse(data, grouper, options={}, similarities=None):
+    """
+    same output as the pairwise calculation, but each group's similarities
+    come from sparse matrix products of its cells x members weight matrix
+
+    * product: sum(x*y) = W'W
+    * smooth:  sum(((x+y)/2)^2) over shared cells
+               = ((W^2)'B + 2W'W + B'(W^2)) / 4, B = indicator of W
+    """
+    logger.info('Calculating similarities (sparse)...')
+    if similarities is None:
+        similarities = {}
+    counter = 0
+    zero_counter = 0
+    smooth = WEIGHTS_METHOD == 'smooth'
+    for i, group in enumerate(grouper.groups):
+        members = group.members
+        n_members = len(members)
+        matrices = group_sparse_matrices(members, smooth)
+        norms = np.array([m['raster_norm'] for m in members], dtype=np.float64)
+        bboxes = member_bboxes(members)
+        filenames = [m['filename'] for m in members]
+
+        for start in range(0, n_members, SPARSE_BLOCK_SIZE):
+            end = min(start + SPARSE_BLOCK_SIZE, n_members)
+            products = block_products(matrices, slice(start, end))
+            intersects = bbox_intersection_matrix(members, slice(start, end), bboxes)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block_similarities = products / np.sqrt(
+                    norms[start:end, None] * norms[None, :]
+                )
+            block_similarities[~intersects] = 0
+
+            for row, j in enumerate(range(start, end)):
+                row_similarities = block_similarities[row, j:].tolist()
+                for k, similarity in zip(range(j, n_members), row_similarities):
+                    similarities[(filenames[j], filenames[k])] = similarity
+                zero_counter += int(np.sum(~intersects[row, j:]))
+                counter += n_members - j
+
+        logger.debug(
+            'Calculated %d similarities (%d default zero-valued) after group %d/%d' % (
+                counter,
+                zero_counter,
+                i+1,
+                len(grouper.groups),
+            )
+        )
+
+    metrics.count('pairs', counter)
+    metrics.count('pairs_skipped_by_bbox', zero_counter)
     return similarities
 
 
@@ -101,22 +403,36 @@ def group_tracks(metadata):
     group_processor = GroupProcessor()
 
     logger.info('Adding values to group processor')
-    for v in metadata.values():
-        group_processor.add_member(v)
-
-    logger.info('Performing final merges')
-    n_merges = group_processor.merge_groups()
-    logger.debug('%d mergest performed in final merges' % n_merges)
+    group_processor.build_groups(list(metadata.values()))
+    logger.debug('%d groups built' % len(group_processor.groups))
 
     return group_processor
         
 
 
-def rasterize(data, grouper):
+def rasterize(data, grouper, options={}, cache=None):
     """
-    assigns "raster_dict" dict of dictionaries 
-    to each member of each group of grouper object
+    assigns a compact "raster" (see raster_engine.compact_raster())
+    to each member of each group of grouper object; members only keep
+    their binned points ("rasterization") if rasterized output is written
+
+    if a RasterCache is given, cached rasters are used where possible
+    (their tracks do not need to be in data) and new ones are saved
     """
+    keep_rasterization = bool(options.get('rasterized_output_prefix'))
+    config = get_config(options)
+    if options.get('raster_engine', 'numpy') == 'numpy':
+        return rasterize_vectorized(
+            data,
+            grouper,
+            config,
+            workers=options.get('workers', 1),
+            cache=cache,
+            keep_rasterization=keep_rasterization,
+        )
+    elif options.get('workers', 1) > 1:
+        logger.warn('The python raster engine does not use --workers')
+
     # 1. determine longitude raster size
     # (grouper.attributes['long_raster_size'])
 
@@ -133,84 +449,226 @@ def rasterize(data, grouper):
 
     logger.info('Rasterizing')
 
-    calc_lat_bin = lambda x: x // c.RASTER_SIZE_LAT
+    # cells are packed int64 keys (see raster_engine.pack_cells()), and
+    # neighbours are found by adding packed stencil offsets
+    stencil_offsets, stencil_distances = raster_engine.make_stencil(config.manhattan_distance_max)
+    weights = config.weights
+    stencil = [
+        (offset, weights[md])
+        for offset, md in zip(stencil_offsets.tolist(), stencil_distances.tolist())
+    ]
 
     n_processed = 0
     
     for i, group in enumerate(grouper.groups):
         logger.debug('Rasterizing group %d/%d' % ((i+1),len(grouper.groups)))
-        calc_long_bin = lambda x: x // group.attributes['long_raster_size']
         for j, member in enumerate(group.members):
             fn = member['filename']
-            # normal rasterization
-            member['rasterization'] = pd.DataFrame(
-                {
-                    'lat_bin': calc_lat_bin(data[fn]['position_lat']),
-                    'long_bin': calc_long_bin(data[fn]['position_long']),
-                    'weight': 1.0,
-                    'pk': np.arange(data[fn].shape[0]), # for intra-data ID when using manhattan r.
-                }
+            if cache is not None and load_cached_raster(member, group, cache):
+                if fn in data and keep_rasterization:
+                    member['rasterization'] = make_rasterization_df(data[fn], group, config)
+                metrics.count('rasters_from_cache')
+                n_processed += 1
+                continue
+            # normal rasterization; points without finite coordinates
+            # are skipped, and cells between points are added if
+            # segments are rasterized
+            lat_bin, long_bin, pks = raster_engine.track_bins(
+                data[fn]['position_lat'].values,
+                data[fn]['position_long'].values,
+                group.attributes['long_raster_size'],
+                config,
             )
+            cells = raster_engine.pack_cells(lat_bin, long_bin)
 
             # this template will be used to determine angles
             # note that only the highest weight will be used 
             raster_dict = defaultdict(lambda: defaultdict(float))
             # manhattan rasterization
-            for pk, lat_bin, long_bin in zip(
-                    member['rasterization']['pk'],
-                    member['rasterization']['lat_bin'],
-                    member['rasterization']['long_bin']
-            ):
+            for pk, cell in zip(pks.tolist(), cells.tolist()):
                 # main rasterization
                 # if update not detected
-                for md in range(c.RASTER_MANHATTAN_DISTANCE_MAX+1):
-                    weight = c.RASTER_FUNCTION(c.RASTER_DECAY_FACTOR, md)
-                    for lat_bin_offset, long_bin_offset in diamond_generator(md):
-                        rkey = (lat_bin+lat_bin_offset, long_bin+long_bin_offset)
-                        if (
-                                # if no recent weights encountered
-                                raster_dict[rkey].get('last_update', -c.RASTER_COOLDOWN_INTERVAL-1) <
-                                pk-c.RASTER_COOLDOWN_INTERVAL
-                        ):
-                            raster_dict[rkey]['last_update'] = pk
-                            raster_dict[rkey]['sum_weight'] += weight
-                            raster_dict[rkey]['last_weight'] = weight
-                            if weight==1:
-                                raster_dict[rkey]['sum_unit_weight'] += 1
-                                raster_dict[rkey]['last_weight_unit'] = True
-                            else:
-                                raster_dict[rkey]['last_weight_unit'] = False
-                        elif (
-                                # in case higher weight is encountered within time frame
-                                raster_dict[rkey]['last_weight'] < weight
-                        ):
-                            prev_weight = raster_dict[rkey]['last_weight']
-                            raster_dict[rkey]['last_update'] = pk
-                            raster_dict[rkey]['last_weight'] = weight
-                            raster_dict[rkey]['weight'] += weight - prev_weight
-                            if weight==1:
-                                raster_dict[rkey]['sum_unit_weight'] += 1
-                                raster_dict[rkey]['last_weight_unit'] = True
-                            else:
-                                raster_dict[rkey]['last_weight_unit'] = False                            
+                for offset, weight in stencil:
+                    rkey = cell + offset
+                    if (
+                            # if no recent weights encountered
+                            raster_dict[rkey].get('last_update', -config.cooldown_interval-1) <
+                            pk-config.cooldown_interval
+                    ):
+                        raster_dict[rkey]['last_update'] = pk
+                        raster_dict[rkey]['sum_weight'] += weight
+                        raster_dict[rkey]['last_weight'] = weight
+                        if weight==1:
+                            raster_dict[rkey]['sum_unit_weight'] += 1
+                            raster_dict[rkey]['last_weight_unit'] = True
+                        else:
+                            raster_dict[rkey]['last_weight_unit'] = False
+                    elif (
+                            # in case higher weight is encountered within time frame
+                            raster_dict[rkey]['last_weight'] < weight
+                    ):
+                        prev_weight = raster_dict[rkey]['last_weight']
+                        raster_dict[rkey]['last_update'] = pk
+                        raster_dict[rkey]['last_weight'] = weight
+                        raster_dict[rkey]['weight'] += weight - prev_weight
+                        if weight==1:
+                            raster_dict[rkey]['sum_unit_weight'] += 1
+                            raster_dict[rkey]['last_weight_unit'] = True
+                        else:
+                            raster_dict[rkey]['last_weight_unit'] = False                            
 
                             
 
-            # final processing to wrap up loose ends
-            member['raster_dict'] = raster_dict
-            member['rkeys'] = set(raster_dict.keys())
+            # final processing to wrap up loose ends; temporary fields
+            # (last_update etc.) are dropped with the dict
+            member['raster'] = raster_dict_to_raster(raster_dict)
+            metrics.count('points_rasterized', data[fn].shape[0])
+            metrics.count('cells_created', len(member['raster']['cells']))
+            if keep_rasterization:
+                member['rasterization'] = make_rasterization_df(data[fn], group, config)
+            if cache is not None:
+                cache.save_raster(
+                    fn,
+                    group.attributes['long_raster_size'],
+                    member['raster'],
+                )
             n_processed += 1            
             if (n_processed % 25) == 0:
                 logger.debug('Rasterized %d tracks' % n_processed)
 
     logger.debug('Processed %d total' % n_processed)
 
-    
-        
-                        
 
+def make_rasterization_df(record, group, config, directional=False):
+    """
+    binned points of a track ("rasterization" of a member)
+    """
+    df = pd.DataFrame(
+        {
+            'lat_bin': record['position_lat'] // config.size_lat,
+            'long_bin': record['position_long'] // group.attributes['long_raster_size'],
+            'weight': 1.0,
+            'pk': np.arange(record.shape[0]), # for intra-data ID when using manhattan r.
+        }
+    )
+    if directional:
+        df['angle'] = record['angle']
+    return df
+
+
+def load_cached_raster(member, group, cache, directional=False):
+    """
+    assigns a member's raster from the cache; returns False on a miss
+    """
+    raster = cache.load_raster(
+        member['filename'],
+        group.attributes['long_raster_size'],
+        directional=directional,
+    )
+    if raster is None:
+        return False
 
-def rasterize_directional(data, grouper):
+    if directional:
+        member['directional_raster'] = raster
+    else:
+        member['raster'] = raster
+    return True
+
+
+def rasterize_tracks(
+        data,
+        grouper,
+        config,
+        workers=1,
+        cache=None,
+        directional=False,
+        keep_rasterization=False,
+):
+    """
+    rasterizes every member of every group with raster_engine, using
+    cached rasters where possible; returns the members and their compact
+    rasters that were not found in the cache
+    """
+    stencil = raster_engine.make_stencil(config.manhattan_distance_max)
+    members = []
+    args_list = []
+    n_cached = 0
+    for group in grouper.groups:
+        long_raster_size = group.attributes['long_raster_size']
+        for member in group.members:
+            fn = member['filename']
+            if fn in data and keep_rasterization:
+                member['rasterization'] = make_rasterization_df(
+                    data[fn],
+                    group,
+                    config,
+                    directional=directional,
+                )
+            if cache is not None and load_cached_raster(
+                    member,
+                    group,
+                    cache,
+                    directional=directional,
+            ):
+                n_cached += 1
+                continue
+
+            members.append((member, long_raster_size))
+            # workers only get the arrays they need
+            args = [
+                data[fn]['position_lat'].values,
+                data[fn]['position_long'].values,
+            ]
+            if directional:
+                args.append(data[fn]['angle'].values)
+            args_list.append(tuple(args) + (long_raster_size, config, stencil))
+
+    if directional:
+        func = raster_engine.rasterize_track_directional
+    else:
+        func = raster_engine.rasterize_track
+    rasters = raster_engine.map_tracks(func, args_list, workers=workers)
+
+    prefix = 'directional_' if directional else ''
+    metrics.count(prefix + 'rasters_from_cache', n_cached)
+    metrics.count(prefix + 'points_rasterized', sum(len(args[0]) for args in args_list))
+    metrics.count(prefix + 'cells_created', sum(len(raster['cells']) for raster in rasters))
+
+    if cache is not None:
+        for (member, long_raster_size), raster in zip(members, rasters):
+            cache.save_raster(
+                member['filename'],
+                long_raster_size,
+                raster,
+                directional=directional,
+            )
+
+    logger.debug('Processed %d total (%d from cache)' % (len(members) + n_cached, n_cached))
+    return [member for member, _ in members], rasters
+
+
+def rasterize_vectorized(data, grouper, config, workers=1, cache=None, keep_rasterization=False):
+    """
+    same output as rasterize(), but each track is expanded and scanned
+    with numpy arrays (see raster_engine.py), optionally across
+    several processes
+    """
+    logger.info('Rasterizing (numpy engine, %d workers)' % workers)
+
+    members, rasters = rasterize_tracks(
+        data,
+        grouper,
+        config,
+        workers=workers,
+        cache=cache,
+        keep_rasterization=keep_rasterization,
+    )
+
+    for member, raster in zip(members, rasters):
+        member['raster'] = raster
+
+
+def rasterize_directional(data, grouper, options={}, cache=None):
     # 1. determine longitude raster size (easy)
 
     # 2. bin latitude and longitude into bins
@@ -225,161 +683,56 @@ def rasterize_directional(data, grouper):
 
     # 4. convert raster dictionary to dataframe
 
-    logger.info('Directional rasterizing')
-
-    calc_lat_bin = lambda x: x // c.RASTER_SIZE_LAT
-
-    n_processed = 0
-    
-    for i, group in enumerate(grouper.groups):
-        logger.debug('Rasterizing group %d/%d' % ((i+1),len(grouper.groups)))
-        calc_long_bin = lambda x: x // group.attributes['long_raster_size']
-        for j, member in enumerate(group.members):
-            fn = member['filename']
-            # normal rasterization
-            member['rasterization'] = pd.DataFrame(
-                {
-                    'lat_bin': calc_lat_bin(data[fn]['position_lat']),
-                    'long_bin': calc_long_bin(data[fn]['position_long']),
-                    'weight': 1.0,
-                    'pk': np.arange(data[fn].shape[0]), # for intra-data ID when using manhattan r.
-                    'angle': data[fn]['angle'],
-                }
-            )
-
-
-            def default_template():
-                return {
-                    'last_update': -c.RASTER_COOLDOWN_INTERVAL-1,
-                    'last_angles': [],
-                    'last_weight': 0.0,
-                    'angle_history':[],
-                    'weight_history': [],
-                    'wrapped_up': True,
-                }
-            raster_dict = defaultdict(default_template)            
-            # manhattan rasterization
-            for pk, lat_bin, long_bin, angle in zip(
-                    member['rasterization']['pk'],
-                    member['rasterization']['lat_bin'],
-                    member['rasterization']['long_bin'],
-                    member['rasterization']['angle'],
-            ):
-                # main rasterization
-                # if update not detected
-                for md in range(c.RASTER_MANHATTAN_DISTANCE_MAX+1):
-                    weight = c.RASTER_FUNCTION(c.RASTER_DECAY_FACTOR, md)
-                    for lat_bin_offset, long_bin_offset in diamond_generator(md):
-                        rkey = (lat_bin+lat_bin_offset, long_bin+long_bin_offset)
-                        # if the last track has been wrapped up (will only be default here
-                        # if it hasn't been initialized yet                        
-                        if (
-                                raster_dict[rkey]['wrapped_up']
-                        ):
-                            raster_dict[rkey]['last_update'] = pk
-                            raster_dict[rkey]['wrapped_up'] = False
-                            raster_dict[rkey]['last_angles'].append(angle)
-                            raster_dict[rkey]['last_weight'] = weight
-                        elif (
-                                # if higher weight is encountered
-                                weight > raster_dict[rkey]['last_weight'] and
-                                pk < raster_dict[rkey]['last_update'] + c.RASTER_COOLDOWN_INTERVAL
-                        ):
-                            # reset last streak and update
-                            raster_dict[rkey]['last_update'] = pk
-                            raster_dict[rkey]['last_angles'] = [angle]
-                            raster_dict[rkey]['last_weight'] = weight
-                            
-                        elif weight < raster_dict[rkey]['last_weight']:
-                            pass
-                        elif (
-                                weight == raster_dict[rkey]['last_weight']
-                                and
-                                (
-                                    raster_dict[rkey]['last_update'] + c.RASTER_COOLDOWN_INTERVAL >
-                                    pk
-                                )
-                        ):
-                            # add another entry
-                            raster_dict[rkey]['last_angles'].append(angle)
-                        else:
-                            # wrap up previous streak
-                            avg_angle = np.arctan2(
-                                np.mean(np.sin(raster_dict[rkey]['last_angles'])),
-                                np.mean(np.cos(raster_dict[rkey]['last_angles'])),
-                            )
-                            raster_dict[rkey]['angle_history'].append(avg_angle)
-                            raster_dict[rkey]['weight_history'].append(
-                                raster_dict[rkey]['last_weight']
-                            )
-                            # start new
-                            raster_dict[rkey]['last_angles'] = [angle]
-                            raster_dict[rkey]['last_weight'] = weight
-                            
-
-            # wrap everything up
-            #logger.warn(list(raster_dict.keys())[:10])
-            for rkey in list(raster_dict.keys()):
-                # should always be true
-                if not raster_dict[rkey]['wrapped_up']:
-                    avg_angle = np.arctan2(
-                        np.mean(np.sin(raster_dict[rkey]['last_angles'])),
-                        np.mean(np.cos(raster_dict[rkey]['last_angles'])),
-                    )
-                    
-                    raster_dict[rkey]['weight_history'].append(raster_dict[rkey]['last_weight'])
-                    raster_dict[rkey]['angle_history'].append(avg_angle)
-                    # save small bit of RAM
-                    raster_dict[rkey]['last_angles'] = []
-                    raster_dict[rkey]['wrapped_up'] = True
-                else:
-                    logger.error('pre-wrapped rkey')
-                    logger.error(rkey)
-                    logger.error(raster_dict[rkey])
-                    
-            member['directional_raster_dict'] = raster_dict
-            # this would be redundant
-            #member['directioanl_rkeys'] = set(raster_dict.keys())
-            n_processed += 1            
-            if (n_processed % 25) == 0:
-                logger.debug('Rasterized %d tracks' % n_processed)
+    workers = options.get('workers', 1)
+    logger.info('Directional rasterizing (%d workers)' % workers)
+
+    members, rasters = rasterize_tracks(
+        data,
+        grouper,
+        get_config(options),
+        workers=workers,
+        cache=cache,
+        directional=True,
+        keep_rasterization=bool(options.get('rasterized_output_prefix')),
+    )
 
-    logger.debug('Processed %d total' % n_processed)
+    for member, raster in zip(members, rasters):
+        member['directional_raster'] = raster
+        # this would be redundant
+        #member['directioanl_rkeys'] = set(raster_dict.keys())
 
         
 def calculate_norms(data, options={}):
     center_wt = options.get('weight_center_only', False)
     for fn, member in data.items():
-        sum_weights_squared = 0
-        sum_unit_weights = 0            
-        for rkey, data in member['raster_dict'].items():
-            sum_weights_squared += data['sum_weight'] ** 2
-            if center_wt:
-                sum_unit_weights += data['sum_unit_weight']
-        member['raster_norm'] = sum_weights_squared
-        member['raster_unit_norm'] = sum_unit_weights
+        raster = member['raster']
+        member['raster_norm'] = np.sum(raster['sum_weight'].astype(np.float64) ** 2)
+        if center_wt:
+            member['raster_unit_norm'] = np.sum(raster['sum_unit_weight'], dtype=np.float64)
+        else:
+            member['raster_unit_norm'] = 0
 
 def calculate_directional_norms(data, options={}):
     center_wt = options.get('weight_center_only', False)
     for fn, member in data.items():
-        sum_weights_squared = 0
-        sum_unit_weights = 0
-        for rkey, data in member['directional_raster_dict'].items():
-            for weight in data['weight_history']:
-                sum_weights_squared += weight ** 2
-                if center_wt:
-                    if weight == 1:
-                        sum_unit_weights += 1
-                        
-        member['raster_directional_norm'] = sum_weights_squared
-        member['raster_directional_unit_norm'] = sum_unit_weights
+        weight_history = member['directional_raster']['weight_history']
+        member['raster_directional_norm'] = np.sum(weight_history ** 2)
+        if center_wt:
+            member['raster_directional_unit_norm'] = np.sum(weight_history == 1)
+        else:
+            member['raster_directional_unit_norm'] = 0
 
 
 def calculate_similarity(r1, r2, options={}):
-    # find similar rkeys
-
-    keys1 = r1['rkeys']
-    keys2 = r2['rkeys']
+    # shared cells of the two (sorted) rasters
+    raster1 = r1['raster']
+    raster2 = r2['raster']
+    _, idx1, idx2 = np.intersect1d(
+        raster1['cells'],
+        raster2['cells'],
+        assume_unique=True,
+        return_indices=True,
+    )
 
     center_wt = options.get('weight_center_only', False)
     if center_wt:
@@ -391,67 +744,51 @@ def calculate_similarity(r1, r2, options={}):
         r1_stat = 'sum_weight'
         norm_stat='raster_norm'
 
-    sum_weight_product = 0
-    for key in keys1.intersection(keys2):
-        if center_wt:
-            sum_weight_product += (
-                WEIGHTS_FUNC(
-                    r1['raster_dict'][key][r1_stat],
-                    min(
-                        r2['raster_dict'][key]['sum_weight'],
-                        r1['raster_dict'][key][r1_stat] * norm_ratio,
-                    ),
-                )
-            )
-        else:
-            sum_weight_product += (
-                WEIGHTS_FUNC(
-                    r1['raster_dict'][key][r1_stat],
-                    r2['raster_dict'][key]['sum_weight'],
-                )
-            )            
-
+    w1 = raster1[r1_stat][idx1].astype(np.float64)
+    w2 = raster2['sum_weight'][idx2].astype(np.float64)
     if center_wt:
-        # problem: self-similarity can increase score quite a bit
-        similarity = sum_weight_product / np.sqrt(r1[norm_stat]*r2[norm_stat])
-    else:
-        similarity = sum_weight_product / np.sqrt(r1[norm_stat]*r2[norm_stat])
+        w2 = np.minimum(w2, w1 * norm_ratio)
+    sum_weight_product = np.sum(WEIGHTS_FUNC(w1, w2))
+
+    # problem (center_wt): self-similarity can increase score quite a bit
+    similarity = sum_weight_product / np.sqrt(r1[norm_stat]*r2[norm_stat])
     return similarity
 
-    
-def calculate_directional_similarity(r1, r2, options={}):
 
-    # find similar rkeys
+def directional_products(weights1, angles1, weights2, angles2, center_wt=False):
+    """
+    cos(a1 - a2) * W(w1, w2) of matched history entries, and a mask of
+    the ones that count (all of them, or those with w1 == 1 if only
+    center weights are used)
+    """
+    products = np.cos(angles1 - angles2) * WEIGHTS_FUNC(weights1, weights2)
+    if center_wt:
+        # skip non-unit weights for first weight
+        return products, weights1 == 1
+    return products, np.ones(products.shape[0], dtype=bool)
+
+
+def calculate_directional_similarity(r1, r2, options={}):
+    raster1 = r1['directional_raster']
+    raster2 = r2['directional_raster']
+    # history entries of shared cells; truncated data will not have any
+    # further contributions
+    pos1, pos2 = raster_engine.match_histories(raster1, raster2)
 
-    keys1 = r1['rkeys']
-    keys2 = r2['rkeys']
-    
     center_wt = options.get('weight_center_only', False)
     if center_wt:
         norm_stat = 'raster_directional_unit_norm'
     else:
         norm_stat='raster_directional_norm'    
 
-    sum_weight_product = 0
-    for key in keys1.intersection(keys2):
-        weights1 = r1['directional_raster_dict'][key]['weight_history']
-        weights2 = r2['directional_raster_dict'][key]['weight_history']
-        angles1 = r1['directional_raster_dict'][key]['angle_history']
-        angles2 = r2['directional_raster_dict'][key]['angle_history']
-
-        # truncated data will not have any further contributions
-        for w1, w2, a1, a2 in zip(weights1, weights2, angles1, angles2):
-            # skip non-unit weights for first weight
-            if center_wt and w1 != 1:
-                continue
-            cosine_sim = np.cos(a1-a2)
-            sum_weight_product += cosine_sim * WEIGHTS_FUNC(w1, w2)
-        
-        #
-        #sum_weight_product += (
-        #    r1['raster_dict'][key]['sum_weight'] *
-        #    r2['raster_dict'][key]['sum_weight']
-        #)
+    products, counted = directional_products(
+        raster1['weight_history'][pos1],
+        raster1['angle_history'][pos1],
+        raster2['weight_history'][pos2],
+        raster2['angle_history'][pos2],
+        center_wt,
+    )
+    sum_weight_product = np.sum(products[counted])
 
     similarity = sum_weight_product / np.sqrt(
         r1[norm_stat]*r2[norm_stat]
@@ -459,27 +796,116 @@ def calculate_directional_similarity(r1, r2, options={}):
     
     return similarity
 
+
+def group_directional_similarity_blocks(members, options={}):
+    """
+    directional similarities of the members of a group, one block of rows
+    at a time: yields (row_start, row_end, block, intersects), where
+    block[r, j] is the similarity of members row_start + r and j (only
+    j >= row_start + r is set) and intersects[r, j] tells if their bboxes
+    intersect (if not, the similarity is 0)
+
+    the cells of all members are sorted together once; each block of
+    rows looks up its cells in them, matches history entries like
+    raster_engine.match_histories() and sums the products of every pair
+    with one bincount. blocks have at most SPARSE_BLOCK_SIZE rows and
+    about DIRECTIONAL_BLOCK_SIZE cells, so memory does not grow with the
+    square of the group size
+    """
+    n_members = len(members)
+    rasters = [m['directional_raster'] for m in members]
+    center_wt = options.get('weight_center_only', False)
+    if center_wt:
+        norm_stat = 'raster_directional_unit_norm'
+    else:
+        norm_stat = 'raster_directional_norm'
+    norms = np.array([m[norm_stat] for m in members], dtype=np.float64)
+    bboxes = member_bboxes(members)
+
+    n_cells = np.array([len(r['cells']) for r in rasters], dtype=np.int64)
+    member_offsets = np.concatenate([[0], np.cumsum(n_cells)])
+    n_entries = [len(r['weight_history']) for r in rasters]
+    entry_starts = np.concatenate([[0], np.cumsum(n_entries)[:-1]]).astype(np.int64)
+    cells = np.concatenate([r['cells'] for r in rasters])
+    owner = np.repeat(np.arange(n_members), n_cells)
+    history_starts = np.concatenate([
+        r['offsets'][:-1] + start for r, start in zip(rasters, entry_starts)
+    ]).astype(np.int64)
+    history_lengths = np.concatenate([np.diff(r['offsets']) for r in rasters])
+    weight_history = np.concatenate([r['weight_history'] for r in rasters])
+    angle_history = np.concatenate([r['angle_history'] for r in rasters])
+
+    # stable, so members stay in order within each cell
+    order = np.argsort(cells, kind='stable')
+    sorted_cells = cells[order]
+
+    row_start = 0
+    while row_start < n_members:
+        # rows whose cells fit in a block (at least one row)
+        row_end = max(
+            row_start + 1,
+            np.searchsorted(
+                member_offsets,
+                member_offsets[row_start] + DIRECTIONAL_BLOCK_SIZE,
+                side='right',
+            ) - 1,
+        )
+        row_end = min(row_end, row_start + SPARSE_BLOCK_SIZE)
+        query = np.arange(member_offsets[row_start], member_offsets[row_end])
+        lo = np.searchsorted(sorted_cells, cells[query], side='left')
+        hi = np.searchsorted(sorted_cells, cells[query], side='right')
+        match = order[raster_engine.expand_ranges(lo, hi - lo)]
+        query = np.repeat(query, hi - lo)
+        upper = owner[match] >= owner[query]
+        query = query[upper]
+        match = match[upper]
+
+        n = np.minimum(history_lengths[query], history_lengths[match])
+        pos1 = raster_engine.expand_ranges(history_starts[query], n)
+        pos2 = raster_engine.expand_ranges(history_starts[match], n)
+        pair = np.repeat((owner[query] - row_start) * n_members + owner[match], n)
+        products, counted = directional_products(
+            weight_history[pos1],
+            angle_history[pos1],
+            weight_history[pos2],
+            angle_history[pos2],
+            center_wt,
+        )
+        sums = np.bincount(
+            pair[counted],
+            weights=products[counted],
+            minlength=(row_end - row_start) * n_members,
+        ).reshape(row_end - row_start, n_members)
+
+        block = sums / np.sqrt(norms[row_start:row_end, None] * norms[None, :])
+        intersects = bbox_intersection_matrix(members, slice(row_start, row_end), bboxes)
+        block[~intersects] = 0
+        yield row_start, row_end, block, intersects
+        row_start = row_end
+
+
 def calculate_directional_similarities(data, grouper, options={}):
+    # the blocked kernel is used with any --workers; see
+    # parallel_similarity.py
     logger.info('Calculating directional similarities...')
     similarities = {}
     counter = 0
     zero_counter = 0
-    for member1, member2 in grouper.pairwise_group_iter():
-        key = (member1['filename'], member2['filename'])
-        if not has_intersection(
-                member1,
-                member2
-        ):
-            similarities[key] = 0
-            zero_counter += 1
-        else:
-            similarities[key] = calculate_directional_similarity(
-                member1,
-                member2,
-                options,
-            )
-        counter+=1
-        if counter % 1000 == 0:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for group in grouper.groups:
+            members = group.members
+            if not members:
+                continue
+            n_members = len(members)
+            filenames = [m['filename'] for m in members]
+            blocks = group_directional_similarity_blocks(members, options)
+            for row_start, row_end, block, intersects in blocks:
+                for row, i in enumerate(range(row_start, row_end)):
+                    row_similarities = block[row, i:].tolist()
+                    for j, similarity in zip(range(i, n_members), row_similarities):
+                        similarities[(filenames[i], filenames[j])] = similarity
+                    zero_counter += int(np.sum(~intersects[row, i:]))
+            counter += n_members * (n_members + 1) // 2
             logger.debug(
                 'Calculated %d directional similarities (%d default zero-valued)' % (
                     counter,
@@ -487,4 +913,6 @@ def calculate_directional_similarities(data, grouper, options={}):
                 )
             )
 
+    metrics.count('directional_pairs', counter)
+    metrics.count('directional_pairs_skipped_by_bbox', zero_counter)
     return similarities
@@ -25,6 +25,13 @@ RASTER_MANHATTAN_DISTANCE_MAX=4
 
 RASTER_METHOD='custom'
 
+# also rasterize the cells crossed by the straight segment between
+# consecutive points, so that tracks with sparse points have no gaps
+RASTER_SEGMENTS=False
+# segments crossing more cells than this are treated as gaps (e.g., a
+# jump to a glitched point), and their cells are not rasterized
+RASTER_SEGMENT_MAX_CELLS=100
+
 CUSTOM_RASTER_PROFILE = [1, 0.95, 0.9, 0.85, 0.1]
 
 # this changes decay profile of rasters
@@ -42,6 +49,13 @@ RASTER_FUNCTIONS = {
 }
 
 RASTER_FUNCTION = RASTER_FUNCTIONS[RASTER_METHOD]
+
+# how weights of the same cell in two tracks are combined when
+# calculating similarities; these also work on numpy arrays
+WEIGHTS_FUNCTIONS = {
+    'product': lambda x, y: x * y,
+    'smooth': lambda x, y: ((x+y)/2) ** 2,
+}
 # determine increase in bbox size from above constants
 BBOX_INCREASE_LAT=(RASTER_MANHATTAN_DISTANCE_MAX + 1) * RASTER_SIZE_LAT
 
@@ -1,40 +1,45 @@
 import constants as c
 from collections import Counter
 import json
+import metrics
 import numpy as np
 from utility import Clogger
 import pandas as pd
+import raster_engine
+from raster_config import RasterConfig
 import re
 
 logger = Clogger('group_clusters.log')
 
 
-def raster_dict_to_df(
-        raster_dict,
+def raster_to_df(
+        raster,
         directional=False,
 ):
-    data = []
+    """
+    one row per cell of a compact raster (or per history entry of each
+    cell of a directional raster)
+    """
+    lat_bin, long_bin = raster_engine.unpack_cells(raster['cells'])
+    lat_bin = lat_bin.astype(np.float64)
+    long_bin = long_bin.astype(np.float64)
     if directional:
-        for bins, d in raster_dict.items():
-            lat_bin, long_bin = bins
-            for i in range(len(d['weight_history'])):
-                data.append({
-                    'lat_bin': lat_bin,
-                    'long_bin': long_bin,
-                    'weight': d['weight_history'][i],
-                    'angle': d['angle_history'][i],
-                    'bin_ord': i,
-                })
+        offsets = raster['offsets']
+        counts = np.diff(offsets)
+        return pd.DataFrame({
+            'lat_bin': np.repeat(lat_bin, counts),
+            'long_bin': np.repeat(long_bin, counts),
+            'weight': raster['weight_history'],
+            'angle': raster['angle_history'],
+            'bin_ord': np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts),
+        })
     else:
-        for bins, d in raster_dict.items():
-            lat_bin, long_bin = bins
-            data.append({
-                'lat_bin': lat_bin,
-                'long_bin': long_bin,
-                'sum_weight': d['sum_weight'],
-                'sum_unit_weight': d['sum_unit_weight'],
-            })
-    return pd.DataFrame(data)
+        return pd.DataFrame({
+            'lat_bin': lat_bin,
+            'long_bin': long_bin,
+            'sum_weight': raster['sum_weight'],
+            'sum_unit_weight': raster['sum_unit_weight'],
+        })
 
 def bbox_intersection(
         d1,
@@ -56,13 +61,87 @@ def bbox_intersection(
         (bbox1['long'][0] > bbox2['long'][1])
     )
 
+class UnionFind:
+    """
+    disjoint sets over the integers 0..n-1
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i == root_j:
+            return False
+        # smaller index stays the root so components keep their
+        # earliest member as representative
+        if root_j < root_i:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        return True
+
+
+def bbox_components(members):
+    """
+    connected components of the bbox intersection graph (same rule as
+    bbox_intersection()), found with a sweep line over the lower latitude
+    edges and a union-find
+
+    returns a list of lists of indices into members, ordered by each
+    component's first index, indices ascending
+    """
+    n = len(members)
+    if n == 0:
+        return []
+
+    bboxes = np.array([
+        [m['bbox']['lat'][0], m['bbox']['lat'][1], m['bbox']['long'][0], m['bbox']['long'][1]]
+        for m in members
+    ], dtype=np.float64)
+    lat_min, lat_max, long_min, long_max = bboxes.T
+
+    uf = UnionFind(n)
+    # boxes whose latitude range has started and may not have ended yet
+    active = np.zeros(0, dtype=np.int64)
+    for i in np.argsort(lat_min, kind='stable'):
+        # anything ending below this box's lower edge can never intersect
+        # this box or any box after it in the sweep
+        active = active[lat_max[active] >= lat_min[i]]
+        hits = active[
+            (long_max[active] >= long_min[i]) &
+            (long_min[active] <= long_max[i])
+        ]
+        for root in {uf.find(j) for j in hits.tolist()}:
+            uf.union(i, root)
+        active = np.append(active, i)
+
+    components = {}
+    for i in range(n):
+        components.setdefault(uf.find(i), []).append(i)
+    return [components[root] for root in sorted(components)]
+
+
 class Group:
     def __init__(
             self,
-            members
+            members,
+            config=None,
     ):
         self.members = members
         self.attributes = None
+        # raster config that sets the group's longitude raster size
+        if config is None:
+            config = RasterConfig.from_constants()
+        self.config = config
 
     def add_member(self, member):
         #logger.debug('Adding member to group: %a' % member)
@@ -120,7 +199,7 @@ class Group:
                 v-1 for v in
                 Counter([m['filename'] for m in self.members]).values()
             ]),
-            'long_raster_size': c.RASTER_SIZE_LAT / np.cos(
+            'long_raster_size': self.config.size_lat / np.cos(
                 np.median([
                     np.mean(m['bbox']['lat'])
                     for m in self.members
@@ -175,13 +254,13 @@ class Group:
             df_list.append(df)
 
             if directional:
-                rd_df = raster_dict_to_df(
-                    member['directional_raster_dict'],
+                rd_df = raster_to_df(
+                    member['directional_raster'],
                     directional=directional
                 )
             else:
-                rd_df = raster_dict_to_df(
-                    member['raster_dict'],
+                rd_df = raster_to_df(
+                    member['raster'],
                     directional=directional
                 )
             rd_df['member_id'] = i
@@ -207,9 +286,12 @@ class GroupProcessor:
             self,
             groups=None,
             metadata=None,
-            debug=False
+            debug=False,
+            config=None,
     ):
         self.debug = debug
+        # raster config of the groups this creates
+        self.config = config
         if groups is None:
             self.groups = []
         else:
@@ -217,11 +299,38 @@ class GroupProcessor:
 
         if metadata is not None:
             logger.info('Initializing GroupProcessor from metadata')
-            for v in metadata.values():
-                self.add_member(v)
-                
-            while self.merge_groups():
-                pass
+            if self.groups:
+                # existing groups may need to be merged with new members
+                for v in metadata.values():
+                    self.add_member(v)
+                while self.merge_groups():
+                    pass
+            else:
+                self.build_groups(list(metadata.values()))
+            self.record_group_sizes()
+
+    def build_groups(self, members):
+        """
+        groups members by connected bounding boxes; equivalent to calling
+        add_member() for each member and merge_groups() until no more
+        merges are made, but without comparing every pair of members
+
+        groups are ordered by their first member, and members keep the
+        order they are given in
+        """
+        for member in members:
+            if member is None:
+                logger.error('MEMBER IS NONE')
+                raise ValueError('MEMBER IS NONE')
+
+        components = bbox_components(members)
+        for component in components:
+            self.add_group(Group([members[i] for i in component], self.config))
+
+        if self.debug:
+            logger.debug('Built %d groups from %d members' % (len(components), len(members)))
+
+        self.set_group_attributes()
 
     def pairwise_group_iter(self):
         for group in self.groups:
@@ -252,7 +361,7 @@ class GroupProcessor:
                 added=True
                 break
         if not added:
-            self.add_group(Group([member]))
+            self.add_group(Group([member], self.config))
 
     def merge_groups(self):
         """
@@ -314,6 +423,9 @@ class GroupProcessor:
             [len(g.members) for g in self.groups]
         )
 
+    def record_group_sizes(self):
+        metrics.distribution('group_size', [len(g.members) for g in self.groups])
+
     def overall_group_summary(self):
         group_summaries = [
             g.summary() for g in self.groups
@@ -328,21 +440,42 @@ class GroupProcessor:
         }
 
     def inter_group_filename_pairs(self):
-        n_groups = len(self.groups)
         all_pairs = set()
-        for i in range(n_groups-1):
-            for j in range(i+1, n_groups):
-                g1 = self.groups[i]
-                g2 = self.groups[j]
-                all_pairs.update(
-                    {
-                        (m1['filename'], m2['filename'])
-                        for m1 in g1.members
-                        for m2 in g2.members
-                    }
-                )
+        for fn1, fn2 in self.inter_group_filename_chunks():
+            all_pairs.update(zip(fn1, fn2))
         return all_pairs
 
+    def inter_group_filename_chunks(self, chunk_size=100000):
+        """
+        generates (fn1, fn2) arrays of filename pairs in different groups,
+        about chunk_size pairs at a time (at least one member of a group
+        against all members of later groups)
+        """
+        filenames = np.array(
+            [m['filename'] for g in self.groups for m in g.members],
+            dtype=object,
+        )
+        fn1_list = []
+        fn2_list = []
+        n_pairs = 0
+        start = 0
+        for group in self.groups:
+            end = start + len(group.members)
+            later = filenames[end:]
+            if len(later) > 0:
+                for fn in filenames[start:end]:
+                    fn1_list.append(np.repeat(fn, len(later)))
+                    fn2_list.append(later)
+                    n_pairs += len(later)
+                    if n_pairs >= chunk_size:
+                        yield np.concatenate(fn1_list), np.concatenate(fn2_list)
+                        fn1_list = []
+                        fn2_list = []
+                        n_pairs = 0
+            start = end
+        if n_pairs > 0:
+            yield np.concatenate(fn1_list), np.concatenate(fn2_list)
+
     def groups_to_df_dict(self, directional=False,options={}):
         member_dataframes = []
         group_dataframes = []
@@ -0,0 +1,272 @@
+## incremental.py
+#
+# saving/loading the state of a run so that new tracks can be added later
+# without recalculating every pair
+#
+# a state directory contains
+#   * state.json       - raster parameters, groups and member metadata
+#                        (including norms)
+#   * group_<hash>.npz - flattened rasters of each group's members, named
+#                        by a hash of the members and their grid
+#   * similarities.csv - all intra-group similarities (full filenames)
+#
+# groups keep the longitude raster size they were rasterized with. when
+# new tracks join a group, they are rasterized on its grid; when a new
+# track bridges several groups, the merged group uses the grid of its
+# largest previous group and members of the other groups are rasterized
+# again on it. because of this, results can differ slightly from a full
+# run, where the raster size is recalculated from all members.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import raster_cache
+from group_clusters import Group
+from group_clusters import bbox_components
+from parallel_similarity import flatten_rasters
+from raster_config import get_config
+from utility import Clogger
+
+logger = Clogger('incremental.log')
+
+STATE_VERSION = 2
+
+NORM_FIELDS = [
+    'raster_norm',
+    'raster_unit_norm',
+    'raster_directional_norm',
+    'raster_directional_unit_norm',
+]
+
+METADATA_FIELDS = [
+    'bbox',
+    'distance',
+    'ts_start',
+    'filename',
+    'median_lat',
+    'cosine_lat',
+] + NORM_FIELDS
+
+
+class StateError(Exception):
+    pass
+
+
+def state_params(options, weights_method):
+    config = get_config(options)
+    params = raster_cache.raster_params(config, 0.0, directional=True)
+    params.pop('long_raster_size')
+    params.pop('directional')
+    params.update(raster_cache.metadata_params(config))
+    params.update({
+        'version': STATE_VERSION,
+        'weights_method': weights_method,
+        'weight_center_only': options.get('weight_center_only', False),
+        'directional': options.get('add_directional_similarity', False),
+    })
+    return raster_cache.to_json_value(params)
+
+
+def group_filename(group):
+    h = hashlib.sha1(repr(group.attributes['long_raster_size']).encode('utf-8'))
+    for member in group.members:
+        h.update(b'\n')
+        h.update(member['filename'].encode('utf-8'))
+    return 'group_%s.npz' % h.hexdigest()
+
+
+def save_state(
+        directory,
+        grouper,
+        similarity_data,
+        directional_similarity_data,
+        options,
+        weights_method,
+):
+    """
+    writes the state of a run to directory
+
+    groups loaded with load_state() that were not changed (they still have
+    a "state_file") have their raster files copied instead of rebuilt
+    """
+    logger.info('Saving state to %s' % directory)
+    os.makedirs(directory, exist_ok=True)
+    directional = directional_similarity_data is not None
+
+    groups = []
+    for group in grouper.groups:
+        filename = group_filename(group)
+        path = os.path.join(directory, filename)
+        source = getattr(group, 'state_file', None)
+        if source is not None:
+            # unchanged group
+            if os.path.abspath(source) != os.path.abspath(path):
+                shutil.copyfile(source, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        else:
+            arrays = flatten_rasters(group.members)
+            if directional:
+                arrays.update({
+                    'directional_%s' % k: v
+                    for k, v in flatten_rasters(group.members, directional=True).items()
+                })
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(path + '.tmp', path)
+
+        groups.append({
+            'file': filename,
+            'long_raster_size': group.attributes['long_raster_size'],
+            'members': [
+                {k: m[k] for k in METADATA_FIELDS if k in m}
+                for m in group.members
+            ],
+        })
+
+    state = {
+        'params': state_params(options, weights_method),
+        'groups': groups,
+    }
+    with open(os.path.join(directory, 'state.json.tmp'), 'w') as f:
+        json.dump(raster_cache.to_json_value(state), f)
+
+    keys = list(similarity_data.keys())
+    df = pd.DataFrame({
+        'fn1': [k[0] for k in keys],
+        'fn2': [k[1] for k in keys],
+        'similarity': [similarity_data[k] for k in keys],
+    })
+    if directional:
+        df['directional_similarity'] = [directional_similarity_data[k] for k in keys]
+    df.to_csv(os.path.join(directory, 'similarities.csv.tmp'), index=False)
+
+    # state.json last, so that a partially written state is never read
+    # with a newer similarities file
+    os.replace(
+        os.path.join(directory, 'similarities.csv.tmp'),
+        os.path.join(directory, 'similarities.csv'),
+    )
+    os.replace(
+        os.path.join(directory, 'state.json.tmp'),
+        os.path.join(directory, 'state.json'),
+    )
+
+    # groups that were merged into others
+    used = {g['file'] for g in groups}
+    for filename in os.listdir(directory):
+        if filename.startswith('group_') and filename.endswith('.npz') and filename not in used:
+            os.remove(os.path.join(directory, filename))
+
+
+def load_state(directory, options, weights_method):
+    """
+    returns a dict with
+      * groups - list of Group objects (attributes set, "state_file" is
+                 the path of their raster file)
+      * similarities/directional_similarities - dicts keyed by filename pairs
+    """
+    logger.info('Loading state from %s' % directory)
+    with open(os.path.join(directory, 'state.json')) as f:
+        state = json.load(f)
+
+    params = state_params(options, weights_method)
+    if state['params'] != params:
+        changed = sorted(
+            k for k in set(params) | set(state['params'])
+            if params.get(k) != state['params'].get(k)
+        )
+        raise StateError(
+            'State in %s was built with different parameters: %s' % (
+                directory,
+                ', '.join(changed),
+            )
+        )
+
+    groups = []
+    for group_state in state['groups']:
+        group = Group(group_state['members'], get_config(options))
+        group.set_attributes()
+        # the grid a group was rasterized with is kept
+        group.attributes['long_raster_size'] = group_state['long_raster_size']
+        group.state_file = os.path.join(directory, group_state['file'])
+        groups.append(group)
+
+    df = pd.read_csv(os.path.join(directory, 'similarities.csv'))
+    keys = list(zip(df['fn1'], df['fn2']))
+    similarities = dict(zip(keys, df['similarity'].tolist()))
+    if 'directional_similarity' in df.columns:
+        directional_similarities = dict(zip(keys, df['directional_similarity'].tolist()))
+    else:
+        directional_similarities = None
+
+    return {
+        'groups': groups,
+        'similarities': similarities,
+        'directional_similarities': directional_similarities,
+    }
+
+
+def load_group_rasters(group, directional=False):
+    """
+    assigns "raster" (and "directional_raster") arrays to each member of a
+    group loaded from a state
+    """
+    with np.load(group.state_file) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+
+    prefixes = ['']
+    if directional:
+        prefixes.append('directional_')
+    for prefix in prefixes:
+        offsets = arrays[prefix + 'member_offsets']
+        for i, member in enumerate(group.members):
+            start, end = offsets[i], offsets[i+1]
+            if prefix:
+                history_offsets = arrays['directional_history_offsets'][start:end+1]
+                member['directional_raster'] = {
+                    'cells': arrays['directional_cells'][start:end],
+                    'offsets': history_offsets - history_offsets[0],
+                    'weight_history': arrays['directional_weight_history'][
+                        history_offsets[0]:history_offsets[-1]
+                    ],
+                    'angle_history': arrays['directional_angle_history'][
+                        history_offsets[0]:history_offsets[-1]
+                    ],
+                }
+            else:
+                member['raster'] = {
+                    'cells': arrays['cells'][start:end],
+                    'sum_weight': arrays['sum_weight'][start:end],
+                    'sum_unit_weight': arrays['sum_unit_weight'][start:end],
+                }
+
+
+def plan_merges(old_groups, new_members):
+    """
+    determines which old groups and new members end up together
+
+    returns a list of (old group indices, new members) per resulting
+    group, in the order old groups come first (by index), then groups made
+    of new members only
+    """
+    members = []
+    owners = []
+    for i, group in enumerate(old_groups):
+        members.extend(group.members)
+        owners.extend([i] * len(group.members))
+    members.extend(new_members)
+    owners.extend([None] * len(new_members))
+
+    plans = []
+    for component in bbox_components(members):
+        group_indices = sorted({owners[k] for k in component if owners[k] is not None})
+        component_new = [members[k] for k in component if owners[k] is None]
+        plans.append((group_indices, component_new))
+
+    plans.sort(key=lambda p: (len(p[0]) == 0, p[0][0] if p[0] else 0))
+    return plans
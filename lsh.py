@@ -0,0 +1,285 @@
+## lsh.py
+#
+# candidate pairs from MinHash signatures of raster cell sets
+#
+# each member's set of raster cells gets a signature of num_perm minimum
+# hashes; signatures are split into bands, and two members of a group are
+# candidates if all rows of any band are equal. the probability of that is
+# 1 - (1 - J^r)^b for cell sets with a Jaccard similarity of J, r rows per
+# band and b bands, so more bands (fewer rows) find more pairs with little
+# overlap, at the cost of more candidates. only candidates have their
+# similarity calculated, in blocks of sparse products like the full
+# matrix; the other pairs are left out of the output.
+
+import numpy as np
+
+from calculate_similarity import calculate_directional_similarity
+from calculate_similarity import group_similarity_matrices
+from calculate_similarity import pair_similarities
+import metrics
+from raster_engine import expand_ranges
+from utility import Clogger
+
+logger = Clogger('lsh.log')
+
+LSH_SEED = 2021
+
+# cells hashed at once when building signatures
+CELL_CHUNK_SIZE = 4096
+
+UINT64_MAX = np.iinfo(np.uint64).max
+
+# probability of a pair being a candidate at the similarity logged by
+# find_candidates()
+LSH_RECALL_PROBABILITY = 0.95
+
+
+def mix_cells(cells):
+    # splitmix64 finalizer, so that neighbouring cells hash very differently
+    x = np.asarray(cells, dtype=np.int64).view(np.uint64)
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_params(num_perm, seed=LSH_SEED):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, UINT64_MAX, size=num_perm, dtype=np.uint64, endpoint=True) | np.uint64(1)
+    b = rng.integers(0, UINT64_MAX, size=num_perm, dtype=np.uint64, endpoint=True)
+    return a, b
+
+
+def minhash_signature(cells, a, b):
+    """
+    minimum of each of the hash functions a*x + b (mod 2^64) over the
+    mixed cells
+    """
+    signature = np.full(len(a), UINT64_MAX, dtype=np.uint64)
+    x = mix_cells(cells)
+    for start in range(0, len(x), CELL_CHUNK_SIZE):
+        chunk = x[start:start+CELL_CHUNK_SIZE]
+        hashes = a[:, None] * chunk[None, :] + b[:, None]
+        signature = np.minimum(signature, hashes.min(axis=1))
+    return signature
+
+
+def minhash_signatures(members, num_perm, seed=LSH_SEED):
+    a, b = hash_params(num_perm, seed)
+    signatures = np.empty((len(members), num_perm), dtype=np.uint64)
+    for i, member in enumerate(members):
+        signatures[i] = minhash_signature(member['raster']['cells'], a, b)
+    return signatures
+
+
+def candidate_pairs(signatures, bands):
+    """
+    arrays (i, j), i < j, sorted by i and then j, of the members that
+    share all rows of at least one band of their signatures
+    """
+    n_members, num_perm = signatures.shape
+    rows = num_perm // bands
+    keys = []
+    for band in range(bands):
+        band_rows = np.ascontiguousarray(signatures[:, band*rows:(band+1)*rows])
+        band_keys = band_rows.view(np.dtype((np.void, band_rows.dtype.itemsize * rows))).ravel()
+        _, labels = np.unique(band_keys, return_inverse=True)
+        # members of a bucket are in increasing order
+        order = np.argsort(labels.ravel(), kind='stable')
+        sorted_labels = labels.ravel()[order]
+        bucket_ends = np.append(np.flatnonzero(np.diff(sorted_labels)) + 1, n_members)
+        bucket_end = np.repeat(bucket_ends, np.diff(bucket_ends, prepend=0))
+        # each member is paired with the members after it in its bucket
+        n_after = bucket_end - np.arange(n_members) - 1
+        positions = np.arange(n_members)
+        i = np.repeat(order, n_after)
+        j = order[expand_ranges(positions + 1, n_after)]
+        keys.append(i * n_members + j)
+    keys = np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    return keys // n_members, keys % n_members
+
+
+def jaccard_threshold(num_perm, bands, probability=LSH_RECALL_PROBABILITY):
+    """
+    Jaccard similarity of two cell sets that are candidates with the
+    given probability, i.e. 1 - (1 - J^r)^b = probability
+    """
+    rows = num_perm // bands
+    return (1 - (1 - probability) ** (1 / bands)) ** (1 / rows)
+
+
+def similarity_threshold(jaccard):
+    """
+    similarity of two tracks with the same number of cells, all of the
+    same weight, whose cell sets have this Jaccard similarity
+    """
+    return 2 * jaccard / (1 + jaccard)
+
+
+def find_candidates(grouper, options={}):
+    """
+    sets group.candidate_pairs, arrays (i, j) sorted by i and then j, for
+    every group; self-pairs are always candidates
+    """
+    num_perm = options.get('lsh_num_perm', 128)
+    bands = options.get('lsh_bands', 64)
+    logger.info(
+        'Finding candidate pairs with %d bands of %d MinHash rows...' % (
+            bands,
+            num_perm // bands,
+        )
+    )
+    jaccard = jaccard_threshold(num_perm, bands)
+    logger.warn(
+        'Only pairs with a similarity of about %.2f or more (Jaccard '
+        'similarity of their cells %.2f) are found with %d%% probability; '
+        'less similar pairs may be missed and left out. More '
+        '--lsh-bands find more of them, and --lsh-recall-sample estimates '
+        'how many are missed' % (
+            similarity_threshold(jaccard),
+            jaccard,
+            100 * LSH_RECALL_PROBABILITY,
+        )
+    )
+    n_pairs = 0
+    n_candidates = 0
+    for group in grouper.groups:
+        n_members = len(group.members)
+        if n_members > 1:
+            signatures = minhash_signatures(group.members, num_perm)
+            i_idx, j_idx = candidate_pairs(signatures, bands)
+        else:
+            i_idx = j_idx = np.zeros(0, dtype=np.int64)
+        self_idx = np.arange(n_members)
+        i_idx = np.concatenate([i_idx, self_idx])
+        j_idx = np.concatenate([j_idx, self_idx])
+        order = np.lexsort((j_idx, i_idx))
+        group.candidate_pairs = (i_idx[order], j_idx[order])
+        n_pairs += n_members * (n_members + 1) // 2
+        n_candidates += len(order)
+    metrics.count('lsh_candidates', n_candidates)
+    logger.info(
+        '%d of %d pairs (%.1f%%) are candidates' % (
+            n_candidates,
+            n_pairs,
+            100.0 * n_candidates / max(n_pairs, 1),
+        )
+    )
+
+
+def calculate_similarities_lsh(grouper, options={}, similarities=None, directional=False):
+    """
+    similarities of the pairs in group.candidate_pairs (see
+    find_candidates()), keyed like
+    calculate_similarity.calculate_similarities(); other pairs are left
+    out, like with --sparse-output
+    """
+    if similarities is None:
+        similarities = {}
+    prefix = 'directional_' if directional else ''
+
+    for group in grouper.groups:
+        members = group.members
+        i_idx, j_idx = group.candidate_pairs
+        if directional:
+            values = np.zeros(len(i_idx))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for k, (i, j) in enumerate(zip(i_idx.tolist(), j_idx.tolist())):
+                    values[k] = calculate_directional_similarity(members[i], members[j], options)
+        else:
+            values = pair_similarities(
+                members,
+                i_idx,
+                j_idx,
+                group_similarity_matrices(members, options),
+                options,
+            )
+        filenames = [m['filename'] for m in members]
+        for i, j, similarity in zip(i_idx.tolist(), j_idx.tolist(), values.tolist()):
+            similarities[(filenames[i], filenames[j])] = similarity
+        n_members = len(members)
+        metrics.count(prefix + 'pairs', n_members * (n_members + 1) // 2)
+        metrics.count(prefix + 'pairs_calculated', len(i_idx))
+    return similarities
+
+
+def sample_pairs(n_members, n_samples, rng):
+    """
+    arrays (i, j), i < j, of n_samples distinct random pairs of
+    n_members members
+    """
+    n_pairs = n_members * (n_members - 1) // 2
+    samples = np.sort(rng.choice(n_pairs, size=min(n_samples, n_pairs), replace=False))
+    # pairs are numbered row by row of the upper triangle
+    row_starts = np.arange(n_members) * (2 * n_members - np.arange(n_members) - 1) // 2
+    i = np.searchsorted(row_starts, samples, side='right') - 1
+    j = i + 1 + samples - row_starts[i]
+    return i, j
+
+
+def estimate_recall(grouper, n_samples, options={}, seed=LSH_SEED):
+    """
+    compares candidates to exact similarities of n_samples distinct random
+    pairs of different members of the same group; returns a dict with the
+    fraction of sampled pairs with a similarity > 0 that are candidates
+    ("recall") and the fraction of their total similarity that candidates
+    account for ("weighted_recall")
+    """
+    groups = [g for g in grouper.groups if len(g.members) > 1]
+    n_pairs = np.array([len(g.members) * (len(g.members) - 1) // 2 for g in groups])
+    report = {
+        'samples': 0,
+        'nonzero': 0,
+        'found': 0,
+        'recall': np.nan,
+        'weighted_recall': np.nan,
+    }
+    if not groups or n_samples <= 0:
+        return report
+
+    rng = np.random.default_rng(seed)
+    # samples are spread over groups in proportion to their pairs
+    group_samples = rng.multivariate_hypergeometric(
+        n_pairs,
+        min(n_samples, int(n_pairs.sum())),
+    )
+    total_similarity = 0.0
+    found_similarity = 0.0
+    for group, n_group_samples in zip(groups, group_samples.tolist()):
+        if n_group_samples == 0:
+            continue
+        members = group.members
+        n_members = len(members)
+        i_idx, j_idx = sample_pairs(n_members, n_group_samples, rng)
+        similarities = pair_similarities(
+            members,
+            i_idx,
+            j_idx,
+            group_similarity_matrices(members, options),
+            options,
+        )
+        candidate_i, candidate_j = group.candidate_pairs
+        found = np.isin(i_idx * n_members + j_idx, candidate_i * n_members + candidate_j)
+        nonzero = similarities > 0
+
+        report['samples'] += len(i_idx)
+        report['nonzero'] += int(np.sum(nonzero))
+        report['found'] += int(np.sum(nonzero & found))
+        total_similarity += float(np.sum(similarities[nonzero]))
+        found_similarity += float(np.sum(similarities[nonzero & found]))
+
+    if report['nonzero']:
+        report['recall'] = report['found'] / report['nonzero']
+        report['weighted_recall'] = found_similarity / total_similarity
+
+    logger.info(
+        'Estimated LSH recall: %.3f (%.3f weighted by similarity), '
+        'from %d of %d sampled pairs with a nonzero similarity' % (
+            report['recall'],
+            report['weighted_recall'],
+            report['nonzero'],
+            report['samples'],
+        )
+    )
+    return report
@@ -0,0 +1,238 @@
+## metrics.py
+#
+# optional instrumentation of a run: wall/CPU time and memory use of each
+# stage, counters (points rasterized, pairs calculated, ...) and
+# distributions (e.g., group sizes), written with --metrics-output
+#
+# recording is off until enable() is called; until then stage() returns a
+# shared no-op context and count()/distribution() return right away, so
+# instrumented code only pays for a function call
+#
+# a stage that is entered several times (e.g., once per group) is
+# recorded once, with its times summed over all calls
+#
+# memory is the peak resident set size of the process (from getrusage(),
+# where available), plus, with trace_memory, the net and peak python
+# allocations of each stage from tracemalloc (which slows allocations
+# down noticeably). stages should not be nested when tracing memory.
+#
+# stages and counters can be recorded from several threads (e.g., the
+# request threads of service.py); updates are made under a lock, and
+# only stages of the main thread trace memory, since tracemalloc's peak
+# is shared by all threads.
+
+from contextlib import contextmanager
+from contextlib import nullcontext
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_NULL_CONTEXT = nullcontext()
+
+_lock = threading.Lock()
+
+_state = {
+    'enabled': False,
+    'trace_memory': False,
+    'start': None,
+    'stages': {},
+    'counters': {},
+    'distributions': {},
+}
+
+# stage fields that are the largest of all calls rather than their sum
+PEAK_FIELDS = ['peak_rss_mb', 'traced_peak_mb']
+
+
+def enable(trace_memory=False):
+    """
+    starts recording (and clears anything recorded before)
+    """
+    _state.update(
+        enabled=True,
+        trace_memory=trace_memory,
+        start=times(),
+        stages={},
+        counters={},
+        distributions={},
+    )
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def times():
+    # children are worker processes that have finished
+    t = os.times()
+    return {
+        'wall': time.perf_counter(),
+        'cpu': time.process_time(),
+        'children_cpu': t.children_user + t.children_system,
+    }
+
+
+def peak_rss_mb():
+    """
+    peak resident set size of this process in MB, or None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+def elapsed(start):
+    end = times()
+    return {
+        'wall_s': end['wall'] - start['wall'],
+        'cpu_s': end['cpu'] - start['cpu'],
+        'children_cpu_s': end['children_cpu'] - start['children_cpu'],
+    }
+
+
+def stage(name):
+    """
+    context manager recording the time and memory use of a stage
+    """
+    if not _state['enabled']:
+        return _NULL_CONTEXT
+    return _record_stage(name)
+
+
+@contextmanager
+def _record_stage(name):
+    start = times()
+    start_rss = peak_rss_mb()
+    trace_memory = (
+        _state['trace_memory'] and
+        tracemalloc.is_tracing() and
+        threading.current_thread() is threading.main_thread()
+    )
+    if trace_memory:
+        tracemalloc.reset_peak()
+        start_traced = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        record = {'calls': 1}
+        record.update(elapsed(start))
+        end_rss = peak_rss_mb()
+        if end_rss is not None:
+            record['peak_rss_mb'] = end_rss
+            record['peak_rss_increase_mb'] = end_rss - start_rss
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['traced_net_mb'] = (current - start_traced) / 2 ** 20
+            record['traced_peak_mb'] = (peak - start_traced) / 2 ** 20
+        add_stage_record(name, record)
+
+
+def add_stage_record(name, record):
+    with _lock:
+        previous = _state['stages'].get(name)
+        if previous is None:
+            _state['stages'][name] = record
+            return
+        for field, value in record.items():
+            if field in PEAK_FIELDS:
+                previous[field] = max(previous.get(field, value), value)
+            else:
+                previous[field] = previous.get(field, 0) + value
+
+
+def count(name, n=1):
+    if _state['enabled']:
+        with _lock:
+            _state['counters'][name] = _state['counters'].get(name, 0) + n
+
+
+def distribution(name, values):
+    """
+    records summary statistics and a histogram (bins of powers of 2) of
+    non-negative integer values
+    """
+    if not _state['enabled']:
+        return
+    values = np.asarray(values, dtype=np.int64)
+    summary = {'count': int(values.shape[0])}
+    if values.shape[0]:
+        summary.update(
+            min=int(values.min()),
+            median=float(np.median(values)),
+            mean=float(values.mean()),
+            max=int(values.max()),
+            sum=int(values.sum()),
+        )
+        # bin k holds values in [2^k, 2^(k+1)), bin 0 also holds 0
+        bins = np.floor(np.log2(np.maximum(values, 1))).astype(np.int64)
+        summary['histogram'] = {
+            '%d-%d' % (2 ** k, 2 ** (k + 1) - 1): int(n)
+            for k, n in enumerate(np.bincount(bins))
+            if n
+        }
+    with _lock:
+        _state['distributions'][name] = summary
+
+
+def to_dict():
+    run = elapsed(_state['start']) if _state['start'] is not None else {}
+    rss = peak_rss_mb()
+    if rss is not None:
+        run['peak_rss_mb'] = rss
+    with _lock:
+        return {
+            'run': run,
+            'stages': [dict(stage=name, **record) for name, record in _state['stages'].items()],
+            'counters': dict(_state['counters']),
+            'distributions': dict(_state['distributions']),
+        }
+
+
+def to_rows():
+    """
+    (section, name, field, value) rows of everything recorded
+    """
+    metrics = to_dict()
+    rows = [('run', '', field, value) for field, value in metrics['run'].items()]
+    for record in metrics['stages']:
+        rows.extend(
+            ('stage', record['stage'], field, value)
+            for field, value in record.items()
+            if field != 'stage'
+        )
+    rows.extend(('counter', name, 'count', n) for name, n in metrics['counters'].items())
+    for name, summary in metrics['distributions'].items():
+        for field, value in summary.items():
+            if field == 'histogram':
+                rows.extend(('distribution', name, 'bin_' + b, n) for b, n in value.items())
+            else:
+                rows.append(('distribution', name, field, value))
+    return rows
+
+
+def write(filename):
+    """
+    writes the metrics to filename, as CSV rows of (section, name, field,
+    value) if it ends with ".csv" and as JSON otherwise
+    """
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['section', 'name', 'field', 'value'])
+            writer.writerows(to_rows())
+    else:
+        with open(filename, 'w') as f:
+            json.dump(to_dict(), f, indent=2)
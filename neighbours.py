@@ -0,0 +1,135 @@
+## neighbours.py
+#
+# top-k most similar tracks of each track (within its group)
+#
+# pairs are visited in decreasing order of an upper bound of their
+# similarity (see similarity_bounds.py), in chunks that are calculated
+# with sparse matrix products. a pair is only calculated if its bound
+# could still place it in the bounded heap of either of its tracks (and
+# is at least the minimum similarity).
+
+import heapq
+
+import numpy as np
+
+from calculate_similarity import group_similarity_matrices
+from calculate_similarity import pair_similarities
+from similarity_bounds import calculate_pair_directional_similarities
+from similarity_bounds import format_counters
+from similarity_bounds import new_counters
+from similarity_bounds import pair_bounds
+from similarity_bounds import record_counters
+from utility import Clogger
+
+logger = Clogger('neighbours.log')
+
+# number of pairs, in decreasing order of their bounds, scored at once
+NEIGHBOUR_CHUNK_SIZE = 16384
+
+
+def heap_threshold(heap, k):
+    # similarity a pair must exceed to enter a full heap
+    if len(heap) < k:
+        return -np.inf
+    return heap[0][0]
+
+
+def push_neighbour(heap, k, similarity, neighbour):
+    if len(heap) < k:
+        heapq.heappush(heap, (similarity, neighbour))
+    elif similarity > heap[0][0]:
+        heapq.heapreplace(heap, (similarity, neighbour))
+
+
+def group_neighbours(members, k, min_similarity, weights_method, options={}, counters=None):
+    """
+    list of [(neighbour index, similarity), ...] for each member, most
+    similar first; only neighbours with a similarity > 0 and
+    >= min_similarity are included
+    """
+    n_members = len(members)
+    heaps = [[] for _ in range(n_members)]
+    if counters is None:
+        counters = new_counters()
+    counters.setdefault('heap', 0)
+
+    i_idx, j_idx, bounds = pair_bounds(members, weights_method, min_similarity, options, counters)
+    order = np.argsort(-bounds, kind='stable')
+    i_idx = i_idx[order]
+    j_idx = j_idx[order]
+    bounds = bounds[order]
+
+    # pairs are scored a chunk at a time with the sparse engine; pairs
+    # whose bound can no longer enter either heap are dropped from each
+    # chunk before it is scored
+    matrices = group_similarity_matrices(members, options)
+    thresholds = np.full(n_members, -np.inf)
+    for start in range(0, len(bounds), NEIGHBOUR_CHUNK_SIZE):
+        i_chunk = i_idx[start:start+NEIGHBOUR_CHUNK_SIZE]
+        j_chunk = j_idx[start:start+NEIGHBOUR_CHUNK_SIZE]
+        bound_chunk = bounds[start:start+NEIGHBOUR_CHUNK_SIZE]
+        skip = (bound_chunk <= thresholds[i_chunk]) & (bound_chunk <= thresholds[j_chunk])
+        counters['heap'] += int(np.sum(skip))
+        i_chunk = i_chunk[~skip]
+        j_chunk = j_chunk[~skip]
+        if not len(i_chunk):
+            continue
+
+        similarities = pair_similarities(members, i_chunk, j_chunk, matrices, options)
+        counters['calculated'] += len(i_chunk)
+        keep = (similarities > 0) & (similarities >= min_similarity)
+        for i, j, similarity in zip(
+                i_chunk[keep].tolist(),
+                j_chunk[keep].tolist(),
+                similarities[keep].tolist(),
+        ):
+            push_neighbour(heaps[i], k, similarity, j)
+            push_neighbour(heaps[j], k, similarity, i)
+        for i in np.unique(np.concatenate([i_chunk[keep], j_chunk[keep]])).tolist():
+            thresholds[i] = heap_threshold(heaps[i], k)
+
+    return [
+        [(neighbour, similarity) for similarity, neighbour in sorted(heap, key=lambda x: (-x[0], x[1]))]
+        for heap in heaps
+    ]
+
+
+def calculate_neighbours(grouper, k, min_similarity, weights_method, options={}):
+    """
+    dict of filename -> [(neighbour filename, similarity), ...] of every
+    member of every group, most similar first
+    """
+    logger.info('Calculating top %d neighbours...' % k)
+    neighbours = {}
+    counters = new_counters()
+    for group in grouper.groups:
+        members = group.members
+        for member, member_neighbours in zip(
+                members,
+                group_neighbours(members, k, min_similarity, weights_method, options, counters),
+        ):
+            neighbours[member['filename']] = [
+                (members[j]['filename'], similarity)
+                for j, similarity in member_neighbours
+            ]
+
+    logger.debug('Neighbours: %s' % format_counters(counters))
+    logger.debug('%d pairs could not enter a top %d' % (counters.get('heap', 0), k))
+    record_counters(counters)
+    return neighbours
+
+
+def calculate_neighbour_directional_similarities(grouper, neighbours, options={}):
+    """
+    directional similarities of the pairs in neighbours, keyed by
+    (filename, neighbour filename)
+    """
+    return calculate_pair_directional_similarities(
+        grouper,
+        [
+            (fn, neighbour)
+            for fn, member_neighbours in neighbours.items()
+            for neighbour, _ in member_neighbours
+        ],
+        options,
+    )
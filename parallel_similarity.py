@@ -0,0 +1,259 @@
+## parallel_similarity.py
+#
+# pairwise similarities computed by a pool of worker processes
+#
+# only used for similarities that have no vectorized kernel, i.e. when the
+# sparse engine cannot be used (--weight-center-only, --similarity-engine
+# python or no scipy); directional similarities always use the blocked
+# kernel of calculate_similarity.py, which is faster per process than
+# pairs.
+#
+# the rasters of every member are flattened into a few arrays that are
+# copied into shared memory once; workers attach to them when they start
+# and then only receive small block descriptions (ranges of rows of a
+# group's upper triangle), so nothing large is pickled per task.
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import constants as c
+import metrics
+import numpy as np
+from utility import Clogger
+
+logger = Clogger('parallel_similarity.log')
+
+# rough number of pairs in each block handed to a worker
+MIN_PAIRS_PER_BLOCK = 500
+BLOCKS_PER_WORKER = 8
+
+# set in each worker by init_worker()
+_arrays = {}
+_shared_blocks = []
+_settings = {}
+
+
+class SharedArrays:
+    """
+    copies a dict of numpy arrays into shared memory blocks; spec() is
+    what worker processes need to attach to them
+    """
+    def __init__(self, arrays):
+        self.blocks = {}
+        self._spec = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            view[...] = array
+            self.blocks[name] = block
+            self._spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def spec(self):
+        return self._spec
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+def attach(spec):
+    arrays = {}
+    blocks = []
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
+
+
+def init_worker(spec, settings):
+    global _arrays
+    global _shared_blocks
+    global _settings
+    _arrays, _shared_blocks = attach(spec)
+    _settings = settings
+
+
+def flatten_rasters(members):
+    """
+    concatenates member rasters into flat arrays with per-member offsets
+    ("member_offsets")
+    """
+    rasters = [m['raster'] for m in members]
+    member_offsets = np.zeros(len(members)+1, dtype=np.int64)
+    member_offsets[1:] = np.cumsum([len(r['cells']) for r in rasters])
+    return {
+        'cells': np.concatenate([r['cells'] for r in rasters]),
+        'member_offsets': member_offsets,
+        'bboxes': np.array([
+            [m['bbox']['lat'][0], m['bbox']['lat'][1], m['bbox']['long'][0], m['bbox']['long'][1]]
+            for m in members
+        ], dtype=np.float64),
+        'sum_weight': np.concatenate([r['sum_weight'] for r in rasters]),
+        'sum_unit_weight': np.concatenate([r['sum_unit_weight'] for r in rasters]),
+        'norms': np.array([m['raster_norm'] for m in members], dtype=np.float64),
+        'unit_norms': np.array([m['raster_unit_norm'] for m in members], dtype=np.float64),
+    }
+
+
+def schedule_blocks(group_bounds, n_workers):
+    """
+    splits the upper triangles of all groups into blocks of roughly equal
+    numbers of pairs
+
+    group_bounds is a list of (start, end) member index ranges; each block
+    is a list of (row_start, row_end, group_end) segments, meaning pairs
+    (i, j) for row_start <= i < row_end and i <= j < group_end. large groups
+    are split over several blocks and small groups share blocks
+    """
+    total_pairs = sum((end-start) * (end-start+1) // 2 for start, end in group_bounds)
+    target = max(MIN_PAIRS_PER_BLOCK, total_pairs // max(1, n_workers * BLOCKS_PER_WORKER))
+
+    blocks = []
+    segments = []
+    n_pairs = 0
+    for start, end in group_bounds:
+        row_start = start
+        for i in range(start, end):
+            n_pairs += end - i
+            if n_pairs >= target:
+                segments.append((row_start, i+1, end))
+                blocks.append(segments)
+                segments = []
+                n_pairs = 0
+                row_start = i+1
+        if row_start < end:
+            segments.append((row_start, end, end))
+    if segments:
+        blocks.append(segments)
+    return blocks
+
+
+def bbox_intersects(i, j):
+    bboxes = _arrays['bboxes']
+    return not (
+        (bboxes[i, 1] < bboxes[j, 0]) or
+        (bboxes[i, 0] > bboxes[j, 1]) or
+        (bboxes[i, 3] < bboxes[j, 2]) or
+        (bboxes[i, 2] > bboxes[j, 3])
+    )
+
+
+def member_cells(i):
+    offsets = _arrays['member_offsets']
+    return offsets[i], _arrays['cells'][offsets[i]:offsets[i+1]]
+
+
+def pair_similarity(i, j):
+    weights_func = c.WEIGHTS_FUNCTIONS[_settings['weights_method']]
+    center_wt = _settings['weight_center_only']
+    start_i, cells_i = member_cells(i)
+    start_j, cells_j = member_cells(j)
+    _, idx_i, idx_j = np.intersect1d(
+        cells_i,
+        cells_j,
+        assume_unique=True,
+        return_indices=True,
+    )
+    idx_i += start_i
+    idx_j += start_j
+
+    if center_wt:
+        norms = _arrays['unit_norms']
+        norm_ratio = norms[j] / norms[i]
+        w1 = _arrays['sum_unit_weight'][idx_i].astype(np.float64)
+        w2 = np.minimum(_arrays['sum_weight'][idx_j].astype(np.float64), w1 * norm_ratio)
+    else:
+        norms = _arrays['norms']
+        w1 = _arrays['sum_weight'][idx_i].astype(np.float64)
+        w2 = _arrays['sum_weight'][idx_j].astype(np.float64)
+
+    return np.sum(weights_func(w1, w2)) / np.sqrt(norms[i] * norms[j])
+
+
+def similarity_block(segments):
+    """
+    similarities of all pairs in a block, in row-major order, plus the
+    number of pairs that were zero because their bboxes do not intersect
+    """
+    similarities = []
+    zero_counter = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for row_start, row_end, group_end in segments:
+            for i in range(row_start, row_end):
+                for j in range(i, group_end):
+                    if not bbox_intersects(i, j):
+                        similarities.append(0)
+                        zero_counter += 1
+                    else:
+                        similarities.append(pair_similarity(i, j))
+    return np.array(similarities, dtype=np.float64), zero_counter
+
+
+def calculate_similarities_parallel(
+        grouper,
+        weights_method,
+        options={},
+        similarities=None,
+):
+    """
+    same output as the pairwise calculation of
+    calculate_similarity.calculate_similarities(), computed by
+    options['workers'] processes
+    """
+    workers = options.get('workers', 1)
+    logger.info('Calculating similarities with %d workers...' % workers)
+
+    members = []
+    group_bounds = []
+    for group in grouper.groups:
+        group_bounds.append((len(members), len(members) + len(group.members)))
+        members.extend(group.members)
+    filenames = [m['filename'] for m in members]
+
+    blocks = schedule_blocks(group_bounds, workers)
+    logger.debug('Split %d groups into %d blocks' % (len(group_bounds), len(blocks)))
+
+    settings = {
+        'weights_method': weights_method,
+        'weight_center_only': options.get('weight_center_only', False),
+    }
+    shared = SharedArrays(flatten_rasters(members))
+    if similarities is None:
+        similarities = {}
+    counter = 0
+    zero_counter = 0
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(shared.spec(), settings),
+        ) as executor:
+            for segments, (values, n_zero) in zip(
+                    blocks,
+                    executor.map(similarity_block, blocks),
+            ):
+                values = iter(values.tolist())
+                for row_start, row_end, group_end in segments:
+                    for i in range(row_start, row_end):
+                        for j in range(i, group_end):
+                            similarities[(filenames[i], filenames[j])] = next(values)
+                counter += sum(
+                    (row_end - row_start) * (2 * group_end - row_start - row_end + 1) // 2
+                    for row_start, row_end, group_end in segments
+                )
+                zero_counter += n_zero
+                logger.debug(
+                    'Calculated %d similarities (%d default zero-valued)' % (
+                        counter,
+                        zero_counter
+                    )
+                )
+    finally:
+        shared.close()
+
+    metrics.count('pairs', counter)
+    metrics.count('pairs_skipped_by_bbox', zero_counter)
+    return similarities
@@ -0,0 +1,220 @@
+## raster_cache.py
+#
+# persistent on-disk cache of per-track metadata and rasters
+#
+# entries are keyed by a hash of the input file's contents plus every
+# constant that affects the cached value, so a file only needs to be
+# loaded and rasterized again if it or the raster parameters change.
+# the cache is bounded in size; least-recently-used entries are evicted.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from raster_config import RasterConfig
+from utility import Clogger
+
+logger = Clogger('raster_cache.log')
+
+# bump when the format of cached entries changes
+CACHE_VERSION = 2
+
+HASH_CHUNK_SIZE = 2 ** 20
+
+RASTER_ARRAYS = ['cells', 'sum_weight', 'sum_unit_weight']
+DIRECTIONAL_RASTER_ARRAYS = ['cells', 'offsets', 'weight_history', 'angle_history']
+
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def to_json_value(x):
+    if isinstance(x, dict):
+        return {k: to_json_value(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [to_json_value(v) for v in x]
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def key_hash(params):
+    return hashlib.sha1(
+        json.dumps(to_json_value(params), sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def metadata_params(config):
+    return {
+        'version': CACHE_VERSION,
+        'RASTER_SIZE_M': config.size_m,
+        'RASTER_MANHATTAN_DISTANCE_MAX': config.manhattan_distance_max,
+        'BBOX_INCREASE_LAT': repr(config.bbox_increase_lat),
+    }
+
+
+def raster_params(config, long_raster_size, directional=False):
+    params = {
+        'version': CACHE_VERSION,
+        'directional': directional,
+        'RASTER_SIZE_M': config.size_m,
+        'RASTER_SIZE_LAT': repr(config.size_lat),
+        'RASTER_METHOD': config.method,
+        'CUSTOM_RASTER_PROFILE': list(config.custom_profile),
+        'RASTER_DECAY_FACTOR': config.decay_factor,
+        'RASTER_MANHATTAN_DISTANCE_MAX': config.manhattan_distance_max,
+        'RASTER_COOLDOWN_INTERVAL': config.cooldown_interval,
+        'long_raster_size': repr(float(long_raster_size)),
+    }
+    if directional:
+        params['ANGLE_LAG_SECONDS'] = config.angle_lag_seconds
+    # only added when set, so that existing cache entries and states
+    # stay valid
+    if config.segments:
+        params['RASTER_SEGMENTS'] = True
+        params['RASTER_SEGMENT_MAX_CELLS'] = config.segment_max_cells
+    return params
+
+
+class RasterCache:
+    def __init__(
+            self,
+            directory,
+            max_bytes=2 ** 30,
+            config=None,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if config is None:
+            config = RasterConfig.from_constants()
+        self.config = config
+        self.hashes = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def file_hash(self, filename):
+        if filename not in self.hashes:
+            self.hashes[filename] = file_hash(filename)
+        return self.hashes[filename]
+
+    def path(self, filename, params, extension):
+        return os.path.join(
+            self.directory,
+            '%s_%s.%s' % (self.file_hash(filename), key_hash(params), extension),
+        )
+
+    def touch(self, path):
+        # access time for LRU eviction is tracked with the mtime
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def load_metadata(self, filename):
+        path = self.path(filename, metadata_params(self.config), 'json')
+        try:
+            with open(path) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # entries saved before non-finite points were ignored by
+        # get_metadata() can have a NaN median
+        if not np.isfinite(metadata['median_lat']):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(path)
+        metadata['filename'] = filename
+        return metadata
+
+    def save_metadata(self, filename, metadata):
+        path = self.path(filename, metadata_params(self.config), 'json')
+        self.write_atomic(
+            path,
+            lambda f: f.write(json.dumps(to_json_value(metadata)).encode('utf-8')),
+        )
+
+    def has_raster(self, filename, long_raster_size, directional=False):
+        return os.path.exists(
+            self.path(filename, raster_params(self.config, long_raster_size, directional), 'npz')
+        )
+
+    def load_raster(self, filename, long_raster_size, directional=False):
+        """
+        compact raster arrays (as built by raster_engine) or None
+        """
+        path = self.path(filename, raster_params(self.config, long_raster_size, directional), 'npz')
+        names = DIRECTIONAL_RASTER_ARRAYS if directional else RASTER_ARRAYS
+        try:
+            with np.load(path) as npz:
+                raster = {name: npz[name] for name in names}
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(path)
+        return raster
+
+    def save_raster(self, filename, long_raster_size, raster, directional=False):
+        path = self.path(filename, raster_params(self.config, long_raster_size, directional), 'npz')
+        names = DIRECTIONAL_RASTER_ARRAYS if directional else RASTER_ARRAYS
+        self.write_atomic(
+            path,
+            lambda f: np.savez(f, **{name: raster[name] for name in names}),
+        )
+
+    def write_atomic(self, path, write_func):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                write_func(f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warn('Could not write cache entry %s: %s' % (path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        """
+        removes least-recently-used entries until the cache fits in
+        max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            n_evicted += 1
+
+        logger.debug(
+            'Cache: %d hits, %d misses, %d entries evicted, %.1f MB used' % (
+                self.hits,
+                self.misses,
+                n_evicted,
+                total_bytes / 2 ** 20,
+            )
+        )
+        return n_evicted
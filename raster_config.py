@@ -0,0 +1,132 @@
+## raster_config.py
+#
+# the raster parameters of a run as one immutable object
+#
+# the defaults come from constants.py; command-line overrides (and sweeps,
+# see sweep.py) create new configs instead of changing the constants
+# module, so several configs can be used in one process. configs are
+# hashable and picklable, so they can be passed to worker processes and
+# used as dict keys.
+
+from dataclasses import dataclass
+from dataclasses import replace
+
+import constants as c
+
+METERS_PER_DEGREE_LAT = 111000
+
+# names of the constants (and options) that configs can override, and
+# the fields they set
+CONSTANT_FIELDS = {
+    'RASTER_SIZE_M': 'size_m',
+    'RASTER_COOLDOWN_INTERVAL': 'cooldown_interval',
+    'RASTER_DECAY_FACTOR': 'decay_factor',
+    'RASTER_MANHATTAN_DISTANCE_MAX': 'manhattan_distance_max',
+    'RASTER_METHOD': 'method',
+    'CUSTOM_RASTER_PROFILE': 'custom_profile',
+    'ANGLE_LAG_SECONDS': 'angle_lag_seconds',
+    'RASTER_SEGMENTS': 'segments',
+    'RASTER_SEGMENT_MAX_CELLS': 'segment_max_cells',
+}
+
+
+@dataclass(frozen=True)
+class RasterConfig:
+    size_m: float
+    cooldown_interval: int
+    decay_factor: float
+    manhattan_distance_max: int
+    method: str
+    custom_profile: tuple
+    angle_lag_seconds: int
+    segments: bool = False
+    segment_max_cells: int = c.RASTER_SEGMENT_MAX_CELLS
+
+    def __post_init__(self):
+        # lists (e.g., from JSON) are accepted, but kept as tuples
+        object.__setattr__(self, 'custom_profile', tuple(self.custom_profile))
+        if self.method not in c.RASTER_FUNCTIONS:
+            raise ValueError('unknown raster method %s' % self.method)
+        if self.manhattan_distance_max < 0:
+            raise ValueError('the maximum manhattan distance cannot be negative')
+        if self.segment_max_cells < 1:
+            raise ValueError('the maximum number of cells of a segment must be positive')
+        if self.method == 'custom' and len(self.custom_profile) <= self.manhattan_distance_max:
+            raise ValueError(
+                'the custom raster profile needs a weight for each manhattan '
+                'distance from 0 to %d' % self.manhattan_distance_max
+            )
+
+    @classmethod
+    def from_constants(cls):
+        return cls(**{
+            field: getattr(c, name)
+            for name, field in CONSTANT_FIELDS.items()
+        })
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        defaults overridden by options that are set (keyed by constant
+        names, like the dest of the raster arguments of tracksim.py)
+        """
+        return cls.from_constants().override(options)
+
+    def override(self, overrides):
+        """
+        copy with the constants named in overrides replaced; None and
+        empty values are ignored
+        """
+        changes = {
+            CONSTANT_FIELDS[name]: value
+            for name, value in overrides.items()
+            if name in CONSTANT_FIELDS and value is not None and value != '' and value != []
+        }
+        return replace(self, **changes)
+
+    def to_constants(self):
+        return {name: getattr(self, field) for name, field in CONSTANT_FIELDS.items()}
+
+    @property
+    def size_lat(self):
+        return self.size_m / METERS_PER_DEGREE_LAT
+
+    @property
+    def bbox_increase_lat(self):
+        return (self.manhattan_distance_max + 1) * self.size_lat
+
+    @property
+    def weights(self):
+        """
+        raster weight of each manhattan distance from 0 to the maximum
+        """
+        if self.method == 'custom':
+            return tuple(self.custom_profile[:self.manhattan_distance_max+1])
+        func = c.RASTER_FUNCTIONS[self.method]
+        return tuple(
+            func(self.decay_factor, md)
+            for md in range(self.manhattan_distance_max+1)
+        )
+
+    @property
+    def stencil_key(self):
+        """
+        configs with the same key have the same groups and raster cells,
+        and only differ in the weights (and cooldown) of the cells
+        """
+        return (
+            self.size_m,
+            self.manhattan_distance_max,
+            self.segments,
+            self.segment_max_cells if self.segments else None,
+        )
+
+
+def get_config(options={}):
+    """
+    the raster config of a run's options, or the defaults
+    """
+    config = options.get('raster_config')
+    if config is None:
+        return RasterConfig.from_constants()
+    return config
@@ -0,0 +1,506 @@
+## raster_engine.py
+#
+# array-based (numpy) rasterization of tracks
+#
+# the pure-python rasterizer in calculate_similarity.py visits every
+# point and every cell of the manhattan "diamond" around it one at a
+# time. here all points x stencil offsets are expanded into arrays at
+# once, sorted by (cell, pk), and the cooldown rule is applied to every
+# cell in parallel, one event rank at a time.
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from utility import diamond_generator
+
+# cells are packed into a single int64: upper 32 bits are the (signed)
+# latitude bin, lower 32 bits the longitude bin shifted to be non-negative,
+# so that sorting packed cells sorts by latitude bin, then longitude bin
+CELL_OFFSET = 2 ** 31
+CELL_MASK = 2 ** 32 - 1
+
+# weights of compact rasters are sums of a few stencil weights, for which
+# single precision is plenty; similarities are accumulated in float64
+RASTER_WEIGHT_DTYPE = np.float32
+
+
+def pack_cells(lat_bin, long_bin):
+    lat_bin = np.asarray(lat_bin, dtype=np.int64)
+    long_bin = np.asarray(long_bin, dtype=np.int64)
+    return (lat_bin << 32) | (long_bin + CELL_OFFSET)
+
+
+def unpack_cells(cells):
+    cells = np.asarray(cells, dtype=np.int64)
+    lat_bin = cells >> 32
+    long_bin = (cells & CELL_MASK) - CELL_OFFSET
+    return lat_bin, long_bin
+
+
+def pack_offsets(lat_offset, long_offset):
+    """
+    packed offset between cells: pack_cells(lat_bin, long_bin) +
+    pack_offsets(lat_offset, long_offset) is the packed cell of
+    (lat_bin + lat_offset, long_bin + long_offset), as long as the
+    longitude bins stay within 32 bits
+    """
+    lat_offset = np.asarray(lat_offset, dtype=np.int64)
+    long_offset = np.asarray(long_offset, dtype=np.int64)
+    return (lat_offset << 32) + long_offset
+
+
+def make_stencil(manhattan_distance_max):
+    """
+    returns the packed offsets (see pack_offsets()) and manhattan
+    distances of every cell within manhattan_distance_max of a point
+    """
+    lat_offsets = []
+    long_offsets = []
+    distances = []
+    for md in range(manhattan_distance_max+1):
+        for lat_bin_offset, long_bin_offset in sorted(diamond_generator(md)):
+            lat_offsets.append(lat_bin_offset)
+            long_offsets.append(long_bin_offset)
+            distances.append(md)
+
+    return (
+        pack_offsets(lat_offsets, long_offsets),
+        np.array(distances, dtype=np.intp),
+    )
+
+
+def stencil_weights(config):
+    # weight of each manhattan distance, indexed by expand_events() distances
+    return np.array(config.weights, dtype=np.float64)
+
+
+def calculate_bins(lat, long, size_lat, long_raster_size):
+    """
+    latitude/longitude bins of each point, as integers; non-finite
+    coordinates are dropped, along with their pk
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    pk = np.arange(lat.shape[0])
+    valid = np.isfinite(lat) & np.isfinite(long)
+    if not valid.all():
+        lat, long, pk = lat[valid], long[valid], pk[valid]
+
+    lat_bin = np.floor_divide(lat, size_lat).astype(np.int64)
+    long_bin = np.floor_divide(long, long_raster_size).astype(np.int64)
+    return lat_bin, long_bin, pk
+
+
+def segment_crossings(bins, coords, bin_size, gaps=None):
+    """
+    bin boundaries crossed by the segment between each pair of
+    consecutive points along one axis: the segment, the fraction t of
+    the segment at which the boundary is crossed and the step (+1/-1);
+    segments where gaps is True have no crossings
+    """
+    d = np.diff(bins)
+    n = np.abs(d)
+    if gaps is not None:
+        n[gaps] = 0
+    segment = np.repeat(np.arange(d.shape[0]), n)
+    # m-th boundary crossed by a segment, starting at 1
+    m = expand_ranges(np.ones(d.shape[0], dtype=np.int64), n)
+    step = np.sign(d)[segment]
+    boundary = (bins[segment] + np.where(step > 0, m, 1 - m)) * bin_size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (boundary - coords[segment]) / (coords[segment+1] - coords[segment])
+    return segment, t, step
+
+
+def calculate_segment_bins(lat, long, size_lat, long_raster_size, max_cells=None):
+    """
+    like calculate_bins(), but every cell crossed by the straight segment
+    between two consecutive points is added after the first point, with
+    its pk (DDA traversal of the lat/long bins)
+
+    the cells of a segment are 4-connected, so sparse or downsampled
+    tracks have no gaps in their cell path; a segment crossing a corner
+    exactly steps in latitude first. segments crossing more than
+    max_cells cells are left as gaps, so that a single glitched point
+    cannot add a line of cells across the map
+    """
+    lat_bin, long_bin, pk = calculate_bins(lat, long, size_lat, long_raster_size)
+    n_points = pk.shape[0]
+    if n_points < 2:
+        return lat_bin, long_bin, pk
+    lat = np.asarray(lat, dtype=np.float64)[pk]
+    long = np.asarray(long, dtype=np.float64)[pk]
+
+    if max_cells is None:
+        gaps = None
+    else:
+        gaps = np.abs(np.diff(lat_bin)) + np.abs(np.diff(long_bin)) > max_cells
+    lat_crossings = segment_crossings(lat_bin, lat, size_lat, gaps)
+    long_crossings = segment_crossings(long_bin, long, long_raster_size, gaps)
+    segment, t, step = [np.concatenate(x) for x in zip(lat_crossings, long_crossings)]
+    is_lat = np.arange(segment.shape[0]) < lat_crossings[0].shape[0]
+    # stable, so lat steps come first on ties
+    order = np.lexsort((t, segment))
+    segment, step, is_lat = segment[order], step[order], is_lat[order]
+
+    # cell after each crossing: bins of the first point plus the steps
+    # taken so far within the segment
+    counts = np.bincount(segment, minlength=n_points-1)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    first = starts[segment]
+    rank = np.arange(segment.shape[0]) - first
+    lat_steps = np.where(is_lat, step, 0)
+    long_steps = np.where(is_lat, 0, step)
+    lat_total = np.cumsum(lat_steps)
+    long_total = np.cumsum(long_steps)
+    cross_lat = lat_bin[segment] + lat_total - (lat_total - lat_steps)[first]
+    cross_long = long_bin[segment] + long_total - (long_total - long_steps)[first]
+
+    # the last crossing of a segment is the cell of its second point
+    inner = rank < counts[segment] - 1
+    segment, rank = segment[inner], rank[inner]
+    n_inner = np.maximum(counts - 1, 0)
+
+    # each point is followed by the inner cells of its segment
+    point_starts = np.arange(n_points)
+    point_starts[1:] += np.cumsum(n_inner)
+    n_total = n_points + int(n_inner.sum())
+    out_lat = np.empty(n_total, dtype=np.int64)
+    out_long = np.empty(n_total, dtype=np.int64)
+    out_pk = np.empty(n_total, dtype=pk.dtype)
+    out_lat[point_starts] = lat_bin
+    out_long[point_starts] = long_bin
+    out_pk[point_starts] = pk
+    positions = point_starts[segment] + 1 + rank
+    out_lat[positions] = cross_lat[inner]
+    out_long[positions] = cross_long[inner]
+    out_pk[positions] = pk[segment]
+    return out_lat, out_long, out_pk
+
+
+def track_bins(lat, long, long_raster_size, config):
+    """
+    bins and pk of a track's points (see calculate_bins()), plus the cells
+    between them if the config rasterizes segments
+    """
+    if config.segments:
+        return calculate_segment_bins(
+            lat,
+            long,
+            config.size_lat,
+            long_raster_size,
+            max_cells=config.segment_max_cells,
+        )
+    return calculate_bins(lat, long, config.size_lat, long_raster_size)
+
+
+def expand_events(lat_bin, long_bin, pk, stencil):
+    """
+    expands each point into one event per stencil cell, returned sorted
+    by (cell, pk), along with the manhattan distance of each event from
+    its point
+    """
+    offsets, distances = stencil
+
+    cells = (pack_cells(lat_bin, long_bin)[:, None] + offsets[None, :]).ravel()
+    event_pk = np.repeat(pk, offsets.shape[0])
+    event_distances = np.tile(distances, pk.shape[0])
+
+    order = np.lexsort((event_pk, cells))
+    return cells[order], event_pk[order], event_distances[order]
+
+
+def cell_runs(sorted_cells):
+    """
+    start index and length of each run of identical cells
+    """
+    n = sorted_cells.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(sorted_cells[1:] != sorted_cells[:-1]) + 1
+    starts = np.concatenate([[0], starts])
+    counts = np.diff(np.concatenate([starts, [n]]))
+    return starts, counts
+
+
+def scan_cooldown(cells, pk, weights, cooldown_interval):
+    """
+    applies the cooldown/higher-weight rule of rasterize() to events
+    sorted by (cell, pk)
+
+    a cell is incremented by an event's weight when the last update is
+    more than RASTER_COOLDOWN_INTERVAL steps old; within the cooldown a
+    strictly higher weight only refreshes the last update/weight (and the
+    unit weight count), exactly like the python rasterizer
+    """
+    starts, counts = cell_runs(cells)
+    n_cells = starts.shape[0]
+
+    # process cells with the most events first so that the cells still
+    # active at rank k are always a prefix
+    by_count = np.argsort(-counts, kind='stable')
+    o_starts = starts[by_count]
+    o_counts = counts[by_count]
+    # n_active[k] = number of cells with more than k events
+    max_count = o_counts[0] if n_cells else 0
+    n_active = n_cells - np.searchsorted(
+        o_counts[::-1], np.arange(max_count), side='right'
+    )
+
+    last_update = np.full(n_cells, -cooldown_interval-1, dtype=np.int64)
+    last_weight = np.zeros(n_cells, dtype=np.float64)
+    sum_weight = np.zeros(n_cells, dtype=np.float64)
+    sum_unit_weight = np.zeros(n_cells, dtype=np.float64)
+
+    for k in range(max_count):
+        m = n_active[k]
+        idx = o_starts[:m] + k
+        event_pk = pk[idx]
+        event_weight = weights[idx]
+
+        is_new = last_update[:m] < event_pk - cooldown_interval
+        is_higher = ~is_new & (last_weight[:m] < event_weight)
+        is_update = is_new | is_higher
+
+        sum_weight[:m] += np.where(is_new, event_weight, 0.0)
+        sum_unit_weight[:m] += is_update & (event_weight == 1)
+        last_update[:m] = np.where(is_update, event_pk, last_update[:m])
+        last_weight[:m] = np.where(is_update, event_weight, last_weight[:m])
+
+    # back to sorted cell order
+    inverse = np.empty_like(by_count)
+    inverse[by_count] = np.arange(n_cells)
+    return {
+        'cells': cells[starts],
+        'sum_weight': sum_weight[inverse],
+        'sum_unit_weight': sum_unit_weight[inverse],
+        'last_update': last_update[inverse],
+        'last_weight': last_weight[inverse],
+    }
+
+
+def compact_raster(cells, sum_weight, sum_unit_weight):
+    """
+    the raster of a track used by similarities, norms and exports: sorted
+    int64 "cells" and their RASTER_WEIGHT_DTYPE "sum_weight" and
+    "sum_unit_weight"
+    """
+    return {
+        'cells': np.asarray(cells, dtype=np.int64),
+        'sum_weight': np.asarray(sum_weight, dtype=RASTER_WEIGHT_DTYPE),
+        'sum_unit_weight': np.asarray(sum_unit_weight, dtype=RASTER_WEIGHT_DTYPE),
+    }
+
+
+def rasterize_track(lat, long, long_raster_size, config, stencil=None):
+    """
+    rasterizes a single track given its coordinate arrays and a
+    RasterConfig
+
+    returns a compact raster (see compact_raster())
+    """
+    return rasterize_track_configs(lat, long, long_raster_size, [config], stencil=stencil)[0][0]
+
+
+def rasterize_track_configs(lat, long, long_raster_size, configs, angle=None, stencil=None):
+    """
+    rasters of a single track for several configs with the same
+    stencil_key; the points are binned and expanded once, and only the
+    scans are repeated for each config's weights and cooldown
+
+    returns a list of compact rasters and, if angle is given, a list of
+    directional rasters (see rasterize_track_directional()), else None
+    """
+    config = configs[0]
+    if stencil is None:
+        stencil = make_stencil(config.manhattan_distance_max)
+    lat_bin, long_bin, pk = track_bins(lat, long, long_raster_size, config)
+    cells, event_pk, event_distances = expand_events(lat_bin, long_bin, pk, stencil)
+    if angle is not None:
+        event_angles = np.asarray(angle, dtype=np.float64)[event_pk]
+
+    rasters = []
+    directional_rasters = [] if angle is not None else None
+    for config in configs:
+        event_weights = stencil_weights(config)[event_distances]
+        raster = scan_cooldown(cells, event_pk, event_weights, config.cooldown_interval)
+        rasters.append(
+            compact_raster(raster['cells'], raster['sum_weight'], raster['sum_unit_weight'])
+        )
+        if angle is not None:
+            directional_rasters.append(scan_directional(
+                cells,
+                event_pk,
+                event_weights,
+                event_angles,
+                config.cooldown_interval,
+            ))
+    return rasters, directional_rasters
+
+
+def scan_directional(cells, pk, weights, angles, cooldown_interval):
+    """
+    applies the streak rules of rasterize_directional() to events sorted
+    by (cell, pk), one event rank at a time for all cells (like
+    scan_cooldown())
+
+    in each cell, events lighter than the heaviest one so far are ignored.
+    while events are within RASTER_COOLDOWN_INTERVAL of the last heavier
+    event, a heavier event restarts the current streak and an equal one
+    joins it; after that, the cooldown reference is never updated again,
+    so every remaining event wraps up the current streak and starts a new
+    one. a streak's angle is the circular mean of its angles, kept as
+    running sums of sines and cosines
+
+    returns sorted "cells", "offsets" and flat "weight_history" and
+    "angle_history" arrays (see rasterize_track_directional())
+    """
+    starts, counts = cell_runs(cells)
+    n_cells = starts.shape[0]
+
+    by_count = np.argsort(-counts, kind='stable')
+    o_starts = starts[by_count]
+    o_counts = counts[by_count]
+    max_count = o_counts[0] if n_cells else 0
+    n_active = n_cells - np.searchsorted(
+        o_counts[::-1], np.arange(max_count), side='right'
+    )
+
+    sin = np.sin(angles)
+    cos = np.cos(angles)
+
+    # state of each cell's current streak
+    last_update = np.zeros(n_cells, dtype=np.int64)
+    last_weight = np.zeros(n_cells, dtype=np.float64)
+    sum_sin = np.zeros(n_cells, dtype=np.float64)
+    sum_cos = np.zeros(n_cells, dtype=np.float64)
+    n_angles = np.zeros(n_cells, dtype=np.int64)
+    expired = np.zeros(n_cells, dtype=bool)
+
+    # wrapped up streaks: cell (in by_count order), rank, weight, angle
+    history = []
+
+    def wrap_up(which, rank):
+        history.append((
+            which,
+            np.full(which.shape[0], rank, dtype=np.int64),
+            last_weight[which],
+            np.arctan2(sum_sin[which] / n_angles[which], sum_cos[which] / n_angles[which]),
+        ))
+
+    for k in range(max_count):
+        m = n_active[k]
+        idx = o_starts[:m] + k
+        event_pk = pk[idx]
+        event_weight = weights[idx]
+        event_sin = sin[idx]
+        event_cos = cos[idx]
+
+        if k == 0:
+            last_update[:] = event_pk
+            last_weight[:] = event_weight
+            sum_sin[:] = event_sin
+            sum_cos[:] = event_cos
+            n_angles[:] = 1
+            continue
+
+        is_used = event_weight >= last_weight[:m]
+        expired[:m] |= is_used & ~(event_pk < last_update[:m] + cooldown_interval)
+        is_restart = is_used & ~expired[:m] & (event_weight > last_weight[:m])
+        is_join = is_used & ~expired[:m] & (event_weight == last_weight[:m])
+        is_new = is_used & expired[:m]
+
+        wrap_up(np.flatnonzero(is_new), k)
+
+        is_start = is_restart | is_new
+        last_update[:m] = np.where(is_restart, event_pk, last_update[:m])
+        last_weight[:m] = np.where(is_start, event_weight, last_weight[:m])
+        sum_sin[:m] = np.where(is_start, event_sin, sum_sin[:m] + np.where(is_join, event_sin, 0.0))
+        sum_cos[:m] = np.where(is_start, event_cos, sum_cos[:m] + np.where(is_join, event_cos, 0.0))
+        n_angles[:m] = np.where(is_start, 1, n_angles[:m] + is_join)
+
+    wrap_up(np.arange(n_cells), max_count)
+
+    which, rank, weight_history, angle_history = [
+        np.concatenate(x) for x in zip(*history)
+    ]
+    # back to sorted cell order, streaks in order within each cell
+    cell_index = by_count[which]
+    order = np.lexsort((rank, cell_index))
+    offsets = np.zeros(n_cells + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cell_index, minlength=n_cells))
+    return {
+        'cells': cells[starts],
+        'offsets': offsets,
+        'weight_history': weight_history[order].astype(np.float64),
+        'angle_history': angle_history[order].astype(np.float64),
+    }
+
+
+def rasterize_track_directional(lat, long, angle, long_raster_size, config, stencil=None):
+    """
+    directional rasterization of a single track given its coordinate and
+    angle arrays and a RasterConfig
+
+    returns a compact dict of arrays: sorted "cells", "offsets" into the
+    flat "weight_history"/"angle_history" arrays (cell i owns entries
+    offsets[i]:offsets[i+1])
+    """
+    if stencil is None:
+        stencil = make_stencil(config.manhattan_distance_max)
+    lat_bin, long_bin, pk = track_bins(lat, long, long_raster_size, config)
+    cells, event_pk, event_distances = expand_events(lat_bin, long_bin, pk, stencil)
+    event_angles = np.asarray(angle, dtype=np.float64)[event_pk]
+    return scan_directional(
+        cells,
+        event_pk,
+        stencil_weights(config)[event_distances],
+        event_angles,
+        config.cooldown_interval,
+    )
+
+
+def expand_ranges(starts, lengths):
+    """
+    concatenation of arange(starts[k], starts[k] + lengths[k]) for all k
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    total = ends[-1] if ends.shape[0] else 0
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(total)
+
+
+def match_histories(raster1, raster2):
+    """
+    positions in the flat histories of two directional rasters of the
+    entries with the same cell and the same streak number within it
+
+    cells are matched by merging the sorted cells of both rasters; longer
+    histories are truncated to the shorter one
+    """
+    _, idx1, idx2 = np.intersect1d(
+        raster1['cells'],
+        raster2['cells'],
+        assume_unique=True,
+        return_indices=True,
+    )
+    offsets1 = raster1['offsets']
+    offsets2 = raster2['offsets']
+    n = np.minimum(
+        offsets1[idx1+1] - offsets1[idx1],
+        offsets2[idx2+1] - offsets2[idx2],
+    )
+    return expand_ranges(offsets1[idx1], n), expand_ranges(offsets2[idx2], n)
+
+
+def map_tracks(func, args_list, workers=1):
+    """
+    applies func to each tuple of arguments in args_list, spread over a
+    process pool if workers > 1; results are in the same order
+    """
+    if workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    chunksize = max(1, len(args_list) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, *zip(*args_list), chunksize=chunksize))
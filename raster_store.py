@@ -0,0 +1,219 @@
+## raster_store.py
+#
+# out-of-core store of the rasters of a run, written one group at a time
+# and read back group by group with np.memmap
+#
+# like track_store.py, every array is a single flat binary file of all
+# groups' values concatenated:
+#   * cells.bin, sum_weight.bin, sum_unit_weight.bin - compact rasters of
+#     every member (see raster_engine.compact_raster())
+#   * member_offsets.bin - start of each member's cells (n_members + 1)
+#   * directional_cells.bin, directional_member_offsets.bin,
+#     history_offsets.bin (start of each cell's history, n_cells + 1),
+#     weight_history.bin, angle_history.bin - directional rasters, if any
+# store.json lists the filenames and grid of every group and is written
+# last; a store without it is not recognized.
+
+import json
+import os
+
+import numpy as np
+
+from raster_engine import RASTER_WEIGHT_DTYPE
+from utility import Clogger
+
+logger = Clogger('raster_store.log')
+
+STORE_VERSION = 1
+
+RASTER_ARRAYS = {
+    'cells': np.int64,
+    'sum_weight': RASTER_WEIGHT_DTYPE,
+    'sum_unit_weight': RASTER_WEIGHT_DTYPE,
+    'member_offsets': np.int64,
+}
+
+DIRECTIONAL_ARRAYS = {
+    'directional_cells': np.int64,
+    'directional_member_offsets': np.int64,
+    'history_offsets': np.int64,
+    'weight_history': np.float64,
+    'angle_history': np.float64,
+}
+
+
+def is_raster_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'store.json'))
+
+
+class RasterStoreWriter:
+    """
+    appends the rasters of each group to a new store; call close() to
+    write the index
+    """
+    def __init__(self, directory, directional=False):
+        self.directory = directory
+        self.directional = directional
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, 'store.json')):
+            os.remove(os.path.join(directory, 'store.json'))
+
+        arrays = dict(RASTER_ARRAYS)
+        if directional:
+            arrays.update(DIRECTIONAL_ARRAYS)
+        self.files = {
+            name: open(os.path.join(directory, '%s.bin' % name), 'wb')
+            for name in arrays
+        }
+        self.sizes = {name: 0 for name in arrays}
+        self.groups = []
+        self.n_members = 0
+        self.n_cells = 0
+        self.n_directional_cells = 0
+        self.n_history = 0
+
+        # offsets start at 0
+        self.write('member_offsets', np.zeros(1, dtype=np.int64))
+        if directional:
+            self.write('directional_member_offsets', np.zeros(1, dtype=np.int64))
+            self.write('history_offsets', np.zeros(1, dtype=np.int64))
+
+    def write(self, name, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype(name))
+        self.files[name].write(values.tobytes())
+        self.sizes[name] += len(values)
+
+    @staticmethod
+    def dtype(name):
+        if name in RASTER_ARRAYS:
+            return RASTER_ARRAYS[name]
+        return DIRECTIONAL_ARRAYS[name]
+
+    def add_group(self, group):
+        """
+        appends the "raster" (and "directional_raster") of every member
+        of group
+        """
+        for member in group.members:
+            raster = member['raster']
+            for name in ['cells', 'sum_weight', 'sum_unit_weight']:
+                self.write(name, raster[name])
+            self.n_cells += len(raster['cells'])
+            self.write('member_offsets', [self.n_cells])
+
+            if self.directional:
+                raster = member['directional_raster']
+                self.write('directional_cells', raster['cells'])
+                self.write('history_offsets', raster['offsets'][1:] + self.n_history)
+                self.write('weight_history', raster['weight_history'])
+                self.write('angle_history', raster['angle_history'])
+                self.n_directional_cells += len(raster['cells'])
+                self.n_history += len(raster['weight_history'])
+                self.write('directional_member_offsets', [self.n_directional_cells])
+
+        self.groups.append({
+            'long_raster_size': group.attributes['long_raster_size'],
+            'start': self.n_members,
+            'filenames': [m['filename'] for m in group.members],
+        })
+        self.n_members += len(group.members)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.directory, 'store.json'), 'w') as f:
+            json.dump(
+                {
+                    'version': STORE_VERSION,
+                    'directional': self.directional,
+                    'sizes': self.sizes,
+                    'groups': self.groups,
+                },
+                f,
+            )
+        logger.info('Wrote rasters of %d tracks in %d groups (%d cells) to %s' % (
+            self.n_members,
+            len(self.groups),
+            self.n_cells,
+            self.directory,
+        ))
+
+
+class RasterStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            info = json.load(f)
+        if info['version'] != STORE_VERSION:
+            raise ValueError(
+                'Raster store %s has version %s, expected %s' % (
+                    directory,
+                    info['version'],
+                    STORE_VERSION,
+                )
+            )
+        self.directional = info['directional']
+        self.groups = info['groups']
+
+        self.arrays = {}
+        for name, size in info['sizes'].items():
+            dtype = RasterStoreWriter.dtype(name)
+            if size == 0:
+                self.arrays[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.arrays[name] = np.memmap(
+                    os.path.join(directory, '%s.bin' % name),
+                    dtype=dtype,
+                    mode='r',
+                    shape=(size,),
+                )
+
+    def load_group_rasters(self, i, group, directional=False):
+        """
+        assigns "raster" (and "directional_raster") arrays to each member
+        of group, the i-th group written to the store; compact rasters
+        are views of the memory-mapped files, so only the pages that are
+        used are read
+        """
+        group_info = self.groups[i]
+        if group_info['filenames'] != [m['filename'] for m in group.members]:
+            raise ValueError('Group %d does not match group %d of raster store %s' % (
+                i,
+                i,
+                self.directory,
+            ))
+        if directional and not self.directional:
+            raise ValueError('Raster store %s has no directional rasters' % self.directory)
+
+        arrays = self.arrays
+        start = group_info['start']
+        for k, member in enumerate(group.members):
+            cell_start, cell_end = arrays['member_offsets'][start+k:start+k+2]
+            member['raster'] = {
+                name: arrays[name][cell_start:cell_end]
+                for name in ['cells', 'sum_weight', 'sum_unit_weight']
+            }
+            if not directional:
+                continue
+            cell_start, cell_end = arrays['directional_member_offsets'][start+k:start+k+2]
+            history_offsets = np.asarray(arrays['history_offsets'][cell_start:cell_end+1])
+            member['directional_raster'] = {
+                'cells': arrays['directional_cells'][cell_start:cell_end],
+                'offsets': history_offsets - history_offsets[0],
+                'weight_history': arrays['weight_history'][
+                    history_offsets[0]:history_offsets[-1]
+                ],
+                'angle_history': arrays['angle_history'][
+                    history_offsets[0]:history_offsets[-1]
+                ],
+            }
+
+
+def release_group_rasters(group):
+    """
+    removes the rasters of the members of group, so that their memory
+    (or mapped pages) can be freed
+    """
+    for member in group.members:
+        member.pop('raster', None)
+        member.pop('directional_raster', None)
@@ -0,0 +1,628 @@
+## service.py
+#
+# long-running similarity service: the groups and rasters of a corpus are
+# built (or loaded from a --save-state directory) once and kept in memory,
+# and the similarities of submitted tracks to the corpus are answered over
+# a local HTTP port or Unix socket
+#
+#   python3 service.py /some/directory/*.csv --port 8765 --ingest-dir /a/dir
+#
+# endpoints (all responses are JSON)
+#
+#   GET  /status          - numbers of tracks and groups, and settings
+#   POST /similarities    - similarities of the submitted track to every
+#                           corpus track with a nonzero similarity, most
+#                           similar first; ?top_k=N (at least 1) and
+#                           ?min_similarity=X limit them. similarities
+#                           that are not defined (e.g., directional
+#                           similarities of a track without angles) are
+#                           null
+#   POST /tracks?filename=NAME
+#                         - adds the submitted track to the corpus; it is
+#                           saved as NAME in --ingest-dir
+#
+# tracks are submitted as CSV (Content-Type: text/csv) in the layout of
+# the input files, or as a JSON object of column -> list of values. only
+# the position columns are needed for queries.
+#
+# requests are handled by a pool of --threads threads; queries run
+# concurrently, while ingesting a track waits for running queries and
+# blocks new ones. at most --queue-size requests wait for a thread, and
+# further requests are answered with 503.
+#
+# other arguments are passed on to tracksim.py, e.g. --cache-dir,
+# --previous-state or --add-directional-similarity
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import io
+import json
+import os
+import socketserver
+import stat
+import threading
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from calculate_similarity import calculate_directional_norms
+from calculate_similarity import calculate_directional_similarity
+from calculate_similarity import calculate_norms
+from calculate_similarity import calculate_similarity
+from calculate_similarity import has_intersection
+from calculate_similarity import get_weights_method
+import incremental
+import metrics
+import raster_engine
+import tracksim
+from utility import Clogger
+
+logger = Clogger('service.log')
+
+# largest request body accepted
+MAX_BODY_BYTES = 64 * 2 ** 20
+
+# name of submitted tracks in logs and metadata
+QUERY_NAME = '<query>'
+
+# tracksim options that the service does not support
+UNSUPPORTED_OPTIONS = [
+    'top_k',
+    'similarity_threshold',
+    'lsh',
+    'save_state',
+    'convert_to_store',
+    'rasterized_output_prefix',
+    'raster_store',
+]
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadWriteLock:
+    """
+    any number of readers or a single writer; waiting writers block new
+    readers, so ingestion is not starved by a stream of queries
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+def parse_track(body, content_type, required):
+    """
+    dataframe of a submitted track (CSV or JSON columns) with the columns
+    in required
+    """
+    try:
+        if content_type.startswith('text/csv'):
+            record = pd.read_csv(io.BytesIO(body))
+        else:
+            record = pd.DataFrame(json.loads(body.decode('utf-8')))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ServiceError(400, 'could not parse track: %s' % e)
+
+    missing = [col for col in required if col not in record.columns]
+    if missing:
+        raise ServiceError(400, 'missing columns %s' % ', '.join(missing))
+    if record.shape[0] == 0:
+        raise ServiceError(400, 'track has no rows')
+    return record.reset_index(drop=True)
+
+
+def query_record(record):
+    """
+    positions of a submitted track, with the columns get_metadata() needs
+    """
+    try:
+        lat = record['position_lat'].values.astype(np.float64)
+        long = record['position_long'].values.astype(np.float64)
+    except ValueError as e:
+        raise ServiceError(400, 'invalid positions: %s' % e)
+    return pd.DataFrame({
+        'position_lat': lat,
+        'position_long': long,
+        'timestamp': np.zeros(lat.shape[0], dtype=np.int64),
+        'distance': np.zeros(lat.shape[0], dtype=np.float32),
+    })
+
+
+class Corpus:
+    """
+    groups and rasters of the corpus tracks, guarded by a ReadWriteLock
+    """
+    def __init__(self, options):
+        self.options = options
+        self.config = options['raster_config']
+        self.directional = options['add_directional_similarity']
+        self.lock = ReadWriteLock()
+        self.groups = []
+
+    def n_tracks(self):
+        return sum(len(group.members) for group in self.groups)
+
+    def filenames(self):
+        return {m['filename'] for group in self.groups for m in group.members}
+
+    def build(self):
+        options = self.options
+        if options['previous_state']:
+            with metrics.stage('load_state'):
+                state = incremental.load_state(
+                    options['previous_state'],
+                    options,
+                    get_weights_method(),
+                )
+                for group in state['groups']:
+                    incremental.load_group_rasters(group, directional=self.directional)
+            self.groups = state['groups']
+            known = self.filenames()
+            new_files = [fn for fn in options['files'] if fn not in known]
+            with metrics.stage('load'):
+                data = tracksim.load_data(
+                    new_files,
+                    threads=options['load_threads'],
+                    track_stores=options['track_stores'],
+                )
+                new_files = [fn for fn in new_files if fn in data]
+                tracksim.filter_bad_data(new_files, data)
+            with metrics.stage('metadata'):
+                members = [
+                    tracksim.get_metadata(data[fn], fn, self.config)
+                    for fn in new_files
+                ]
+            self.add_members(members, data)
+        else:
+            cache = tracksim.make_cache(options)
+            data, metadata, grouper = tracksim.load_and_group(options, cache)
+            if self.directional:
+                with metrics.stage('add_directions'):
+                    tracksim.add_directions(data, options, metadata)
+            with metrics.stage('rasterize'):
+                tracksim.rasterize(data, grouper, options, cache=cache)
+            with metrics.stage('norms'):
+                calculate_norms(metadata, options)
+            if self.directional:
+                with metrics.stage('directional_rasterize'):
+                    tracksim.rasterize_directional(data, grouper, options, cache=cache)
+                with metrics.stage('directional_norms'):
+                    calculate_directional_norms(metadata, options)
+            if cache is not None:
+                with metrics.stage('cache_evict'):
+                    cache.evict()
+            self.groups = grouper.groups
+        logger.info('Corpus has %d tracks in %d groups' % (self.n_tracks(), len(self.groups)))
+
+    def add_members(self, members, data):
+        """
+        adds new members (metadata of the tracks in data), merging the
+        groups they connect; the caller holds the write lock (or the
+        corpus is not served yet)
+        """
+        groups = []
+        for group_indices, new_members in incremental.plan_merges(self.groups, members):
+            merged = [self.groups[i] for i in group_indices]
+            if len(merged) == 1 and not new_members:
+                groups.append(merged[0])
+                continue
+            group, _ = tracksim.merge_group(merged, new_members, data, self.options)
+            groups.append(group)
+        self.groups = groups
+
+    def query(self, record, top_k=None, min_similarity=0):
+        """
+        list of (filename, similarity, directional similarity or None) of
+        the corpus tracks with a nonzero similarity to record, most similar
+        first
+        """
+        query = tracksim.get_metadata(record, QUERY_NAME, self.config)
+        lat = record['position_lat'].values
+        long = record['position_long'].values
+        if self.directional:
+            angles = tracksim.track_angles(
+                lat,
+                long,
+                np.array([0, lat.shape[0]]),
+                np.array([query['cosine_lat']]),
+                self.config.angle_lag_seconds,
+            )
+
+        results = []
+        with self.lock.read():
+            for group in self.groups:
+                candidates = [m for m in group.members if has_intersection(m, query)]
+                if not candidates:
+                    continue
+                # the query is rasterized on the grid of each group it meets
+                long_raster_size = group.attributes['long_raster_size']
+                query['raster'] = raster_engine.rasterize_track(
+                    lat,
+                    long,
+                    long_raster_size,
+                    self.config,
+                )
+                calculate_norms({QUERY_NAME: query}, self.options)
+                if self.directional:
+                    query['directional_raster'] = raster_engine.rasterize_track_directional(
+                        lat,
+                        long,
+                        angles,
+                        long_raster_size,
+                        self.config,
+                    )
+                    calculate_directional_norms({QUERY_NAME: query}, self.options)
+
+                for member in candidates:
+                    # the query is treated as the later track of each pair
+                    similarity = calculate_similarity(member, query, self.options)
+                    if similarity <= 0 or similarity < min_similarity:
+                        continue
+                    directional_similarity = None
+                    if self.directional:
+                        directional_similarity = calculate_directional_similarity(
+                            member,
+                            query,
+                            self.options,
+                        )
+                    results.append((member['filename'], similarity, directional_similarity))
+                metrics.count('pairs', len(candidates))
+
+        results.sort(key=lambda r: -r[1])
+        if top_k is not None:
+            results = results[:top_k]
+        return results
+
+    def ingest(self, filename, record):
+        """
+        saves a track to filename and adds it to the corpus
+        """
+        with self.lock.write():
+            if filename in self.filenames() or os.path.exists(filename):
+                raise ServiceError(409, '%s already exists' % filename)
+            record.to_csv(filename, index=False)
+            try:
+                record = tracksim.load_track(filename)
+                member = tracksim.get_metadata(record, filename, self.config)
+            except (ValueError, TypeError) as e:
+                os.remove(filename)
+                raise ServiceError(400, 'invalid track: %s' % e)
+            self.add_members([member], {filename: record})
+            group = next(g for g in self.groups if member in g.members)
+        logger.info('Ingested %s (group of %d)' % (filename, len(group.members)))
+        return len(group.members)
+
+
+def json_number(x):
+    """
+    x as a float, or None (null) if it is not finite, e.g. the directional
+    similarity of a track without angles
+    """
+    x = float(x)
+    return x if np.isfinite(x) else None
+
+
+def json_body(content):
+    # NaN and infinity are not valid JSON
+    return json.dumps(content, allow_nan=False).encode('utf-8')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # connections are closed after each response (HTTP/1.0), so idle
+    # clients do not hold on to a thread
+    timeout = 60
+
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'local'
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+    def send_json(self, status, content):
+        self.send_body(status, json_body(content))
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise ServiceError(413, 'request body is larger than %d bytes' % MAX_BODY_BYTES)
+        return self.rfile.read(length)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            body = self.read_body() if method == 'POST' else b''
+            route = (method, url.path.rstrip('/'))
+            if route == ('GET', '/status'):
+                content = self.server.status()
+            elif route == ('POST', '/similarities'):
+                content = self.similarities(body, params)
+            elif route == ('POST', '/tracks'):
+                content = self.tracks(body, params)
+            else:
+                raise ServiceError(404, 'no endpoint %s %s' % (method, url.path))
+            # encoded here, so that a value JSON cannot represent is a 500
+            body = json_body(content)
+        except ServiceError as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+        except Exception as e:
+            logger.error('Error handling %s %s: %s' % (method, self.path, ascii(e)))
+            self.send_json(500, {'error': 'internal error'})
+            return
+        self.send_body(200, body)
+
+    def similarities(self, body, params):
+        try:
+            top_k = int(params['top_k']) if 'top_k' in params else None
+            min_similarity = float(params.get('min_similarity', 0))
+        except ValueError as e:
+            raise ServiceError(400, 'invalid parameter: %s' % e)
+        if top_k is not None and top_k < 1:
+            raise ServiceError(400, 'top_k must be at least 1')
+        if not np.isfinite(min_similarity):
+            raise ServiceError(400, 'min_similarity must be finite')
+        record = query_record(parse_track(
+            body,
+            self.headers.get('Content-Type', ''),
+            ['position_lat', 'position_long'],
+        ))
+        with metrics.stage('query'):
+            results = self.server.corpus.query(record, top_k, min_similarity)
+        metrics.count('queries')
+        rows = []
+        for filename, similarity, directional_similarity in results:
+            row = {'filename': filename, 'similarity': json_number(similarity)}
+            if directional_similarity is not None:
+                row['directional_similarity'] = json_number(directional_similarity)
+            rows.append(row)
+        return {'similarities': rows}
+
+    def tracks(self, body, params):
+        ingest_dir = self.server.ingest_dir
+        if ingest_dir is None:
+            raise ServiceError(403, 'ingesting tracks requires --ingest-dir')
+        name = os.path.basename(params.get('filename', ''))
+        if not name or name.startswith('.'):
+            raise ServiceError(400, 'a filename is required')
+        record = parse_track(
+            body,
+            self.headers.get('Content-Type', ''),
+            tracksim.REQUIRED_COLUMNS,
+        )
+        filename = os.path.join(ingest_dir, name)
+        with metrics.stage('ingest'):
+            group_size = self.server.corpus.ingest(filename, record)
+        metrics.count('tracks_ingested')
+        return {'filename': filename, 'group_size': group_size}
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+class RejectHandler(RequestHandler):
+    """
+    answers every request with a 503; the request is still read, so that
+    clients get the response instead of a reset connection
+    """
+    timeout = 5
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        while length > 0:
+            chunk = self.rfile.read(min(length, 2 ** 16))
+            if not chunk:
+                break
+            length -= len(chunk)
+        self.send_json(503, {'error': 'too many requests'})
+
+
+class BoundedPoolMixIn:
+    """
+    handles requests on a pool of threads, with at most queue_size
+    requests waiting for one; requests beyond that get a 503
+    """
+    # listen backlog; connections are accepted (and rejected if need be)
+    # as fast as they come, so this only has to absorb bursts
+    request_queue_size = 128
+
+    def init_pool(self, threads, queue_size):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+        # rejected requests are answered one at a time
+        self.rejector = ThreadPoolExecutor(max_workers=1)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.rejector.submit(self.reject_request, request, client_address)
+            return
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def reject_request(self, request, client_address):
+        metrics.count('requests_rejected')
+        try:
+            RejectHandler(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def status(self):
+        with self.corpus.lock.read():
+            return {
+                'tracks': self.corpus.n_tracks(),
+                'groups': len(self.corpus.groups),
+                'directional': self.corpus.directional,
+                'ingest': self.ingest_dir is not None,
+            }
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+        self.rejector.shutdown(wait=False)
+
+
+class SimilarityHTTPServer(BoundedPoolMixIn, HTTPServer):
+    pass
+
+
+class SimilarityUnixServer(BoundedPoolMixIn, socketserver.UnixStreamServer):
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def is_socket(path):
+    return stat.S_ISSOCK(os.stat(path).st_mode)
+
+
+def make_server(args, corpus):
+    if args.socket:
+        # a socket left by an earlier run is replaced, but nothing else
+        # (see get_args())
+        if os.path.exists(args.socket):
+            if not is_socket(args.socket):
+                raise ValueError('%s exists and is not a socket' % args.socket)
+            os.remove(args.socket)
+        server = SimilarityUnixServer(args.socket, RequestHandler)
+    else:
+        server = SimilarityHTTPServer((args.host, args.port), RequestHandler)
+    server.init_pool(args.threads, args.queue_size)
+    server.corpus = corpus
+    server.ingest_dir = args.ingest_dir
+    return server
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Serve similarities of submitted tracks to a corpus. '
+        'Other arguments are passed on to tracksim.py.',
+        allow_abbrev=False,
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument(
+        '--socket',
+        default=None,
+        help='Listen on this Unix socket instead of --host/--port',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=4,
+        help='Number of requests handled at once',
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=16,
+        help='Number of requests that can wait for a thread; more are '
+        'answered with 503',
+    )
+    parser.add_argument(
+        '--ingest-dir',
+        default=None,
+        help='Directory tracks added with POST /tracks are saved to. '
+        'Without it, tracks cannot be added.',
+    )
+    args, tracksim_args = parser.parse_known_args()
+    if args.threads < 1 or args.queue_size < 0:
+        parser.error('--threads must be at least 1 and --queue-size at least 0')
+    if args.socket and os.path.exists(args.socket) and not is_socket(args.socket):
+        parser.error('--socket %s exists and is not a socket' % args.socket)
+
+    options = tracksim.get_options(tracksim_args)
+    unsupported = [
+        name for name in UNSUPPORTED_OPTIONS
+        if options[name] is not None and options[name] is not False
+    ]
+    if unsupported:
+        parser.error('the service does not support %s' % ', '.join(unsupported))
+    if args.ingest_dir:
+        os.makedirs(args.ingest_dir, exist_ok=True)
+    return args, options
+
+
+if __name__ == '__main__':
+    args, options = get_args()
+
+    if options['metrics_output']:
+        metrics.enable(trace_memory=options['metrics_trace_memory'])
+
+    try:
+        corpus = Corpus(options)
+        corpus.build()
+        server = make_server(args, corpus)
+        logger.info('Serving on %s' % (args.socket or '%s:%d' % (args.host, args.port)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Shutting down')
+        finally:
+            server.server_close()
+    finally:
+        if options['metrics_output']:
+            metrics.write(options['metrics_output'])
+            logger.info('Wrote metrics to %s' % options['metrics_output'])
@@ -0,0 +1,365 @@
+## similarity_bounds.py
+#
+# cheap upper bounds of pair similarities, used to skip pairs that can't
+# reach a threshold (and by neighbours.py to skip pairs that can't be
+# among a track's top k)
+#
+# bounds, from cheapest to most expensive:
+#   * bbox       - pairs whose bboxes don't intersect are 0
+#   * cell_count - at most min(cells) cells are shared, each with at most
+#                  the largest weight of either track; this also bounds
+#                  the part of each norm that can overlap
+#   * weight     - largest weight of one track times the total weight of
+#                  the other
+#   * overlap    - Cauchy-Schwarz within shared coarse blocks
+#                  (COARSE_FACTOR x COARSE_FACTOR cells):
+#                  sum(a*b) <= sqrt(sum(a^2) * sum(b^2)), summed over
+#                  blocks with a sparse product like the similarities
+#
+# pairs left by the bounds are calculated with blocks of sparse matrix
+# products (see calculate_similarity.pair_similarities())
+
+import numpy as np
+
+from calculate_similarity import bbox_intersection_matrix
+from calculate_similarity import blocked_pair_values
+from calculate_similarity import calculate_directional_similarity
+from calculate_similarity import group_similarity_matrices
+from calculate_similarity import pair_similarities
+import metrics
+import raster_engine
+from utility import Clogger
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+logger = Clogger('similarity_bounds.log')
+
+# protects against bounds that are rounded below the similarity they bound
+BOUND_TOLERANCE = 1e-9
+
+# raster cells per side of the blocks used for overlap bounds
+COARSE_FACTOR = 8
+
+BOUND_NAMES = ['bbox', 'cell_count', 'weight', 'overlap']
+
+
+def member_bound_stats(members, center_wt=False):
+    """
+    per-member arrays used by the bounds
+
+    "a" is the first track's weight in a pair (sum_unit_weight if only
+    center weights are used), "b" the second track's (sum_weight)
+    """
+    a_stat = 'sum_unit_weight' if center_wt else 'sum_weight'
+    norm_stat = 'raster_unit_norm' if center_wt else 'raster_norm'
+    stats = {
+        'n_cells': [],
+        'a_max': [],
+        'a_sum': [],
+        'a_sum_sq': [],
+        'b_max': [],
+        'b_sum': [],
+        'b_sum_sq': [],
+        'norm': [],
+    }
+    coarse = []
+    for member in members:
+        raster = member['raster']
+        a = raster[a_stat].astype(np.float64)
+        b = raster['sum_weight'].astype(np.float64)
+        stats['n_cells'].append(len(a))
+        stats['a_max'].append(a.max() if len(a) else 0)
+        stats['a_sum'].append(a.sum())
+        stats['a_sum_sq'].append(np.sum(a ** 2))
+        stats['b_max'].append(b.max() if len(b) else 0)
+        stats['b_sum'].append(b.sum())
+        stats['b_sum_sq'].append(np.sum(b ** 2))
+        stats['norm'].append(member[norm_stat])
+        coarse.append(coarse_blocks(raster['cells'], a, b))
+    stats = {k: np.array(v, dtype=np.float64) for k, v in stats.items()}
+    stats['coarse'] = coarse
+    return stats
+
+
+def coarse_blocks(cells, a, b):
+    """
+    sorted blocks of a raster and the sums of squared weights in them
+    """
+    lat_bin, long_bin = raster_engine.unpack_cells(cells)
+    blocks, inverse = np.unique(
+        raster_engine.pack_cells(lat_bin // COARSE_FACTOR, long_bin // COARSE_FACTOR),
+        return_inverse=True,
+    )
+    a_sq = np.bincount(inverse.ravel(), weights=a ** 2, minlength=len(blocks))
+    b_sq = np.bincount(inverse.ravel(), weights=b ** 2, minlength=len(blocks))
+    return blocks, a_sq, b_sq
+
+
+def normalize_bound(stats, i, j, bound):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bound = bound / np.sqrt(stats['norm'][i] * stats['norm'][j])
+    # pairs with undefined bounds are always calculated
+    bound = np.where(np.isfinite(bound), bound, np.inf)
+    return bound * (1 + BOUND_TOLERANCE) + BOUND_TOLERANCE
+
+
+def cheap_bounds(stats, i, j, weights_method):
+    """
+    dict of the "cell_count" and "weight" bounds of pairs (i[k], j[k]);
+    inf if the weights function has no known bound
+    """
+    if weights_method not in ['product', 'smooth']:
+        return {
+            'cell_count': np.full(len(i), np.inf),
+            'weight': np.full(len(i), np.inf),
+        }
+
+    n_common = np.minimum(stats['n_cells'][i], stats['n_cells'][j])
+    a_max = stats['a_max'][i]
+    b_max = stats['b_max'][j]
+    a_sum_sq = stats['a_sum_sq'][i]
+    b_sum_sq = stats['b_sum_sq'][j]
+    # squared weights that can be in shared cells
+    a_shared_sq = np.minimum(a_sum_sq, n_common * a_max ** 2)
+    b_shared_sq = np.minimum(b_sum_sq, n_common * b_max ** 2)
+    cell_count = np.minimum(
+        n_common * a_max * b_max,
+        np.sqrt(a_shared_sq * b_shared_sq),
+    )
+    weight = np.minimum(
+        a_max * stats['b_sum'][j],
+        stats['a_sum'][i] * b_max,
+    )
+
+    if weights_method == 'smooth':
+        # ((a+b)/2)^2 = (a^2 + 2ab + b^2)/4
+        cell_count = np.minimum(
+            (a_shared_sq + 2 * cell_count + b_shared_sq) / 4,
+            n_common * ((a_max + b_max) / 2) ** 2,
+        )
+        weight = (a_shared_sq + 2 * weight + b_shared_sq) / 4
+
+    return {
+        'cell_count': normalize_bound(stats, i, j, cell_count),
+        'weight': normalize_bound(stats, i, j, weight),
+    }
+
+
+def overlap_bound(stats, i, j, weights_method):
+    """
+    upper bound of the similarity of (i, j) from their shared blocks
+    """
+    if weights_method not in ['product', 'smooth']:
+        return np.inf
+    blocks_i, a_sq, _ = stats['coarse'][i]
+    blocks_j, _, b_sq = stats['coarse'][j]
+    _, idx_i, idx_j = np.intersect1d(
+        blocks_i,
+        blocks_j,
+        assume_unique=True,
+        return_indices=True,
+    )
+    a_sq = a_sq[idx_i]
+    b_sq = b_sq[idx_j]
+    bound = np.sum(np.sqrt(a_sq * b_sq))
+    if weights_method == 'smooth':
+        bound = (np.sum(a_sq) + 2 * bound + np.sum(b_sq)) / 4
+    return normalize_bound(stats, i, j, bound)
+
+
+def coarse_matrices(stats, weights_method):
+    """
+    sparse blocks x members matrices of the coarse blocks of stats: the
+    square roots of the squared weights of the first ("a") and second
+    ("b") track in a pair and, for the smooth weights function, the
+    squared weights and indicators of the blocks
+    """
+    coarse = stats['coarse']
+    counts = [len(blocks) for blocks, _, _ in coarse]
+    _, rows = np.unique(
+        np.concatenate([blocks for blocks, _, _ in coarse]),
+        return_inverse=True,
+    )
+    rows = rows.ravel()
+    cols = np.repeat(np.arange(len(coarse)), counts)
+    shape = (rows.max() + 1 if len(rows) else 0, len(coarse))
+    make = lambda values: sparse.csc_matrix((values, (rows, cols)), shape=shape)
+
+    a_sq = np.concatenate([a for _, a, _ in coarse])
+    b_sq = np.concatenate([b for _, _, b in coarse])
+    matrices = {'a': make(np.sqrt(a_sq)), 'b': make(np.sqrt(b_sq))}
+    if weights_method == 'smooth':
+        matrices['a_sq'] = make(a_sq)
+        matrices['b_sq'] = make(b_sq)
+        matrices['indicator'] = make(np.ones_like(a_sq))
+    return matrices
+
+
+def overlap_bounds(stats, i, j, weights_method):
+    """
+    overlap_bound() of the pairs (i[k], j[k]), from blocks of sparse
+    products of the coarse_matrices() (one pair at a time without scipy)
+    """
+    if weights_method not in ['product', 'smooth']:
+        return np.full(len(i), np.inf)
+    if sparse is None:
+        return np.array([
+            overlap_bound(stats, i_k, j_k, weights_method)
+            for i_k, j_k in zip(i.tolist(), j.tolist())
+        ])
+
+    matrices = coarse_matrices(stats, weights_method)
+
+    def block_bounds(rows, cols):
+        product = lambda x, y: (matrices[x][:, rows].T @ matrices[y][:, cols]).toarray()
+        bound = product('a', 'b')
+        if weights_method == 'smooth':
+            bound = (product('a_sq', 'indicator') + 2 * bound + product('indicator', 'b_sq')) / 4
+        return bound
+
+    return normalize_bound(stats, i, j, blocked_pair_values(i, j, block_bounds))
+
+
+def new_counters():
+    counters = {name: 0 for name in BOUND_NAMES}
+    counters['pairs'] = 0
+    counters['calculated'] = 0
+    return counters
+
+
+def pair_bounds(members, weights_method, threshold=-np.inf, options={}, counters=None):
+    """
+    pairs (i, j), i < j, of members whose bounds are >= threshold, in
+    row-major order, with their tightest bound
+
+    counters[name] is increased by the number of pairs pruned by each
+    bound (a pair is counted under the first bound that prunes it)
+    """
+    if counters is None:
+        counters = new_counters()
+    n_members = len(members)
+    n_pairs = n_members * (n_members - 1) // 2
+    counters['pairs'] += n_pairs
+    if n_members < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+
+    i_idx, j_idx = np.nonzero(np.triu(bbox_intersection_matrix(members), 1))
+    counters['bbox'] += n_pairs - len(i_idx)
+
+    stats = member_bound_stats(members, options.get('weight_center_only', False))
+    bounds = np.full(len(i_idx), np.inf)
+    keep = np.ones(len(i_idx), dtype=bool)
+    for name, bound in cheap_bounds(stats, i_idx, j_idx, weights_method).items():
+        bounds = np.minimum(bounds, bound)
+        pruned = keep & (bound < threshold)
+        counters[name] += int(np.sum(pruned))
+        keep &= ~pruned
+    i_idx = i_idx[keep]
+    j_idx = j_idx[keep]
+    bounds = bounds[keep]
+
+    bounds = np.minimum(bounds, overlap_bounds(stats, i_idx, j_idx, weights_method))
+    keep = bounds >= threshold
+    counters['overlap'] += int(np.sum(~keep))
+
+    return i_idx[keep], j_idx[keep], bounds[keep]
+
+
+def record_counters(counters, prefix=''):
+    """
+    adds the pair counters of the bounds to the run's metrics
+    """
+    for name, n in counters.items():
+        if name == 'pairs':
+            metric = 'pairs'
+        elif name == 'bbox':
+            metric = 'pairs_skipped_by_bbox'
+        elif name in BOUND_NAMES or name == 'heap':
+            metric = 'pairs_pruned_by_%s' % name
+        else:
+            metric = 'pairs_%s' % name
+        metrics.count(prefix + metric, n)
+
+
+def format_counters(counters):
+    return '%d pairs, pruned %s, %d calculated' % (
+        counters['pairs'],
+        ', '.join('%d by %s' % (counters[name], name) for name in BOUND_NAMES),
+        counters['calculated'],
+    )
+
+
+def calculate_similarities_threshold(
+        grouper,
+        threshold,
+        weights_method,
+        options={},
+        similarities=None,
+):
+    """
+    similarities >= threshold of pairs within groups, keyed like
+    calculate_similarity.calculate_similarities(); pairs whose bounds are
+    below the threshold are not calculated, and no pairs below the
+    threshold are included
+    """
+    logger.info('Calculating similarities >= %s...' % threshold)
+    if similarities is None:
+        similarities = {}
+    counters = new_counters()
+    counters['below_threshold'] = 0
+    for group in grouper.groups:
+        members = group.members
+        n_members = len(members)
+        i_idx, j_idx, _ = pair_bounds(members, weights_method, threshold, options, counters)
+        # self-pairs are always calculated
+        i_idx = np.concatenate([i_idx, np.arange(n_members)])
+        j_idx = np.concatenate([j_idx, np.arange(n_members)])
+        order = np.lexsort((j_idx, i_idx))
+        i_idx = i_idx[order]
+        j_idx = j_idx[order]
+        counters['pairs'] += n_members
+
+        # the pairs left by the bounds are calculated together with
+        # sparse matrix products
+        group_similarities = pair_similarities(
+            members,
+            i_idx,
+            j_idx,
+            group_similarity_matrices(members, options),
+            options,
+        )
+        counters['calculated'] += len(i_idx)
+        above = group_similarities >= threshold
+        counters['below_threshold'] += int(np.sum(~above))
+        for i, j, similarity in zip(
+                i_idx[above].tolist(),
+                j_idx[above].tolist(),
+                group_similarities[above].tolist(),
+        ):
+            similarities[(members[i]['filename'], members[j]['filename'])] = similarity
+
+    logger.debug('Similarity threshold: %s' % format_counters(counters))
+    logger.debug('%d calculated pairs were below the threshold' % counters['below_threshold'])
+    record_counters(counters)
+    return similarities
+
+
+def calculate_pair_directional_similarities(grouper, pairs, options={}):
+    """
+    directional similarities of (filename1, filename2) pairs
+    """
+    members = {m['filename']: m for g in grouper.groups for m in g.members}
+    similarities = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for fn1, fn2 in pairs:
+            similarities[(fn1, fn2)] = calculate_directional_similarity(
+                members[fn1],
+                members[fn2],
+                options,
+            )
+    metrics.count('directional_pairs', len(similarities))
+    return similarities
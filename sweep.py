@@ -0,0 +1,307 @@
+## sweep.py
+#
+# similarities of the same tracks for several raster configs, loading the
+# input files and adding directions only once
+#
+#   python3 sweep.py --grid grid.json /some/directory/*.csv \
+#       --output-filename /an/output/file.csv --workers 4
+#
+# the grid is a JSON object of constant -> list of values, whose
+# combinations are all run, e.g.
+#
+#   {"RASTER_SIZE_M": [30, 40], "RASTER_MANHATTAN_DISTANCE_MAX": [3, 4]}
+#
+# or a JSON list of objects of constant -> value, one per config. other
+# arguments are passed on to tracksim.py and set the defaults of every
+# config.
+#
+# configs with the same raster size, maximum manhattan distance and
+# segment setting (see RasterConfig.stencil_key) have the same bboxes,
+# groups and raster cells, so they are grouped and rasterized together:
+# each track is expanded into its raster cells once, and only the weights
+# and cooldown scan are repeated for each config. tracks are spread over
+# --workers processes.
+#
+# config i is written to <output>_<i>.csv, and <output>_sweep.csv lists
+# the parameters of each config. the raster cache is not used.
+
+import argparse
+from itertools import product
+import json
+import os
+
+import pandas as pd
+
+import metrics
+import raster_engine
+from raster_config import CONSTANT_FIELDS
+import tracksim
+from utility import Clogger
+
+logger = Clogger('sweep.log')
+
+# constants that can vary within a sweep; directions (ANGLE_LAG_SECONDS)
+# are only calculated once
+SWEEP_CONSTANTS = [
+    name for name in CONSTANT_FIELDS
+    if name != 'ANGLE_LAG_SECONDS'
+]
+
+# tracksim options that a sweep does not support
+UNSUPPORTED_OPTIONS = [
+    'top_k',
+    'similarity_threshold',
+    'lsh',
+    'save_state',
+    'previous_state',
+    'convert_to_store',
+    'rasterized_output_prefix',
+    'raster_store',
+]
+
+
+def load_grid(filename):
+    """
+    list of dicts of constant -> value, one per config
+    """
+    with open(filename) as f:
+        grid = json.load(f)
+
+    if isinstance(grid, dict):
+        names = list(grid)
+        for name in names:
+            if not isinstance(grid[name], list) or not grid[name]:
+                raise ValueError('values of %s must be a non-empty list' % name)
+        overrides = [dict(zip(names, values)) for values in product(*grid.values())]
+    elif isinstance(grid, list) and all(isinstance(x, dict) for x in grid):
+        overrides = grid
+    else:
+        raise ValueError('the grid must be an object of lists or a list of objects')
+
+    if not overrides:
+        raise ValueError('the grid has no configs')
+    for config_overrides in overrides:
+        unknown = sorted(set(config_overrides) - set(SWEEP_CONSTANTS))
+        if unknown:
+            raise ValueError(
+                'cannot sweep %s; valid constants are %s' % (
+                    ', '.join(unknown),
+                    ', '.join(SWEEP_CONSTANTS),
+                )
+            )
+    return overrides
+
+
+def config_families(configs):
+    """
+    dict of stencil_key -> indices of the configs that share it
+    """
+    families = {}
+    for i, config in enumerate(configs):
+        families.setdefault(config.stencil_key, []).append(i)
+    return families
+
+
+def config_filename(output_filename, i):
+    root, ext = os.path.splitext(output_filename)
+    return '%s_%s%s' % (root, i, ext or '.csv')
+
+
+def rasterize_family(data, grouper, configs, workers=1, directional=False):
+    """
+    rasters of every member of grouper for each of configs (which share
+    a stencil_key); returns the members, and per member a list of compact
+    rasters and a list of directional rasters (or None), one per config
+    """
+    stencil = raster_engine.make_stencil(configs[0].manhattan_distance_max)
+    members = []
+    args_list = []
+    for group in grouper.groups:
+        for member in group.members:
+            record = data[member['filename']]
+            members.append(member)
+            args_list.append((
+                record['position_lat'].values,
+                record['position_long'].values,
+                group.attributes['long_raster_size'],
+                configs,
+                record['angle'].values if directional else None,
+                stencil,
+            ))
+
+    results = raster_engine.map_tracks(
+        raster_engine.rasterize_track_configs,
+        args_list,
+        workers=workers,
+    )
+
+    metrics.count('points_rasterized', sum(len(args[0]) for args in args_list))
+    metrics.count('cells_created', sum(
+        len(raster['cells'])
+        for rasters, _ in results
+        for raster in rasters
+    ))
+    return members, results
+
+
+def run_config(data, grouper, metadata, options):
+    """
+    norms, similarities and output of one config whose rasters are
+    already assigned to the members of grouper
+    """
+    directional = options['add_directional_similarity']
+    with metrics.stage('norms'):
+        tracksim.calculate_norms(metadata, options)
+    with metrics.stage('similarities'):
+        writer = None if directional else tracksim.ResultWriter(options, grouper)
+        similarity_data = tracksim.calculate_similarities(
+            data,
+            grouper,
+            options,
+            similarities=writer,
+        )
+
+    directional_similarity_data = None
+    if directional:
+        with metrics.stage('directional_norms'):
+            tracksim.calculate_directional_norms(metadata, options)
+        with metrics.stage('directional_similarities'):
+            directional_similarity_data = tracksim.calculate_directional_similarities(
+                data,
+                grouper,
+                options,
+            )
+
+    with metrics.stage('write'):
+        tracksim.write_results_to_disk(
+            similarity_data,
+            directional_similarity_data,
+            options,
+            grouper,
+            writer=writer,
+        )
+
+
+def main_sweep(options, overrides):
+    """
+    runs every config of overrides (see load_grid()) on options['files'];
+    returns the index of configs and their output files
+    """
+    base = options['raster_config']
+    configs = [base.override(config_overrides) for config_overrides in overrides]
+    directional = options['add_directional_similarity']
+
+    with metrics.stage('load'):
+        data = tracksim.load_data(
+            options['files'],
+            threads=options['load_threads'],
+            track_stores=options['track_stores'],
+        )
+        tracksim.filter_bad_data(options['files'], data)
+    options['files'] = [fn for fn in options['files'] if fn in data]
+
+    families = config_families(configs)
+    logger.info('Running %d configs in %d families' % (len(configs), len(families)))
+    for n, (family, indices) in enumerate(families.items()):
+        family_configs = [configs[i] for i in indices]
+        logger.info('Rasterizing family %s (%d configs)' % (ascii(family), len(indices)))
+        # bboxes and groups only depend on the stencil_key
+        with metrics.stage('metadata'):
+            metadata = {
+                fn: tracksim.get_metadata(data[fn], fn, family_configs[0])
+                for fn in options['files']
+            }
+        # directions do not depend on the config, so they are only added
+        # once, with the first family's metadata
+        if directional and n == 0:
+            logger.info('Adding directions')
+            with metrics.stage('add_directions'):
+                tracksim.add_directions(data, options, metadata)
+        with metrics.stage('grouping'):
+            grouper = tracksim.GroupProcessor(metadata=metadata, config=family_configs[0])
+        grouper.print_group_sizes()
+
+        with metrics.stage('rasterize'):
+            members, results = rasterize_family(
+                data,
+                grouper,
+                family_configs,
+                workers=options['workers'],
+                directional=directional,
+            )
+
+        for k, i in enumerate(indices):
+            logger.info('Calculating similarities of config %d' % i)
+            for member, (rasters, directional_rasters) in zip(members, results):
+                member['raster'] = rasters[k]
+                if directional:
+                    member['directional_raster'] = directional_rasters[k]
+            config_options = dict(
+                options,
+                raster_config=configs[i],
+                output_filename=config_filename(options['output_filename'], i),
+            )
+            run_config(data, grouper, metadata, config_options)
+
+    index = pd.DataFrame([
+        dict(
+            config=i,
+            output_filename=config_filename(options['output_filename'], i),
+            **{
+                name: json.dumps(list(value)) if isinstance(value, tuple) else value
+                for name, value in config.to_constants().items()
+            }
+        )
+        for i, config in enumerate(configs)
+    ])
+    index_filename = config_filename(options['output_filename'], 'sweep')
+    index.to_csv(index_filename, index=False)
+    logger.info('Wrote index of configs to %s' % index_filename)
+    return index
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Calculate similarities for several raster configs. '
+        'Other arguments are passed on to tracksim.py.',
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        '--grid',
+        required=True,
+        help='JSON file of raster constants to sweep: an object of lists of '
+        'values (all combinations are run) or a list of objects (one per config)',
+    )
+    args, tracksim_args = parser.parse_known_args()
+    try:
+        overrides = load_grid(args.grid)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    options = tracksim.get_options(tracksim_args)
+    unsupported = [
+        name for name in UNSUPPORTED_OPTIONS
+        if options[name] is not None and options[name] is not False
+    ]
+    if unsupported:
+        parser.error('sweeps do not support %s' % ', '.join(unsupported))
+    try:
+        for config_overrides in overrides:
+            options['raster_config'].override(config_overrides)
+    except (TypeError, ValueError) as e:
+        parser.error(str(e))
+    return options, overrides
+
+
+if __name__ == '__main__':
+    options, overrides = get_args()
+
+    if options['metrics_output']:
+        metrics.enable(trace_memory=options['metrics_trace_memory'])
+
+    try:
+        main_sweep(options, overrides)
+    finally:
+        if options['metrics_output']:
+            metrics.write(options['metrics_output'])
+            logger.info('Wrote metrics to %s' % options['metrics_output'])
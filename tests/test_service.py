@@ -0,0 +1,101 @@
+## test_service.py
+#
+# responses of the similarity service to queries whose similarities are
+# not all defined
+#
+#   python3 -m pytest tests
+
+from http.client import HTTPConnection
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.generate import write_tracks
+import service
+import tracksim
+
+
+def strict_json(body):
+    # like json.loads(), but NaN and infinity are errors
+    def reject(token):
+        raise ValueError('invalid JSON token %s' % token)
+    return json.loads(body, parse_constant=reject)
+
+
+class DirectionalServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp(prefix='tracksim_test_')
+        files = write_tracks(
+            os.path.join(cls.work_dir, 'tracks'),
+            {'loops': 2, 'out_and_backs': 2, 'corridors': 2, 'repeats': 2, 'areas': 1},
+        )
+        options = tracksim.get_options(files + ['--add-directional-similarity'])
+        cls.corpus = service.Corpus(options)
+        cls.corpus.build()
+        cls.server = service.SimilarityHTTPServer(('127.0.0.1', 0), service.RequestHandler)
+        cls.server.init_pool(2, 2)
+        cls.server.corpus = cls.corpus
+        cls.server.ingest_dir = None
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        # a point of the first track, so that the query meets its group
+        record = tracksim.load_track(files[0])
+        cls.point = {
+            'position_lat': [float(record['position_lat'].iloc[0])],
+            'position_long': [float(record['position_long'].iloc[0])],
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def post(self, path, content):
+        connection = HTTPConnection(*self.server.server_address, timeout=60)
+        try:
+            connection.request(
+                'POST',
+                path,
+                body=json.dumps(content),
+                headers={'Content-Type': 'application/json'},
+            )
+            response = connection.getresponse()
+            return response.status, response.read().decode('utf-8')
+        finally:
+            connection.close()
+
+    def test_single_point_query_is_valid_json(self):
+        # a single point has no angle, so its directional similarities
+        # are not defined
+        status, body = self.post('/similarities', self.point)
+        self.assertEqual(status, 200)
+        rows = strict_json(body)['similarities']
+        self.assertTrue(rows)
+        for row in rows:
+            self.assertIsNone(row['directional_similarity'])
+
+    def test_invalid_parameters(self):
+        for query in ['top_k=0', 'top_k=-1', 'min_similarity=nan', 'min_similarity=inf']:
+            status, body = self.post('/similarities?' + query, self.point)
+            self.assertEqual(status, 400, query)
+            self.assertIn('error', strict_json(body))
+
+    def test_non_finite_values_are_not_encoded(self):
+        with self.assertRaises(ValueError):
+            service.json_body({'similarity': float('nan')})
+        self.assertIsNone(service.json_number(float('nan')))
+        self.assertEqual(service.json_number(0.5), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+## track_store.py
+#
+# columnar on-disk store of many tracks
+#
+# every column is a single flat binary file of all tracks' values
+# concatenated, read with np.memmap; index.csv maps each track's original
+# filename to its [start, end) row range and a hash of its contents. this
+# avoids parsing a CSV for every track on every run.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utility import Clogger
+
+logger = Clogger('track_store.log')
+
+STORE_VERSION = 1
+
+STORE_COLUMNS = {
+    'position_lat': np.float64,
+    'position_long': np.float64,
+    'timestamp': np.int64,
+    'distance': np.float64,
+}
+
+
+def is_track_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'store.json'))
+
+
+def track_hash(record):
+    h = hashlib.sha1()
+    for col in STORE_COLUMNS:
+        h.update(np.ascontiguousarray(record[col].values).tobytes())
+    return h.hexdigest()
+
+
+def to_store_columns(record):
+    """
+    converts a loaded track to the store's column types; timestamps that
+    are not integers are converted to seconds since the epoch
+    """
+    columns = {}
+    for col, dtype in STORE_COLUMNS.items():
+        values = record[col]
+        if col == 'timestamp' and not pd.api.types.is_integer_dtype(values):
+            values = pd.to_datetime(values).astype('int64') // 10 ** 9
+        columns[col] = np.asarray(values, dtype=dtype)
+    return pd.DataFrame(columns)
+
+
+class TrackStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            info = json.load(f)
+        if info['version'] != STORE_VERSION:
+            raise ValueError(
+                'Track store %s has version %s, expected %s' % (
+                    directory,
+                    info['version'],
+                    STORE_VERSION,
+                )
+            )
+
+        self.columns = {}
+        for col in STORE_COLUMNS:
+            if info['n_rows'] == 0:
+                self.columns[col] = np.zeros(0, dtype=STORE_COLUMNS[col])
+            else:
+                self.columns[col] = np.memmap(
+                    os.path.join(directory, '%s.bin' % col),
+                    dtype=STORE_COLUMNS[col],
+                    mode='r',
+                    shape=(info['n_rows'],),
+                )
+
+        index = pd.read_csv(os.path.join(directory, 'index.csv'))
+        self.index = {
+            fn: (start, end)
+            for fn, start, end in zip(
+                index['filename'],
+                index['start'].tolist(),
+                index['end'].tolist(),
+            )
+        }
+        self.hashes = dict(zip(index['filename'], index['hash']))
+
+    def names(self):
+        return list(self.index.keys())
+
+    def load(self, fn):
+        """
+        DataFrame of a track whose columns are views of the memory-mapped
+        columns (pandas may still copy them when consolidating)
+        """
+        start, end = self.index[fn]
+        return pd.DataFrame(
+            {col: values[start:end] for col, values in self.columns.items()},
+            copy=False,
+        )
+
+
+class TrackStoreWriter:
+    """
+    appends tracks to a new store; call close() to write the index
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, 'store.json')):
+            os.remove(os.path.join(directory, 'store.json'))
+        self.files = {
+            col: open(os.path.join(directory, '%s.bin' % col), 'wb')
+            for col in STORE_COLUMNS
+        }
+        self.index = []
+        self.n_rows = 0
+
+    def add(self, fn, record):
+        record = to_store_columns(record)
+        for col, f in self.files.items():
+            f.write(record[col].values.tobytes())
+        self.index.append({
+            'filename': fn,
+            'start': self.n_rows,
+            'end': self.n_rows + record.shape[0],
+            'hash': track_hash(record),
+        })
+        self.n_rows += record.shape[0]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        pd.DataFrame(
+            self.index,
+            columns=['filename','start','end','hash'],
+        ).to_csv(os.path.join(self.directory, 'index.csv'), index=False)
+        # written last: a store without it is not recognized
+        with open(os.path.join(self.directory, 'store.json'), 'w') as f:
+            json.dump(
+                {
+                    'version': STORE_VERSION,
+                    'n_rows': self.n_rows,
+                    'columns': {col: np.dtype(t).str for col, t in STORE_COLUMNS.items()},
+                },
+                f,
+            )
+        logger.info('Wrote %d tracks (%d rows) to %s' % (len(self.index), self.n_rows, self.directory))
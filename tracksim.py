@@ -17,6 +17,9 @@ import sys
 import argparse
 import pandas as pd
 import re
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from copy import copy
 
 from utility import Clogger
@@ -30,8 +33,27 @@ from calculate_similarity import calculate_directional_similarities
 from calculate_similarity import calculate_norms
 from calculate_similarity import calculate_directional_norms
 from calculate_similarity import set_weights_func
+from calculate_similarity import get_weights_method
+from calculate_similarity import calculate_similarity
+from calculate_similarity import calculate_directional_similarity
+from calculate_similarity import has_intersection
 
+from group_clusters import Group
 from group_clusters import GroupProcessor
+import incremental
+import lsh
+import metrics
+from raster_config import RasterConfig
+from raster_config import get_config
+from neighbours import calculate_neighbours
+from neighbours import calculate_neighbour_directional_similarities
+from raster_cache import RasterCache
+import raster_store
+from similarity_bounds import calculate_pair_directional_similarities
+from similarity_bounds import calculate_similarities_threshold
+from track_store import TrackStore
+from track_store import TrackStoreWriter
+from track_store import is_track_store
 
 logger = Clogger('calculate_similarities.log')
 
@@ -39,7 +61,22 @@ logger.debug('initialized logger')
 
 PI=np.pi
 
-def get_options():
+# options that need the rasters or similarities of every group at once,
+# which --raster-store does not keep
+OUT_OF_CORE_UNSUPPORTED_OPTIONS = [
+    'top_k',
+    'similarity_threshold',
+    'lsh',
+    'save_state',
+    'previous_state',
+    'convert_to_store',
+    'rasterized_output_prefix',
+]
+
+def get_options(args=None):
+    """
+    parses command-line arguments (or the list args) into the options dict
+    """
     parser = argparse.ArgumentParser(
         description='Get similarities between gps-type tracks'
     )
@@ -47,7 +84,17 @@ def get_options():
     parser.add_argument(
         'files',
         nargs='+',
-        help='Input files'
+        help='Input files. Directories created with --convert-to-store '
+        'are expanded to the tracks they contain.'
+    )
+
+    parser.add_argument(
+        '--convert-to-store',
+        default=None,
+        required=False,
+        help='Instead of calculating similarities, convert the input files '
+        'to a columnar track store in this directory, which can be used as '
+        'input later'
     )
 
     parser.add_argument(
@@ -95,6 +142,82 @@ def get_options():
     '''
     
 
+    parser.add_argument(
+        '--sparse-output',
+        action='store_true',
+        help='Only write pairs of tracks in the same group. Pairs that are '
+        'missing from the output have a similarity of 0.'
+    )
+
+    parser.add_argument(
+        '--top-k',
+        type=int,
+        default=None,
+        help='Instead of all pairs, write the K most similar tracks of '
+        'each track'
+    )
+
+    parser.add_argument(
+        '--min-similarity',
+        type=float,
+        default=0.0,
+        help='Minimum similarity of neighbours written with --top-k'
+    )
+
+    parser.add_argument(
+        '--similarity-threshold',
+        type=float,
+        default=None,
+        help='Only write pairs with at least this similarity. Pairs that '
+        'cannot reach it are not calculated'
+    )
+
+    parser.add_argument(
+        '--lsh',
+        action='store_true',
+        help='Only calculate similarities of candidate pairs found with '
+        'MinHash signatures of raster cells; other pairs are 0'
+    )
+
+    parser.add_argument(
+        '--lsh-num-perm',
+        type=int,
+        default=128,
+        help='Number of hash functions in each MinHash signature'
+    )
+
+    parser.add_argument(
+        '--lsh-bands',
+        type=int,
+        default=64,
+        help='Number of bands MinHash signatures are split into. More bands '
+        'find more pairs with little overlap, at the cost of speed'
+    )
+
+    parser.add_argument(
+        '--lsh-recall-sample',
+        type=int,
+        default=0,
+        help='Number of random pairs used to estimate the recall of --lsh. '
+        'Off by default, since each sampled pair is calculated exactly'
+    )
+
+    parser.add_argument(
+        '--metrics-output',
+        default=None,
+        required=False,
+        help='File to write the time and memory use of each stage of the run, '
+        'and counts of points, cells and pairs, to. CSV if the name ends '
+        'with .csv, JSON otherwise.'
+    )
+
+    parser.add_argument(
+        '--metrics-trace-memory',
+        action='store_true',
+        help='Also record python memory allocations of each stage with '
+        'tracemalloc in --metrics-output (slows the run down)',
+    )
+
     parser.add_argument(
         '--no-filter',
         help='Do not filter out input filenames',
@@ -122,6 +245,88 @@ def get_options():
         'recommended if used with "--map-filename"'
     )
 
+    parser.add_argument(
+        '--raster-engine',
+        choices=['numpy','python'],
+        default='numpy',
+        help='Engine used for (non-directional) rasterization. "numpy" '
+        'expands all points at once and produces the same weights as '
+        'the original "python" implementation, only faster.'
+    )
+
+    parser.add_argument(
+        '--load-threads',
+        type=int,
+        default=4,
+        help='Number of threads used to load input files'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes used to rasterize tracks'
+    )
+
+    parser.add_argument(
+        '--similarity-engine',
+        choices=['sparse','python'],
+        default='sparse',
+        help='Engine used for (non-directional) similarities. "sparse" '
+        'computes all pairs of a group with sparse matrix products '
+        '(requires scipy); "python" compares each pair separately. '
+        'Options that "sparse" does not support fall back to "python".'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='Directory of cached metadata and rasters, keyed by file '
+        'contents and raster parameters. Without it, nothing is cached'
+    )
+
+    parser.add_argument(
+        '--cache-max-mb',
+        type=float,
+        default=1024,
+        help='Maximum size of the cache directory in MB. Least recently '
+        'used entries are removed after each run.'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read from or write to the raster cache, even with '
+        '--cache-dir'
+    )
+
+    parser.add_argument(
+        '--raster-store',
+        default=None,
+        required=False,
+        help='Out-of-core mode: rasterize one group at a time into a '
+        'memory-mapped store in this directory, then calculate similarities '
+        'from it group by group, so that only the tracks and rasters of one '
+        'group are in memory at once'
+    )
+
+    parser.add_argument(
+        '--save-state',
+        default=None,
+        required=False,
+        help='Directory to save groups, rasters, norms and similarities to, '
+        'so that tracks can be added later with --previous-state'
+    )
+
+    parser.add_argument(
+        '--previous-state',
+        default=None,
+        required=False,
+        help='Directory saved with --save-state by a previous run. Only input '
+        'files that are not part of it are loaded, and only pairs involving '
+        'them (or groups they connect) are calculated.'
+    )
+
     parser.add_argument(
         '--rasterized-output-prefix',
         default=None,
@@ -193,17 +398,70 @@ def get_options():
         'First should be 1 if provided.',
         dest='CUSTOM_RASTER_PROFILE',
     )
+
+    parser.add_argument(
+        '--raster-segments',
+        action='store_true',
+        default=None,
+        help='Also rasterize the cells crossed between consecutive points, '
+        'so that tracks with sparse or downsampled points have no gaps',
+        dest='RASTER_SEGMENTS',
+    )
+
+    parser.add_argument(
+        '--raster-segment-max-cells',
+        type=int,
+        default=None,
+        help='Segments crossing more cells than this are treated as gaps '
+        'by --raster-segments, e.g. jumps to glitched points',
+        dest='RASTER_SEGMENT_MAX_CELLS',
+    )
         
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
+
+    if args.top_k is not None:
+        if args.top_k < 1:
+            parser.error('--top-k must be at least 1')
+        if args.save_state or args.previous_state:
+            parser.error('--top-k cannot be used with --save-state or --previous-state')
+        if args.lsh:
+            parser.error('--top-k cannot be used with --lsh')
+    if args.similarity_threshold is not None:
+        if args.top_k is not None or args.lsh:
+            parser.error('--similarity-threshold cannot be used with --top-k or --lsh')
+        if args.save_state or args.previous_state:
+            parser.error(
+                '--similarity-threshold cannot be used with --save-state or --previous-state'
+            )
+    if args.lsh and (args.lsh_bands < 1 or args.lsh_num_perm % args.lsh_bands != 0):
+        parser.error('--lsh-num-perm must be a multiple of --lsh-bands')
+    if args.raster_store:
+        unsupported = [
+            '--%s' % name.replace('_', '-')
+            for name in OUT_OF_CORE_UNSUPPORTED_OPTIONS
+            if getattr(args, name) not in [None, False]
+        ]
+        if unsupported:
+            parser.error('--raster-store cannot be used with %s' % ', '.join(unsupported))
 
     options = vars(args)
 
-    update_constants(options)
-            
+    try:
+        options['raster_config'] = RasterConfig.from_options(options)
+    except ValueError as e:
+        parser.error(str(e))
+    log_raster_config(options['raster_config'])
+
+    # pairs in different groups are always 0, so they can be left out;
+    # --lsh and --similarity-threshold leave out other pairs too
+    options['add_inter_group_pairs'] = (
+        not options['sparse_output'] and
+        options['similarity_threshold'] is None and
+        not options['lsh']
+    )
 
-    # this should be true always
-    options['add_inter_group_pairs'] = True
+    expand_track_stores(options)
 
     # filter out start/lap files
     if not options['no_filter']:
@@ -217,31 +475,36 @@ def get_options():
         options['files'] = options['files'][:options['head']]
 
     if options['weight_smooth']:
-        set_weights_func(lambda x, y: ((x+y)/2) ** 2)
+        set_weights_func(c.WEIGHTS_FUNCTIONS['smooth'], method='smooth')
     
     return options
 
-def update_constants(options):
-    # lazy way of updating constants
-    # I don't advise this method in general
-    # it might be better to just have a class in the future
-    # that can update its own values...
-    for opt in dir(c):
-        if options.get(c):
+def expand_track_stores(options):
+    # replaces track store directories in the input with their tracks
+    files = []
+    options['track_stores'] = {}
+    for fn in options['files']:
+        if is_track_store(fn):
+            store = TrackStore(fn)
+            logger.info('Using %d tracks from track store %s' % (len(store.index), fn))
+            for name in store.names():
+                options['track_stores'][name] = store
+                files.append(name)
+        else:
+            files.append(fn)
+    options['files'] = files
+
+def log_raster_config(config):
+    defaults = RasterConfig.from_constants().to_constants()
+    for name, value in config.to_constants().items():
+        if value != defaults[name]:
             logger.debug(
                 'Overriding default value of %s (%s) with %s' % (
-                    opt,
-                    ascii(getattr(c, opt)),
-                    ascii(options.get(opt)),
+                    name,
+                    ascii(defaults[name]),
+                    ascii(value),
                 )
             )
-            setattr(c, opt, options.get(opt))
-            if opt == 'RASTER_SIZE_M':
-                RASTER_SIZE_LAT = options['RASTER_SIZE_M']/111000
-            if opt in ['RASTER_SIZE_M','RASTER_MANHATTAN_DISTANCE_MAX']:
-                c.BBOX_INCREASE_LAT=(c.RASTER_MANHATTAN_DISTANCE_MAX + 1) * c.RASTER_SIZE_LAT
-            if opt == 'RASTER_METHOD':
-                c.RASTER_FUNCTION = c.RASTER_FUNCTIONS[c.RASTER_METHOD]    
 
 def filter_bad_data(
         files,
@@ -250,7 +513,7 @@ def filter_bad_data(
     fns = copy(files)
     n_bad = 0
     for fn in fns:
-        if data[fn].shape[0] == 0:
+        if fn in data and data[fn].shape[0] == 0:
             n_bad+=1
             logger.warn('Removing %s due to 0 rows' % fn)
             files.pop(files.index(fn))
@@ -262,22 +525,30 @@ def filter_bad_data(
         logger.debug('No rows removed from filter')
             
 
-def get_metadata(record, fn):
+def get_metadata(record, fn, config=None):
     #logger.debug('summarizing %s' % fn)
+    if config is None:
+        config = RasterConfig.from_constants()
     
-    median_lat = np.median(record['position_lat'])
+    # like rasterizing, points without finite coordinates are ignored
+    lat = record['position_lat'].values.astype(np.float64)
+    long = record['position_long'].values.astype(np.float64)
+    lat[~np.isfinite(lat)] = np.nan
+    long[~np.isfinite(long)] = np.nan
+    median_lat = np.nanmedian(lat)
     cosine_lat = np.cos(PI/180 * median_lat)
 
-    bbox_increase_long = c.BBOX_INCREASE_LAT / cosine_lat
+    bbox_increase_lat = config.bbox_increase_lat
+    bbox_increase_long = bbox_increase_lat / cosine_lat
     
     bbox = {
         'lat': [
-            np.min(record['position_lat']) - c.BBOX_INCREASE_LAT,
-            np.max(record['position_lat']) + c.BBOX_INCREASE_LAT,
+            np.nanmin(lat) - bbox_increase_lat,
+            np.nanmax(lat) + bbox_increase_lat,
         ],
         'long': [
-            np.min(record['position_long']) - bbox_increase_long,
-            np.max(record['position_long']) + bbox_increase_long,
+            np.nanmin(long) - bbox_increase_long,
+            np.nanmax(long) + bbox_increase_long,
         ],
     }
 
@@ -290,102 +561,724 @@ def get_metadata(record, fn):
         'cosine_lat': cosine_lat,
     }
 
-def add_directions(data, options):
-    for fn in data.keys():
-        record = data[fn]
-        clat, clon = (
-            np.median(record['position_lat']),
-            np.median(record['position_long'])
-        )
-        lon_lat_ratio = np.cos(PI/180 * clat)
-        diffs = record[['position_lat','position_long']].diff(
-            c.ANGLE_LAG_SECONDS
-        )
-
-        # shifts differences to original values, then fills last rows with last direction
-        diffs = diffs.dropna().reset_index().append(
-            diffs.iloc[[-1] * c.ANGLE_LAG_SECONDS].reset_index()
-        ).reset_index()
-        diffs['position_long'] = diffs['position_long'] / lon_lat_ratio
-        record['angle'] = np.arctan2(
-            diffs['position_lat'],
-            diffs['position_long']
-        )
+def track_angles(lat, long, offsets, cosine_lat, lag):
+    """
+    angle of each point of the tracks in flat coordinate arrays (track k
+    owns points offsets[k]:offsets[k+1]), from the point lag points
+    later; the last lag points of a track repeat the angle before them,
+    and tracks of lag points or fewer have no angles (NaN)
+    """
+    lengths = np.diff(offsets)
+    track = np.repeat(np.arange(lengths.shape[0]), lengths)
+    i = np.arange(offsets[-1])
+    j = np.minimum(i, offsets[1:][track] - 1 - lag)
+    valid = j >= offsets[:-1][track]
+    j = np.where(valid, j, i)
+    j_lag = np.minimum(j + lag, offsets[-1] - 1)
+
+    angles = np.arctan2(
+        lat[j_lag] - lat[j],
+        (long[j_lag] - long[j]) / cosine_lat[track],
+    )
+    angles[~valid] = np.nan
+    return angles
+
+
+def add_directions(data, options, metadata):
+    """
+    adds the "angle" of each point to every record of data, using the
+    cosine_lat of its metadata
+    """
+    fns = list(data.keys())
+    if not fns:
+        return
+    offsets = np.zeros(len(fns) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([data[fn].shape[0] for fn in fns])
+    angles = track_angles(
+        np.concatenate([data[fn]['position_lat'].values for fn in fns]),
+        np.concatenate([data[fn]['position_long'].values for fn in fns]),
+        offsets,
+        np.array([metadata[fn]['cosine_lat'] for fn in fns], dtype=np.float64),
+        get_config(options).angle_lag_seconds,
+    )
+    for k, fn in enumerate(fns):
+        data[fn]['angle'] = angles[offsets[k]:offsets[k+1]]
     logger.info('Done adding directions')
         
 
-def main(options):
+# columns read from input files (others are skipped while parsing)
+REQUIRED_COLUMNS = ['position_long','position_lat','timestamp','distance']
+OPTIONAL_COLUMNS = ['timezone']
+
+# coordinates stay float64 so that raster bins are not affected
+COLUMN_DTYPES = {
+    'position_long': np.float64,
+    'position_lat': np.float64,
+    'distance': np.float32,
+}
+
+
+def load_track(fn, track_stores={}):
+    if fn in track_stores:
+        return track_stores[fn].load(fn)
+
+    columns = REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+    usecols = lambda col: col in columns
+    try:
+        record = pd.read_csv(
+            fn,
+            usecols=usecols,
+            dtype=dict(COLUMN_DTYPES, timestamp=np.int64),
+        )
+    except (ValueError, TypeError):
+        # non-integer (e.g., text) timestamps
+        record = pd.read_csv(fn, usecols=usecols, dtype=COLUMN_DTYPES)
+
+    missing = [col for col in REQUIRED_COLUMNS if col not in record.columns]
+    if missing:
+        raise ValueError('missing columns %s' % ', '.join(missing))
+    return record[[col for col in columns if col in record.columns]]
+
+
+def load_data(files, threads=1, track_stores={}):
+    """
+    loads files on a thread pool, with at most 2 * threads files being
+    read at a time; files that cannot be loaded are logged and left out
+    """
+    data = {}
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = {}
+        files = iter(files)
+        done = False
+        while not done or pending:
+            while not done and len(pending) < 2 * max(1, threads):
+                fn = next(files, None)
+                if fn is None:
+                    done = True
+                else:
+                    pending[executor.submit(load_track, fn, track_stores)] = fn
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                fn = pending.pop(future)
+                try:
+                    data[fn] = future.result()
+                except Exception as e:
+                    n_failed += 1
+                    logger.error('Could not load %s: %s' % (ascii(fn), e))
+
+    if n_failed > 0:
+        logger.warn('Skipped %d files that could not be loaded' % n_failed)
+    return data
+
+
+def needs_data(member, group, options, cache):
+    """
+    whether a track has to be loaded to rasterize it (i.e., not all of
+    its rasters are cached)
+    """
+    if options['rasterized_output_prefix']:
+        return True
+    long_raster_size = group.attributes['long_raster_size']
+    if not cache.has_raster(member['filename'], long_raster_size):
+        return True
+    return options['add_directional_similarity'] and not cache.has_raster(
+        member['filename'],
+        long_raster_size,
+        directional=True,
+    )
+
+
+def load_and_group(options, cache=None):
+    """
+    loads the input files (only those without cached rasters if a
+    RasterCache is given), creates their metadata and groups them;
+    returns the records, the metadata and the GroupProcessor
+    """
+    metadata = {}
+    if cache is not None:
+        logger.info('Looking up cached metadata')
+        with metrics.stage('load_cached_metadata'):
+            for fn in options['files']:
+                record_metadata = cache.load_metadata(fn)
+                if record_metadata is not None:
+                    metadata[fn] = record_metadata
+        logger.debug('%d of %d files found in cache' % (len(metadata), len(options['files'])))
+
     # load all files into memory brrrrr
     logger.info('loading data')
 
-        
-    data = {
-        fn: pd.read_csv(fn)[['position_long','position_lat','timestamp','distance','timezone']]
-        for fn in options['files']
-    }
-
+    with metrics.stage('load'):
+        data = load_data(
+            [fn for fn in options['files'] if fn not in metadata],
+            threads=options['load_threads'],
+            track_stores=options['track_stores'],
+        )
 
-    filter_bad_data(
-        options['files'],
-        data,        
-    )
+        filter_bad_data(
+            options['files'],
+            data,        
+        )
 
     logger.info('Creating metadata')
 
-    metadata = {
-        fn: get_metadata(data[fn], fn)
-        for fn in options['files']
-    }
+    with metrics.stage('metadata'):
+        for fn in data.keys():
+            metadata[fn] = get_metadata(data[fn], fn, options['raster_config'])
+            if cache is not None:
+                cache.save_metadata(fn, metadata[fn])
+
+    # keep input order, without files that could not be loaded
+    options['files'] = [fn for fn in options['files'] if fn in metadata]
+    metadata = {fn: metadata[fn] for fn in options['files']}
 
     logger.info('Grouping tracks')
-    grouper = GroupProcessor(
-        metadata=metadata
-    )
+    with metrics.stage('grouping'):
+        grouper = GroupProcessor(
+            metadata=metadata,
+            config=options['raster_config'],
+        )
     
     logger.debug('%d groups created' % len(grouper.groups))
 
     grouper.print_group_sizes()
-    
-    logger.info('Adding directions')
-    add_directions(data, options)
 
-    # applies rasterization to grouper->groups->members objects
-    rasterize(data, grouper)
-
-    calculate_norms(metadata, options)
-    similarity_data = calculate_similarities(
-        data,
-        grouper,
-        options,
+    if cache is not None:
+        with metrics.stage('load_uncached'):
+            missing = [
+                member['filename']
+                for group in grouper.groups
+                for member in group.members
+                if member['filename'] not in data and needs_data(member, group, options, cache)
+            ]
+            logger.info('Loading %d files without cached rasters' % len(missing))
+            data.update(load_data(
+                missing,
+                threads=options['load_threads'],
+                track_stores=options['track_stores'],
+            ))
+            failed = [fn for fn in missing if fn not in data]
+            if failed:
+                raise IOError('Could not reload %d files with cached metadata' % len(failed))
+
+    return data, metadata, grouper
+
+
+def make_cache(options):
+    """
+    RasterCache of the options, or None without --cache-dir or with
+    --no-cache
+    """
+    if options['cache_dir'] is None or options['no_cache']:
+        return None
+    cache = RasterCache(
+        os.path.expanduser(options['cache_dir']),
+        max_bytes=options['cache_max_mb'] * 2 ** 20,
+        config=options['raster_config'],
     )
-    logger.info('Calculated similarities')
-    write_grouper_to_disk(grouper, options)    
+    # tracks in a store are identified by the hash of their contents
+    for store in set(options['track_stores'].values()):
+        cache.hashes.update(store.hashes)
+    return cache
+
+
+def main(options):
+    cache = make_cache(options)
+    data, metadata, grouper = load_and_group(options, cache)
 
     if options['add_directional_similarity']:
-        rasterize_directional(data, grouper)
-        calculate_directional_norms(metadata, options)
-            
-        directional_similarity_data = calculate_directional_similarities(
-            data,
-            grouper,
-            options,
-        )
+        logger.info('Adding directions')
+        with metrics.stage('add_directions'):
+            add_directions(data, options, metadata)
+
+    # applies rasterization to grouper->groups->members objects
+    with metrics.stage('rasterize'):
+        rasterize(data, grouper, options, cache=cache)
+
+    with metrics.stage('norms'):
+        calculate_norms(metadata, options)
+    if options['top_k']:
+        with metrics.stage('similarities'):
+            neighbours = calculate_neighbours(
+                grouper,
+                options['top_k'],
+                options['min_similarity'],
+                get_weights_method(),
+                options,
+            )
+        logger.info('Calculated neighbours')
+    else:
+        # without directional similarities or a saved state, nothing else
+        # needs the similarities, so they are written out as they are
+        # calculated
+        if not options['add_directional_similarity'] and not options['save_state']:
+            writer = ResultWriter(options, grouper)
+        else:
+            writer = None
+        if options['lsh']:
+            with metrics.stage('lsh_candidates'):
+                lsh.find_candidates(grouper, options)
+                if options['lsh_recall_sample'] > 0:
+                    lsh.estimate_recall(grouper, options['lsh_recall_sample'], options)
+        with metrics.stage('similarities'):
+            if options['similarity_threshold'] is not None:
+                similarity_data = calculate_similarities_threshold(
+                    grouper,
+                    options['similarity_threshold'],
+                    get_weights_method(),
+                    options,
+                    similarities=writer,
+                )
+            elif options['lsh']:
+                similarity_data = lsh.calculate_similarities_lsh(
+                    grouper,
+                    options,
+                    similarities=writer,
+                )
+            else:
+                similarity_data = calculate_similarities(
+                    data,
+                    grouper,
+                    options,
+                    similarities=writer,
+                )
+        logger.info('Calculated similarities')
+    with metrics.stage('write_rasters'):
+        write_grouper_to_disk(grouper, options)    
+
+    if options['add_directional_similarity']:
+        with metrics.stage('directional_rasterize'):
+            rasterize_directional(data, grouper, options, cache=cache)
+        with metrics.stage('directional_norms'):
+            calculate_directional_norms(metadata, options)
+
+        with metrics.stage('directional_similarities'):
+            if options['top_k']:
+                directional_similarity_data = calculate_neighbour_directional_similarities(
+                    grouper,
+                    neighbours,
+                    options,
+                )
+            elif options['similarity_threshold'] is not None:
+                directional_similarity_data = calculate_pair_directional_similarities(
+                    grouper,
+                    similarity_data.keys(),
+                    options,
+                )
+            elif options['lsh']:
+                directional_similarity_data = lsh.calculate_similarities_lsh(
+                    grouper,
+                    options,
+                    directional=True,
+                )
+            else:
+                directional_similarity_data = calculate_directional_similarities(
+                    data,
+                    grouper,
+                    options,
+                )
         
         logger.info('Calculated directional similarities')
-        write_grouper_to_disk(grouper, options, directional=True)
+        with metrics.stage('write_directional_rasters'):
+            write_grouper_to_disk(grouper, options, directional=True)
 
     else:
         directional_similarity_data = None
 
-    write_results_to_disk(
+    with metrics.stage('write'):
+        if options['top_k']:
+            write_neighbours_to_disk(
+                neighbours,
+                directional_similarity_data,
+                options,
+                grouper,
+            )
+        else:
+            write_results_to_disk(
+                similarity_data,
+                directional_similarity_data,
+                options,
+                grouper,
+                writer=writer,
+            )
+
+    if options['save_state']:
+        with metrics.stage('save_state'):
+            incremental.save_state(
+                options['save_state'],
+                grouper,
+                similarity_data,
+                directional_similarity_data,
+                options,
+                get_weights_method(),
+            )
+
+    if cache is not None:
+        with metrics.stage('cache_evict'):
+            cache.evict()
+
+    logger.info('Done!')
+
+
+def load_metadata_batched(options, cache=None, batch_size=256):
+    """
+    metadata of the input files, loading a batch of files at a time (or
+    using cached metadata) without keeping the records
+    """
+    metadata = {}
+    if cache is not None:
+        logger.info('Looking up cached metadata')
+        with metrics.stage('load_cached_metadata'):
+            for fn in options['files']:
+                record_metadata = cache.load_metadata(fn)
+                if record_metadata is not None:
+                    metadata[fn] = record_metadata
+
+    missing = [fn for fn in options['files'] if fn not in metadata]
+    logger.info('Creating metadata of %d files' % len(missing))
+    for i in range(0, len(missing), batch_size):
+        files = missing[i:i+batch_size]
+        with metrics.stage('load'):
+            data = load_data(
+                files,
+                threads=options['load_threads'],
+                track_stores=options['track_stores'],
+            )
+            filter_bad_data(files, data)
+        with metrics.stage('metadata'):
+            for fn in files:
+                if fn not in data:
+                    continue
+                metadata[fn] = get_metadata(data[fn], fn, options['raster_config'])
+                if cache is not None:
+                    cache.save_metadata(fn, metadata[fn])
+        logger.debug('Created metadata of %d files' % min(i+batch_size, len(missing)))
+
+    # keep input order, without files that could not be loaded
+    options['files'] = [fn for fn in options['files'] if fn in metadata]
+    return {fn: metadata[fn] for fn in options['files']}
+
+
+def rasterize_to_store(grouper, metadata, options, cache=None):
+    """
+    rasterizes one group at a time and appends its rasters to the raster
+    store; only the tracks of the group being rasterized are loaded
+    """
+    directional = options['add_directional_similarity']
+    writer = raster_store.RasterStoreWriter(options['raster_store'], directional=directional)
+    for i, group in enumerate(grouper.groups):
+        logger.debug('Rasterizing group %d/%d' % (i+1, len(grouper.groups)))
+        group_grouper = GroupProcessor(groups=[group])
+        files = [
+            member['filename']
+            for member in group.members
+            if cache is None or needs_data(member, group, options, cache)
+        ]
+        with metrics.stage('load'):
+            data = load_data(
+                files,
+                threads=options['load_threads'],
+                track_stores=options['track_stores'],
+            )
+        failed = [fn for fn in files if fn not in data]
+        if failed:
+            raise IOError('Could not reload %d files with metadata' % len(failed))
+
+        if directional:
+            with metrics.stage('add_directions'):
+                add_directions(data, options, metadata)
+        with metrics.stage('rasterize'):
+            rasterize(data, group_grouper, options, cache=cache)
+        if directional:
+            with metrics.stage('directional_rasterize'):
+                rasterize_directional(data, group_grouper, options, cache=cache)
+
+        with metrics.stage('write_raster_store'):
+            writer.add_group(group)
+        raster_store.release_group_rasters(group)
+    writer.close()
+
+
+def main_out_of_core(options):
+    """
+    same output as main(), but tracks are rasterized one group at a time
+    into a memory-mapped raster store (--raster-store) and similarities
+    are calculated from it group by group, so that memory use is bounded
+    by the largest group rather than the whole input
+    """
+    cache = make_cache(options)
+    directional = options['add_directional_similarity']
+    metadata = load_metadata_batched(options, cache)
+
+    logger.info('Grouping tracks')
+    with metrics.stage('grouping'):
+        grouper = GroupProcessor(
+            metadata=metadata,
+            config=options['raster_config'],
+        )
+    grouper.print_group_sizes()
+
+    logger.info('Rasterizing to %s' % options['raster_store'])
+    rasterize_to_store(grouper, metadata, options, cache=cache)
+
+    store = raster_store.RasterStore(options['raster_store'])
+    writer = ResultWriter(options, grouper, directional=directional)
+    logger.info('Calculating similarities from %s' % options['raster_store'])
+    for i, group in enumerate(grouper.groups):
+        with metrics.stage('load_raster_store'):
+            store.load_group_rasters(i, group, directional=directional)
+        group_grouper = GroupProcessor(groups=[group])
+        group_metadata = {m['filename']: m for m in group.members}
+
+        with metrics.stage('norms'):
+            calculate_norms(group_metadata, options)
+        if not directional:
+            with metrics.stage('similarities'):
+                calculate_similarities({}, group_grouper, options, similarities=writer)
+        else:
+            with metrics.stage('similarities'):
+                similarity_data = calculate_similarities({}, group_grouper, options)
+            with metrics.stage('directional_norms'):
+                calculate_directional_norms(group_metadata, options)
+            with metrics.stage('directional_similarities'):
+                directional_similarity_data = calculate_directional_similarities(
+                    {},
+                    group_grouper,
+                    options,
+                )
+            for key, similarity in similarity_data.items():
+                writer.add(key, similarity, directional_similarity_data[key])
+        raster_store.release_group_rasters(group)
+
+    with metrics.stage('write'):
+        write_results_to_disk(None, None, options, grouper, writer=writer)
+
+    if cache is not None:
+        with metrics.stage('cache_evict'):
+            cache.evict()
+
+    logger.info('Done!')
+
+
+def convert_to_store(options, batch_size=256):
+    """
+    writes the input files to a columnar track store, a batch of files at
+    a time
+    """
+    logger.info('Converting %d files to track store %s' % (
+        len(options['files']),
+        options['convert_to_store'],
+    ))
+    writer = TrackStoreWriter(options['convert_to_store'])
+    for i in range(0, len(options['files']), batch_size):
+        files = options['files'][i:i+batch_size]
+        data = load_data(
+            files,
+            threads=options['load_threads'],
+            track_stores=options['track_stores'],
+        )
+        for fn in files:
+            if fn not in data:
+                continue
+            if data[fn].shape[0] == 0:
+                logger.warn('Skipping %s due to 0 rows' % fn)
+                continue
+            writer.add(fn, data[fn])
+        logger.debug('Converted %d files' % min(i+batch_size, len(options['files'])))
+    writer.close()
+
+
+def main_incremental(options):
+    """
+    adds the input files that are not in options['previous_state'] to it,
+    calculating only the pairs of the groups they join
+    """
+    directional = options['add_directional_similarity']
+    with metrics.stage('load_state'):
+        state = incremental.load_state(
+            options['previous_state'],
+            options,
+            get_weights_method(),
+        )
+    old_groups = state['groups']
+    similarity_data = state['similarities']
+    directional_similarity_data = state['directional_similarities']
+
+    known = {m['filename'] for g in old_groups for m in g.members}
+    new_files = [fn for fn in options['files'] if fn not in known]
+    logger.info('%d new files (%d already in state)' % (
+        len(new_files),
+        len(options['files']) - len(new_files),
+    ))
+
+    if options['rasterized_output_prefix']:
+        logger.warn('--rasterized-output-prefix is ignored with --previous-state')
+        options['rasterized_output_prefix'] = None
+
+    with metrics.stage('load'):
+        data = load_data(
+            new_files,
+            threads=options['load_threads'],
+            track_stores=options['track_stores'],
+        )
+        new_files = [fn for fn in new_files if fn in data]
+        filter_bad_data(new_files, data)
+    with metrics.stage('metadata'):
+        metadata = {
+            fn: get_metadata(data[fn], fn, options['raster_config'])
+            for fn in new_files
+        }
+
+    groups = []
+    n_pairs = 0
+    for group_indices, new_members in incremental.plan_merges(
+            old_groups,
+            list(metadata.values()),
+    ):
+        merged = [old_groups[i] for i in group_indices]
+        if len(merged) == 1 and not new_members:
+            groups.append(merged[0])
+            continue
+
+        with metrics.stage('load_state_rasters'):
+            for group in merged:
+                incremental.load_group_rasters(group, directional=directional)
+        group, origin = merge_group(merged, new_members, data, options)
+
+        with metrics.stage('similarities'):
+            n_pairs += update_group_similarities(
+                group,
+                origin,
+                similarity_data,
+                directional_similarity_data,
+                options,
+            )
+        groups.append(group)
+
+    logger.info('Calculated %d new pairs' % n_pairs)
+    grouper = GroupProcessor(groups=groups)
+    grouper.print_group_sizes()
+    grouper.record_group_sizes()
+
+    with metrics.stage('write'):
+        write_results_to_disk(
+            similarity_data,
+            directional_similarity_data,
+            options,
+            grouper
+        )
+
+    if options['save_state']:
+        with metrics.stage('save_state'):
+            incremental.save_state(
+                options['save_state'],
+                grouper,
+                similarity_data,
+                directional_similarity_data,
+                options,
+                get_weights_method(),
+            )
+
+    logger.info('Done!')
+
+def merge_group(merged, new_members, data, options):
+    """
+    group of previous groups (whose rasters are loaded) and new members;
+    the largest previous group keeps its grid, and the new members and
+    members of previous groups on other grids are rasterized on it. data
+    needs the records of the new members, and the records of members
+    that are rasterized again are loaded into it.
+
+    returns the group and a dict of filename -> index (in merged) of the
+    previous group of each previous member
+    """
+    directional = options['add_directional_similarity']
+    base = max(merged, key=lambda g: len(g.members), default=None)
+    old_members = []
+    rerasterize = []
+    origin = {}
+    for i, group in enumerate(merged):
+        for member in group.members:
+            origin[member['filename']] = i
+            old_members.append(member)
+            if group.attributes['long_raster_size'] != base.attributes['long_raster_size']:
+                rerasterize.append(member)
+
+    group = Group(old_members + new_members, options['raster_config'])
+    group.set_attributes()
+    if base is not None:
+        group.attributes['long_raster_size'] = base.attributes['long_raster_size']
+
+    to_rasterize = rerasterize + new_members
+    to_load = [m['filename'] for m in rerasterize]
+    if to_load:
+        logger.info('Loading %d files to rasterize on merged grid' % len(to_load))
+        with metrics.stage('load'):
+            data.update(load_data(
+                to_load,
+                threads=options['load_threads'],
+                track_stores=options['track_stores'],
+            ))
+    if directional:
+        with metrics.stage('add_directions'):
+            add_directions(
+                {m['filename']: data[m['filename']] for m in to_rasterize},
+                options,
+                {m['filename']: m for m in to_rasterize},
+            )
+    partial_grouper = GroupProcessor(groups=[Group(to_rasterize, options['raster_config'])])
+    partial_grouper.groups[0].attributes = group.attributes
+    with metrics.stage('rasterize'):
+        rasterize(data, partial_grouper, options)
+    with metrics.stage('norms'):
+        calculate_norms({m['filename']: m for m in to_rasterize}, options)
+    if directional:
+        with metrics.stage('directional_rasterize'):
+            rasterize_directional(data, partial_grouper, options)
+        with metrics.stage('directional_norms'):
+            calculate_directional_norms({m['filename']: m for m in to_rasterize}, options)
+    return group, origin
+
+
+def update_group_similarities(
+        group,
+        origin,
         similarity_data,
         directional_similarity_data,
         options,
-        grouper
-    )
-
+):
+    """
+    calculates the pairs of a merged group whose members do not come from
+    the same previous group (origin maps filenames of previous members to
+    their group); returns the number of pairs
+    """
+    directional = options['add_directional_similarity']
+    n_pairs = 0
+    for member1, member2 in group.pairwise_iter():
+        # pairs within a previous group are already known
+        o1 = origin.get(member1['filename'])
+        if o1 is not None and o1 == origin.get(member2['filename']):
+            continue
+        key = (member1['filename'], member2['filename'])
+        if not has_intersection(member1, member2):
+            metrics.count('pairs_skipped_by_bbox')
+            similarity_data[key] = 0
+            if directional:
+                directional_similarity_data[key] = 0
+        else:
+            similarity_data[key] = calculate_similarity(member1, member2, options)
+            if directional:
+                directional_similarity_data[key] = calculate_directional_similarity(
+                    member1,
+                    member2,
+                    options,
+                )
+        n_pairs += 1
+    metrics.count('pairs', n_pairs)
+    return n_pairs
 
-    logger.info('Done!')
 
 def write_grouper_to_disk(grouper, options, directional=False):
     if options['rasterized_output_prefix']:
@@ -412,96 +1305,230 @@ def write_grouper_to_disk(grouper, options, directional=False):
 
 # python3 calculate_similarities.py ../fit_conversion/subject_data/spriesdaddy/fit_csv/
 
+def load_map_df(options):
+    """
+    "filename"/"id" columns of the map file, or None if it can't be used
+    """
+    logger.info('Attempting map of column filenames with external CSV')
+    try:
+        map_df = pd.read_csv(options['map_filename'])
+    except Exception as e:
+        logger.error('Could not find file %s' % ascii(options['map_filename']))
+        return None
+
+    if 'filename' not in map_df.columns or 'id' not in map_df.columns:
+        logger.error('Cannot find "id" or "filename" columns in map file. Skipping')
+        return None
+    return map_df[['filename','id']]
+
+
+def filename_maps(options, grouper):
+    """
+    dicts of filename -> name written to the output (path truncated if
+    requested) and filename -> id from the map file (None if no map file
+    is used)
+    """
+    filenames = [m['filename'] for g in grouper.groups for m in g.members]
+    if options['truncate_file_path']:
+        sub_regex = re.compile(r'.*/')
+        names = {fn: sub_regex.sub('', fn) for fn in filenames}
+    else:
+        names = {fn: fn for fn in filenames}
+
+    ids = None
+    if options['map_filename']:
+        map_df = load_map_df(options)
+        if map_df is not None:
+            id_map = dict(zip(map_df['filename'], map_df['id']))
+            ids = {fn: id_map.get(name) for fn, name in names.items()}
+    return names, ids
+
+
+class ResultWriter:
+    """
+    writes similarity rows to the output file in chunks of chunk_size
+    rows; can also be used as the "similarities" mapping of the
+    similarity functions, so that rows are written as they are calculated
+
+    path truncation and id mapping use dicts precomputed from the
+    grouper's filenames
+    """
+    def __init__(
+            self,
+            options,
+            grouper,
+            directional=False,
+            chunk_size=100000,
+    ):
+        self.filename = options['output_filename']
+        self.directional = directional
+        self.chunk_size = chunk_size
+        self.remove_filenames = options['remove_filenames']
+        self.n_rows = 0
+        self.header_written = False
+        self.rows = []
+
+        self.names, self.ids = filename_maps(options, grouper)
+
+        self.cols = []
+        if not self.remove_filenames:
+            self.cols.extend(['fn1','fn2',])
+        self.cols.extend(['similarity'])
+        if directional:
+            self.cols.append('directional_similarity')
+        if self.ids is not None:
+            self.cols.extend(['id1','id2'])
+
+    def __setitem__(self, key, similarity):
+        self.add(key, similarity)
+
+    def add(self, key, similarity, directional_similarity=None):
+        self.rows.append((key[0], key[1], similarity, directional_similarity))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def add_zeros(self, fn1, fn2):
+        """
+        adds pairs whose similarities are 0
+        """
+        self.flush()
+        zeros = np.zeros(len(fn1))
+        self.write_chunk(fn1, fn2, zeros, zeros if self.directional else None)
+
+    def flush(self):
+        if not self.rows:
+            return
+        fn1, fn2, similarity, directional_similarity = zip(*self.rows)
+        self.rows = []
+        self.write_chunk(
+            fn1,
+            fn2,
+            similarity,
+            directional_similarity if self.directional else None,
+        )
+
+    def write_chunk(self, fn1, fn2, similarity, directional_similarity=None):
+        chunk = {}
+        if not self.remove_filenames:
+            chunk['fn1'] = [self.names[fn] for fn in fn1]
+            chunk['fn2'] = [self.names[fn] for fn in fn2]
+        chunk['similarity'] = similarity
+        if directional_similarity is not None:
+            chunk['directional_similarity'] = directional_similarity
+        if self.ids is not None:
+            chunk['id1'] = [self.ids[fn] for fn in fn1]
+            chunk['id2'] = [self.ids[fn] for fn in fn2]
+
+        pd.DataFrame(chunk, columns=self.cols).to_csv(
+            self.filename,
+            mode='a' if self.header_written else 'w',
+            header=not self.header_written,
+            index=False,
+        )
+        self.header_written = True
+        self.n_rows += len(fn1)
+
+    def close(self):
+        self.flush()
+        if not self.header_written:
+            pd.DataFrame({}, columns=self.cols).to_csv(self.filename, index=False)
+            self.header_written = True
+        logger.debug('Wrote %d rows to %s' % (self.n_rows, self.filename))
+
+
 def write_results_to_disk(
         simdata,
         dsimdata,
         options,
-        grouper
+        grouper,
+        writer=None,
 ):
-    # get unique pairs
-    keys, values = zip(*simdata.items())
-
-    source_data = {
-            'fn1': [k[0] for k in keys],
-            'fn2': [k[1] for k in keys],
-            'similarity': values
-    }
-    cols = []
-    if not options['remove_filenames']:
-        cols.extend(['fn1','fn2',])
-    cols.extend(['similarity'])
-    if dsimdata is not None:
-        cols+=['directional_similarity']
-        source_data.update(
-            {'directional_similarity': [dsimdata[k] for k in keys]}
-        )
-    df = pd.DataFrame(
-        source_data
-    )
+    """
+    writes similarities (and directional similarities) to the output file,
+    followed by the inter-group pairs
+
+    if a ResultWriter is given, intra-group similarities were already
+    written to it while they were calculated
+    """
+    if writer is None:
+        writer = ResultWriter(options, grouper, directional=dsimdata is not None)
+        logger.info('Writing data to %s' % options['output_filename'])
+        for key, similarity in simdata.items():
+            writer.add(
+                key,
+                similarity,
+                dsimdata[key] if dsimdata is not None else None,
+            )
 
     if options['add_inter_group_pairs']:
+        # inter-group pairs are all zero, and can be far more numerous
+        # than intra-group pairs, so they are streamed to the file
         logger.info('Adding inter-group pairs')
-        filename_pairs = list(grouper.inter_group_filename_pairs())
-        inter_pair_df = pd.DataFrame({
-            'fn1': [x[0] for x in filename_pairs],
-            'fn2': [x[1] for x in filename_pairs],
-        })
-        inter_pair_df['similarity'] = 0
-        if dsimdata is not None:
-            inter_pair_df['directional_similarity'] = 0
-        df = df.append(
-            inter_pair_df,
-            ignore_index=True
-        )
+        for fn1, fn2 in grouper.inter_group_filename_chunks(writer.chunk_size):
+            writer.add_zeros(fn1, fn2)
 
-    if options['truncate_file_path']:
-        sub_regex = re.compile(r'.*/')
-        df['fn1'] = df['fn1'].str.replace(sub_regex,'')
-        df['fn2'] = df['fn2'].str.replace(sub_regex,'')
+    writer.close()
+    
 
-    if options['map_filename']:
-        cols.extend(['id1','id2'])
-        logger.info('Attempting map of column filenames with external CSV')
-        try:
-            map_df = pd.read_csv(options['map_filename'])
-        except Exception as e:
-            logger.error('Could not find file %s' % ascii(options['map_filename']))
-            map_df = None
-
-        if map_df is None:
-            map_df = pd.DataFrame({})
-        elif 'filename' not in map_df.columns or 'id' not in map_df.columns:
-            logger.error('Cannot find "id" or "filename" columns in map file. Skipping')
-        else:
-            try:
-                logger.info('merging df with map file')
-                map_df = map_df[['filename','id']]
-                df = df.merge(
-                    map_df.rename({'id':'id1'}, axis=1),
-                    how='left',
-                    left_on='fn1',
-                    right_on='filename'
-                )
-                df = df.merge(
-                    map_df.rename({'id':'id2'}, axis=1),
-                    how='left',
-                    left_on='fn2',
-                    right_on='filename'
-                )
-                logger.info('merged df and map')
-                    
-                    
-            except Exception as e:
-                logger.error(str(e))
-                logger.error('Could not map IDs back to file')
-                
+def write_neighbours_to_disk(
+        neighbours,
+        directional_similarity_data,
+        options,
+        grouper,
+):
+    """
+    writes one row per track and neighbour: fn, rank (1 = most similar),
+    neighbour and similarity, plus directional similarity and ids if
+    available
+    """
+    logger.info('Writing neighbours to %s' % options['output_filename'])
+    names, ids = filename_maps(options, grouper)
+    rows = []
+    for fn, member_neighbours in neighbours.items():
+        for rank, (neighbour, similarity) in enumerate(member_neighbours, 1):
+            row = {}
+            if not options['remove_filenames']:
+                row['fn'] = names[fn]
+                row['neighbour'] = names[neighbour]
+            row['rank'] = rank
+            row['similarity'] = similarity
+            if directional_similarity_data is not None:
+                row['directional_similarity'] = directional_similarity_data[(fn, neighbour)]
+            if ids is not None:
+                row['id'] = ids[fn]
+                row['neighbour_id'] = ids[neighbour]
+            rows.append(row)
 
-    logger.info('Writing data to %s' % options['output_filename'])
+    cols = []
+    if not options['remove_filenames']:
+        cols.extend(['fn','neighbour'])
+    cols.extend(['rank','similarity'])
+    if directional_similarity_data is not None:
+        cols.append('directional_similarity')
+    if ids is not None:
+        cols.extend(['id','neighbour_id'])
+    pd.DataFrame(rows, columns=cols).to_csv(
+        options['output_filename'],
+        index=False,
+    )
 
-    df[cols].to_csv(options['output_filename'], index=False)
-    
 
 if __name__=='__main__':
     options = get_options()
 
-    main(options)
+    if options['metrics_output']:
+        metrics.enable(trace_memory=options['metrics_trace_memory'])
+
+    try:
+        if options['convert_to_store']:
+            convert_to_store(options)
+        elif options['previous_state']:
+            main_incremental(options)
+        elif options['raster_store']:
+            main_out_of_core(options)
+        else:
+            main(options)
+    finally:
+        if options['metrics_output']:
+            metrics.write(options['metrics_output'])
+            logger.info('Wrote metrics to %s' % options['metrics_output'])